@@ -1,11 +1,11 @@
 import json
 from pathlib import Path
 import shutil
+import tempfile
 
-from git import Repo
 from airflow.decorators import dag, task
-from google.cloud import secretmanager, storage
-import google.auth
+
+from dataform_helpers.gcp_project import get_project_id
 
 
 default_args = {
@@ -18,56 +18,42 @@ REPO_URL: str = "ADD_REPO_URL_HERE"
 # Secret Manager Credentials name
 CREDENTIALS_SECRET_NAME = "dataform_credentials"
 
+# Clones go through a bare mirror on the worker's local disk, so that only
+# new objects are fetched on each run. Use {"depth": 1} instead for a plain
+# shallow clone. See dataform_helpers.git_cache.CloneOptions
+GIT_CLONE_OPTIONS = {"cache_dir": Path(tempfile.gettempdir()) / "dataform-git-cache"}
+
 # AUTHOR: To be modified
 # You can set the author in a global variable in Airflow and retrieve it from there
 # TODO: Add the author from a global variable
 AUTHOR = 'CHANGE-THE-AUTHOR-HERE'
 
-# Automatically get the project ID
-_, PROJECT_ID = google.auth.default()
-
-
-# Bucket where the dataform build should be saved
-GCS_BUCKET = f"{PROJECT_ID}-dataform-build"
-
-# Full GCS path
-GCS_PATH = f"gs://{GCS_BUCKET}/{AUTHOR}"
-
-
-class SecretManagerHelper:
-    # pylint: disable=too-few-public-methods
-    """Wrapper around Google Secret Manager."""
 
-    project_id: str
-    client: secretmanager.SecretManagerServiceClient
+# The project, and the paths derived from it, are resolved on first use
+# rather than at import, which would slow down every parse of this file
+def get_gcs_bucket() -> str:
+    """Bucket where the dataform build should be saved"""
+    return f"{get_project_id()}-dataform-build"
 
-    def __init__(self, project_id: str):
-        """Sets project and instantiates Secret Manager client"""
-        self.project_id = project_id
-        self.client = secretmanager.SecretManagerServiceClient()
 
-    def get_secret(self, secret_name: str) -> str:
-        """Using the secret name, fetches the secret value
+def get_gcs_path() -> str:
+    """Full GCS path"""
+    return f"gs://{get_gcs_bucket()}/{AUTHOR}"
 
-        Args:
-            secret_name (str): The name of the secret as defined in
-                Google Secret Manager
 
-        Returns:
-            str: The value stored in the secret
-        """
-        name = (
-            f"projects/{self.project_id}/secrets/{secret_name}/versions/latest"
-        )
+# Number of files transferred to / from GCS in parallel
+GCS_TRANSFER_WORKERS = 32
 
-        response = self.client.access_secret_version(request={"name": name})
-        return response.payload.data.decode("UTF-8")
+# How the project is saved on GCS: "files" (one object per file),
+# "tar.gz" or "tar.zst" (a single archive, extracted while streaming)
+SNAPSHOT_FORMAT = "files"
 
 
 class LocalDiskHelper:
     @staticmethod
     def clone_dataform_project(repo_url: str):
-        """Loads dataform project from Github into a local folder
+        """Loads dataform project from Github into a local folder, through
+        the git mirror cache of the worker (see GIT_CLONE_OPTIONS)
 
         Args:
             repo_url (str): Github https path to repository
@@ -78,14 +64,17 @@ class LocalDiskHelper:
         destination_dir = Path("dataform_example")
         LocalDiskHelper.remove_dir_if_exists(destination_dir)
 
-        destination_dir.mkdir(parents=True, exist_ok=True)
-        Repo.clone_from(repo_url, str(destination_dir))
+        from dataform_helpers import git_cache
 
-        return destination_dir
+        return git_cache.clone_repository(
+            repo_url, destination_dir, git_cache.CloneOptions(**GIT_CLONE_OPTIONS)
+        )
 
     @staticmethod
     def create_credentials_file(base_path: Path):
-        secret_manager_helper = SecretManagerHelper(PROJECT_ID)
+        from dataform_helpers.secret_helper import SecretManagerHelper
+
+        secret_manager_helper = SecretManagerHelper(get_project_id())
         credentials = json.loads(
             secret_manager_helper.get_secret(CREDENTIALS_SECRET_NAME)
         )
@@ -105,26 +94,20 @@ class LocalDiskHelper:
             shutil.rmtree(directory)
 
     @staticmethod
-    def overwrite_dataform_vars(dataform_json_path: str, dataform_vars: dict):
+    def overwrite_dataform_vars(dataform_json_path: str, dataform_vars: dict) -> str:
         """Overwrites dataform variables in the given dataform_json_path
 
         Args:
             dataform_json_path (str): Path pointing towards dataform.json file
             dataform_vars (dict): Variables to add / change in dataform.json
-        """
-        with open(dataform_json_path) as json_file:
-            json_data = json.load(json_file)
 
-        if "vars" not in json_data:
-            json_data["vars"] = {}
-
-        json_data["vars"] = {
-            **json_data["vars"],
-            **dataform_vars
-        }
+        Returns:
+            str: Hash of the resulting variables, see
+                dataform_helpers.dataform_vars.patch_dataform_vars
+        """
+        from dataform_helpers.dataform_vars import patch_dataform_vars
 
-        with open(dataform_json_path, 'w') as out_file:
-            json.dump(json_data, out_file, indent=4)
+        return patch_dataform_vars(dataform_json_path, dataform_vars)
 
 
 class GCSHelper:
@@ -132,7 +115,7 @@ class GCSHelper:
 
     @staticmethod
     def upload_local_dir_to_gcs(local_dir_path, destination_gcs_path):
-        """Upload the contents of a local directory to GCS
+        """Upload the contents of a local directory to GCS, in SNAPSHOT_FORMAT
 
         Note: The structure of the local directory is replicated on Cloud Storage.
 
@@ -140,15 +123,14 @@ class GCSHelper:
             local_dir_path (str): The path to the local directory.
             destination_gcs_path (str): The path to the GCS location.
         """
-        client = storage.Client()
-        local_dir_path = Path(local_dir_path)
-        for path_to_file in local_dir_path.glob("**/*"):
-            if path_to_file.is_file():
-                path_without_root = Path(*path_to_file.parts[1:])
-                destination_uri = f"{destination_gcs_path}/{path_without_root}"
-                destination_blob = storage.blob.Blob.from_string(destination_uri,
-                                                                 client=client)
-                destination_blob.upload_from_filename(path_to_file)
+        from dataform_helpers import snapshot
+
+        snapshot.save_snapshot(
+            local_dir_path,
+            destination_gcs_path,
+            snapshot_format=SNAPSHOT_FORMAT,
+            max_workers=GCS_TRANSFER_WORKERS
+        )
 
     @staticmethod
     def download_folder_from_gcs_and_return_base_path(
@@ -156,24 +138,28 @@ class GCSHelper:
         gcs_prefix: str,
         local_destination_path: Path
     ):
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(bucket_or_name=gcs_bucket)
-        blobs = bucket.list_blobs(prefix=gcs_prefix)
-
-        base_path = Path(local_destination_path / Path(gcs_prefix))
+        """Downloads the project saved under the GCS prefix, whatever its format
 
-        LocalDiskHelper.remove_dir_if_exists(base_path)
-
-        for blob in blobs:
-            file_path = Path(local_destination_path / blob.name)
+        Args:
+            gcs_bucket (str): Bucket where the project is saved
+            gcs_prefix (str): Prefix where the project is saved
+            local_destination_path (Path): Local directory to download into
 
-            if len(file_path.parts) > 1:
-                base_path = Path(*file_path.parts[:-1])
-                base_path.mkdir(parents=True, exist_ok=True)
+        Returns:
+            Path: Local path of the downloaded prefix
+        """
+        from dataform_helpers import snapshot
 
-            blob.download_to_filename(file_path)
+        LocalDiskHelper.remove_dir_if_exists(
+            Path(local_destination_path / Path(gcs_prefix))
+        )
 
-        return base_path
+        return snapshot.load_snapshot(
+            gcs_bucket,
+            gcs_prefix,
+            local_destination_path,
+            max_workers=GCS_TRANSFER_WORKERS
+        )
 
 
 # TODO: Add DAG configuration
@@ -186,7 +172,7 @@ def run_audience_example():
         # TODO 2: Add the repo to GCS. BE MINDFUL OF THE AUTHOR!
 
         return {
-            "bucket": GCS_BUCKET,
+            "bucket": get_gcs_bucket(),
             "path": AUTHOR
         }
 
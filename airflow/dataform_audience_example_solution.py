@@ -1,15 +1,18 @@
 import json
+from dataclasses import asdict
 from pathlib import Path
 import shutil
+import tempfile
 import os
+from typing import List, Optional
 
-from git import Repo
 from airflow.decorators import dag, task
+from airflow.exceptions import AirflowSkipException
 from airflow.utils.dates import days_ago
-from airflow.operators.bash import BashOperator
 from airflow.operators.python import get_current_context
-from google.cloud import secretmanager, storage
-import google.auth
+
+from dataform_helpers import metrics
+from dataform_helpers.gcp_project import get_project_id
 
 
 default_args = {
@@ -20,67 +23,83 @@ REPO_URL: str = "ADD_REPO_URL_HERE"
 
 CREDENTIALS_SECRET_NAME = "dataform_credentials"
 
+# Clones go through a bare mirror on the worker's local disk, so that only
+# new objects are fetched on each run. Use {"depth": 1} instead for a plain
+# shallow clone. See dataform_helpers.git_cache.CloneOptions
+GIT_CLONE_OPTIONS = {"cache_dir": Path(tempfile.gettempdir()) / "dataform-git-cache"}
+
 AUTHOR = 'alexb'
 
-_, PROJECT_ID = google.auth.default()
 
-GCS_BUCKET = f"{PROJECT_ID}-dataform-build"
+# The project, and the paths derived from it, are resolved on first use
+# rather than at import, which would slow down every parse of this file
+def get_gcs_bucket(project_id: Optional[str] = None) -> str:
+    """Bucket where the dataform build should be saved"""
+    return f"{project_id or get_project_id()}-dataform-build"
 
-GCS_PATH = f"gs://{GCS_BUCKET}/{AUTHOR}"
 
+def get_gcs_path(author: str = AUTHOR, project_id: Optional[str] = None) -> str:
+    """Full GCS path"""
+    return f"gs://{get_gcs_bucket(project_id)}/{author}"
 
-class SecretManagerHelper:
-    # pylint: disable=too-few-public-methods
-    """Wrapper around Google Secret Manager."""
 
-    project_id: str
-    client: secretmanager.SecretManagerServiceClient
+# Number of files transferred to / from GCS in parallel
+GCS_TRANSFER_WORKERS = 32
 
-    def __init__(self, project_id: str):
-        """Sets project and instantiates Secret Manager client"""
-        self.project_id = project_id
-        self.client = secretmanager.SecretManagerServiceClient()
+# How the project is saved on GCS: "files" (one object per file),
+# "tar.gz" or "tar.zst" (a single archive, extracted while streaming)
+SNAPSHOT_FORMAT = "files"
 
-    def get_secret(self, secret_name: str) -> str:
-        """Using the secret name, fetches the secret value
+# Tag of the actions run by the DAG
+DATAFORM_TAG = "orchestrator_audience"
 
-        Args:
-            secret_name (str): The name of the secret as defined in
-                Google Secret Manager
+# When above 1, the tagged actions are split into up to this number of
+# independent shards, each run by its own task
+DATAFORM_SHARDS = 1
+
+# Only runs the actions affected by the commits since the last successful
+# run, when their Dataform vars did not change. Ignored when sharded
+INCREMENTAL_RUNS = False
+
+
+def get_npm_cache_gcs_path(project_id: Optional[str] = None) -> str:
+    """node_modules tarballs keyed on the package-lock hash, shared between workers"""
+    return f"gs://{get_gcs_bucket(project_id)}/npm-cache"
 
-        Returns:
-            str: The value stored in the secret
-        """
-        name = (
-            f"projects/{self.project_id}/secrets/{secret_name}/versions/latest"
-        )
 
-        response = self.client.access_secret_version(request={"name": name})
-        return response.payload.data.decode("UTF-8")
+def get_graph_cache_gcs_path(project_id: Optional[str] = None) -> str:
+    """Compiled graphs keyed on the commit and the hash of the Dataform vars"""
+    return f"gs://{get_gcs_bucket(project_id)}/compiled-graphs"
 
 
 class LocalDiskHelper:
     @staticmethod
-    def clone_dataform_project(repo_url: str):
-        """Loads dataform project from Github into a local folder
+    def clone_dataform_project(repo_url: str, author: str = AUTHOR):
+        """Loads dataform project from Github into a local folder, through
+        the git mirror cache of the worker (see GIT_CLONE_OPTIONS)
 
         Args:
             repo_url (str): Github https path to repository
+            author (str): Author of the DAG, each author gets its own folder
 
         Returns:
             destination_dir (Path): Path to where the project will be saved.
         """
-        destination_dir = Path("dataform_example")
+        destination_dir = Path("dataform_example") / author
         LocalDiskHelper.remove_dir_if_exists(destination_dir)
 
-        destination_dir.mkdir(parents=True, exist_ok=True)
-        Repo.clone_from(repo_url, str(destination_dir))
+        from dataform_helpers import git_cache
 
-        return destination_dir
+        with metrics.stage("clone", author=author):
+            return git_cache.clone_repository(
+                repo_url, destination_dir, git_cache.CloneOptions(**GIT_CLONE_OPTIONS)
+            )
 
     @staticmethod
-    def create_credentials_file(base_path: Path):
-        secret_manager_helper = SecretManagerHelper(PROJECT_ID)
+    def create_credentials_file(base_path: Path, project_id: Optional[str] = None):
+        from dataform_helpers.secret_helper import SecretManagerHelper
+
+        secret_manager_helper = SecretManagerHelper(project_id or get_project_id())
         credentials = json.loads(
             secret_manager_helper.get_secret(CREDENTIALS_SECRET_NAME)
         )
@@ -100,26 +119,20 @@ class LocalDiskHelper:
             shutil.rmtree(directory)
 
     @staticmethod
-    def overwrite_dataform_vars(dataform_json_path: str, dataform_vars: dict):
+    def overwrite_dataform_vars(dataform_json_path: str, dataform_vars: dict) -> str:
         """Overwrites dataform variables in the given dataform_json_path
 
         Args:
             dataform_json_path (str): Path pointing towards dataform.json file
             dataform_vars (dict): Variables to add / change in dataform.json
-        """
-        with open(dataform_json_path) as json_file:
-            json_data = json.load(json_file)
-
-        if "vars" not in json_data:
-            json_data["vars"] = {}
 
-        json_data["vars"] = {
-            **json_data["vars"],
-            **dataform_vars
-        }
+        Returns:
+            str: Hash of the resulting variables, see
+                dataform_helpers.dataform_vars.patch_dataform_vars
+        """
+        from dataform_helpers.dataform_vars import patch_dataform_vars
 
-        with open(dataform_json_path, 'w') as out_file:
-            json.dump(json_data, out_file, indent=4)
+        return patch_dataform_vars(dataform_json_path, dataform_vars)
 
 
 class GCSHelper:
@@ -127,7 +140,7 @@ class GCSHelper:
 
     @staticmethod
     def upload_local_dir_to_gcs(local_dir_path, destination_gcs_path):
-        """Upload the contents of a local directory to GCS
+        """Upload the contents of a local directory to GCS, in SNAPSHOT_FORMAT
 
         Note: The structure of the local directory is replicated on Cloud Storage.
 
@@ -135,15 +148,15 @@ class GCSHelper:
             local_dir_path (str): The path to the local directory.
             destination_gcs_path (str): The path to the GCS location.
         """
-        client = storage.Client()
-        local_dir_path = Path(local_dir_path)
-        for path_to_file in local_dir_path.glob("**/*"):
-            if path_to_file.is_file():
-                path_without_root = Path(*path_to_file.parts[1:])
-                destination_uri = f"{destination_gcs_path}/{path_without_root}"
-                destination_blob = storage.blob.Blob.from_string(destination_uri,
-                                                                 client=client)
-                destination_blob.upload_from_filename(path_to_file)
+        from dataform_helpers import snapshot
+
+        with metrics.stage("upload", snapshot_format=SNAPSHOT_FORMAT):
+            snapshot.save_snapshot(
+                local_dir_path,
+                destination_gcs_path,
+                snapshot_format=SNAPSHOT_FORMAT,
+                max_workers=GCS_TRANSFER_WORKERS
+            )
 
     @staticmethod
     def download_folder_from_gcs_and_return_base_path(
@@ -151,81 +164,269 @@ class GCSHelper:
         gcs_prefix: str,
         local_destination_path: Path
     ):
-        storage_client = storage.Client()
-        bucket = storage_client.get_bucket(bucket_or_name=gcs_bucket)
-        blobs = bucket.list_blobs(prefix=gcs_prefix)
-
-        base_path = Path(local_destination_path / Path(gcs_prefix))
-
-        LocalDiskHelper.remove_dir_if_exists(base_path)
-
-        for blob in blobs:
-            file_path = Path(local_destination_path / blob.name)
+        """Downloads the project saved under the GCS prefix, whatever its format
 
-            if len(file_path.parts) > 1:
-                base_path = Path(*file_path.parts[:-1])
-                base_path.mkdir(parents=True, exist_ok=True)
-
-            blob.download_to_filename(file_path)
-
-        return base_path
-
-
-@dag(
-    'dataform_audience_example',
-    default_args=default_args,
-    schedule_interval=None,
-    start_date=days_ago(2),
-    tags=['dataform_example']
-)
-def run_audience_example():
-
-    @task()
-    def upload_repo_to_gcs():
-        # TODO: Get variable from global variables
-        config = get_current_context()['dag_run'].conf
-        example_value = config.get("example_value", "default-value")
-        base_dataform_folder = LocalDiskHelper.clone_dataform_project(REPO_URL)
-        LocalDiskHelper.create_credentials_file(base_dataform_folder)
-
-        file_path = base_dataform_folder / "dataform.json"
-
-        dataform_vars = {
-            "exampleValue": example_value,
-            "author": AUTHOR,
-            "isAudienceEnabled": "true",
-        }
-
-        LocalDiskHelper.overwrite_dataform_vars(file_path, dataform_vars)
-        GCSHelper.upload_local_dir_to_gcs(base_dataform_folder, GCS_PATH)
-
-        return {
-            "bucket": GCS_BUCKET,
-            "path": AUTHOR
-        }
+        Args:
+            gcs_bucket (str): Bucket where the project is saved
+            gcs_prefix (str): Prefix where the project is saved
+            local_destination_path (Path): Local directory to download into
 
-    @task()
-    def download_and_execute(gcs_payload: dict):
-        gcs_bucket = gcs_payload["bucket"]
-        gcs_path = gcs_payload["path"]
+        Returns:
+            Path: Local path of the downloaded prefix
+        """
+        from dataform_helpers import snapshot
 
-        local_destination_path = Path.cwd() / "gcs_example"
-        final_base_path = GCSHelper.download_folder_from_gcs_and_return_base_path(
-            gcs_bucket=gcs_bucket,
-            gcs_prefix=gcs_path,
-            local_destination_path=local_destination_path
+        LocalDiskHelper.remove_dir_if_exists(
+            Path(local_destination_path / Path(gcs_prefix))
         )
 
-        run_dataform = BashOperator(
-            task_id="run_dataform",
-            bash_command=f'npm i -g @dataform/cli && pwd && cd {str(final_base_path)} && npm install && cat dataform.json && dataform run --tags orchestrator_audience'
+        with metrics.stage("download"):
+            return snapshot.load_snapshot(
+                gcs_bucket,
+                gcs_prefix,
+                local_destination_path,
+                max_workers=GCS_TRANSFER_WORKERS
+            )
+
+
+def prepare_dataform_project(
+    gcs_payload: dict,
+    local_destination_path: Path,
+    project_id: Optional[str] = None
+):
+    """Downloads the project uploaded by upload_repo_to_gcs and installs its
+    dependencies and the Dataform CLI
+
+    Args:
+        gcs_payload (dict): Bucket and path of the project
+        local_destination_path (Path): Local directory to download into
+        project_id (str): Project holding the npm cache
+
+    Returns:
+        Tuple[Path, str]: Path of the project and of the Dataform CLI
+    """
+    final_base_path = GCSHelper.download_folder_from_gcs_and_return_base_path(
+        gcs_bucket=gcs_payload["bucket"],
+        gcs_prefix=gcs_payload["path"],
+        local_destination_path=local_destination_path
+    )
+
+    from dataform_helpers import dataform_cli, dependency_cache
+
+    with metrics.stage("install_dependencies"):
+        dependency_cache.install_dependencies(
+            final_base_path,
+            gcs_cache_path=get_npm_cache_gcs_path(project_id)
         )
-        run_dataform.execute({})
-
-    payload = upload_repo_to_gcs()
-    result = download_and_execute(payload)
-
-    payload >> result
-
-
-dataform_example_dag = run_audience_example()
+        dataform = dataform_cli.resolve_dataform_cli()
+
+    return final_base_path, dataform
+
+
+def run_dataform_actions(
+    final_base_path: Path,
+    dataform: str,
+    graph: Optional[dict],
+    actions: Optional[List[str]] = None,
+    **labels: str
+):
+    """Runs the tagged actions of the project, or only the given ones, and
+    pushes the status and estimated duration of each action as the "dataform_actions" XCom
+
+    Args:
+        final_base_path (Path): Path of the Dataform project
+        dataform (str): Dataform CLI executable
+        graph (dict): Compiled graph of the project, giving the dependencies
+            from which the duration of each action is estimated. Only the
+            time at which each action finished is known when None
+        actions (List[str]): Actions to run. All the tagged ones if None
+        labels (str): Labels of the "dataform_run" stage
+    """
+    from dataform_helpers import dataform_runner, dataform_shards
+
+    with metrics.stage("dataform_run", **labels):
+        run_result = dataform_runner.run_dataform(
+            final_base_path,
+            dataform,
+            actions=actions,
+            tags=[DATAFORM_TAG],
+            dependencies=None if graph is None else dataform_shards.action_dependencies(graph)
+        )
+    get_current_context()['ti'].xcom_push(
+        key="dataform_actions",
+        value=[asdict(action) for action in run_result.actions]
+    )
+
+
+def push_metrics_summary():
+    """Logs the stages measured by the task and pushes them as its "metrics" XCom"""
+    metrics.write_summary()
+    get_current_context()['ti'].xcom_push(key="metrics", value=metrics.summary())
+
+
+def create_audience_example_dag(
+    author: str,
+    project_id: Optional[str] = None,
+    dag_id: str = 'dataform_audience_example',
+    shards: int = DATAFORM_SHARDS,
+    incremental: bool = INCREMENTAL_RUNS
+):
+    """Creates the DAG running the audience tags of the Dataform project for
+    the given author.
+
+    Used for the single DAG of this file and by dataform_author_dags.py,
+    which generates one DAG per author from the same helpers.
+
+    Args:
+        author (str): Author passed to the Dataform variables and GCS prefix
+        project_id (str): Project holding the credentials and the build bucket,
+            the default project of the worker if None
+        dag_id (str): ID of the DAG
+        shards (int): Number of tasks running the Dataform actions in parallel
+        incremental (bool): Whether to only run the actions affected by
+            the changes since the last successful run
+
+    Returns:
+        DAG: The DAG
+    """
+
+    @dag(
+        dag_id,
+        default_args=default_args,
+        schedule_interval=None,
+        start_date=days_ago(2),
+        tags=['dataform_example']
+    )
+    def run_audience_example():
+
+        @task()
+        def upload_repo_to_gcs():
+            # TODO: Get variable from global variables
+            config = get_current_context()['dag_run'].conf
+            example_value = config.get("example_value", "default-value")
+            base_dataform_folder = LocalDiskHelper.clone_dataform_project(REPO_URL, author)
+            LocalDiskHelper.create_credentials_file(base_dataform_folder, project_id)
+
+            file_path = base_dataform_folder / "dataform.json"
+
+            dataform_vars = {
+                "exampleValue": example_value,
+                "author": author,
+                "isAudienceEnabled": "true",
+            }
+
+            vars_hash = LocalDiskHelper.overwrite_dataform_vars(file_path, dataform_vars)
+
+            from dataform_helpers import change_detection, graph_cache
+
+            # Lets the following tasks reuse the compiled graph of the same commit and vars
+            graph_cache.write_build_info(base_dataform_folder, vars_hash)
+            if incremental and shards <= 1:
+                change_detection.record_changes(
+                    base_dataform_folder,
+                    change_detection.default_run_state_gcs_path(
+                        get_gcs_bucket(project_id), author
+                    )
+                )
+            GCSHelper.upload_local_dir_to_gcs(
+                base_dataform_folder, get_gcs_path(author, project_id)
+            )
+
+            push_metrics_summary()
+            return {
+                "bucket": get_gcs_bucket(project_id),
+                "path": author
+            }
+
+        @task()
+        def download_and_execute(gcs_payload: dict):
+            final_base_path, dataform = prepare_dataform_project(
+                gcs_payload, Path.cwd() / "gcs_example", project_id
+            )
+
+            from dataform_helpers import change_detection, dataform_shards, graph_cache
+
+            build_info = graph_cache.read_build_info(final_base_path)
+            changed_files = (build_info or {}).get("changed_files")
+            select_actions = incremental and changed_files is not None
+
+            # `dataform run` compiles the project again, so the graph is only
+            # compiled here to select the actions
+            load_graph = (
+                graph_cache.load_compiled_graph if select_actions
+                else graph_cache.find_cached_graph
+            )
+            graph = load_graph(final_base_path, get_graph_cache_gcs_path(project_id), dataform)
+            actions = None
+            if select_actions:
+                actions = dataform_shards.affected_actions(
+                    graph, changed_files, tags=[DATAFORM_TAG]
+                )
+
+            # Nothing to run when none of the changes affect the tagged actions
+            if actions is None or actions:
+                run_dataform_actions(final_base_path, dataform, graph, actions, author=author)
+
+            if incremental and build_info:
+                change_detection.record_successful_run(
+                    change_detection.default_run_state_gcs_path(gcs_payload["bucket"], author),
+                    build_info
+                )
+            push_metrics_summary()
+
+        @task()
+        def plan_dataform_shards(gcs_payload: dict):
+            final_base_path, dataform = prepare_dataform_project(
+                gcs_payload, Path.cwd() / "gcs_example", project_id
+            )
+
+            from dataform_helpers import dataform_shards
+
+            with metrics.stage("plan_shards", author=author):
+                shard_plan = dataform_shards.plan_shards(
+                    final_base_path,
+                    shards,
+                    tags=[DATAFORM_TAG],
+                    dataform=dataform,
+                    graph_cache_gcs_path=get_graph_cache_gcs_path(project_id)
+                )
+            push_metrics_summary()
+            return shard_plan
+
+        @task()
+        def run_dataform_shard(gcs_payload: dict, shard_plan: list, shard_index: int):
+            # The number of tasks is fixed when the DAG is parsed, while the
+            # plan may have fewer shards than that
+            if shard_index >= len(shard_plan):
+                raise AirflowSkipException(f"No actions in shard {shard_index}")
+
+            final_base_path, dataform = prepare_dataform_project(
+                gcs_payload, Path.cwd() / "gcs_example" / f"shard-{shard_index}", project_id
+            )
+
+            from dataform_helpers import graph_cache
+
+            # Compiled and cached by plan_dataform_shards
+            graph = graph_cache.find_cached_graph(
+                final_base_path, get_graph_cache_gcs_path(project_id), dataform
+            )
+            run_dataform_actions(
+                final_base_path, dataform, graph, shard_plan[shard_index],
+                author=author, shard=str(shard_index)
+            )
+            push_metrics_summary()
+
+        payload = upload_repo_to_gcs()
+
+        if shards <= 1:
+            result = download_and_execute(payload)
+            payload >> result
+        else:
+            shard_plan = plan_dataform_shards(payload)
+            for shard_index in range(shards):
+                shard_plan >> run_dataform_shard(payload, shard_plan, shard_index)
+
+    return run_audience_example()
+
+
+dataform_example_dag = create_audience_example_dag(AUTHOR)
@@ -0,0 +1,66 @@
+"""
+Generates the Dataform DAGs of every author from a single table, instead of
+one copied DAG file per author.
+
+The table is read once per parse, from dataform_authors.yaml next to this
+file or, when the file does not exist, from the "dataform_authors" Airflow
+Variable (JSON). Each entry looks like:
+
+    - author: alexb
+      project_id: my-project        # optional, the default project otherwise
+      examples: [basic, audience]   # optional, all the examples otherwise
+      shards: 4                     # optional, parallel tasks of the audience DAG
+      incremental: true             # optional, only run the changed audience actions
+
+All the DAGs share the helpers, the lazily created clients and the caches
+of the example modules, which are only imported once.
+"""
+
+from pathlib import Path
+from typing import List
+
+import yaml
+from airflow.models import Variable
+
+from dataform_audience_example_solution import create_audience_example_dag
+from dataform_simple_example import create_basic_example_dag
+
+
+AUTHORS_FILE = Path(__file__).resolve().parent / "dataform_authors.yaml"
+AUTHORS_VARIABLE = "dataform_authors"
+
+# Entries of the table only supported by the audience DAG
+AUDIENCE_OPTIONS = ("shards", "incremental")
+
+DAG_FACTORIES = {
+    "basic": create_basic_example_dag,
+    "audience": create_audience_example_dag,
+}
+
+
+def load_authors() -> List[dict]:
+    """Reads the author table
+
+    Returns:
+        List[dict]: One entry per author
+    """
+    if AUTHORS_FILE.exists():
+        with open(AUTHORS_FILE) as authors_file:
+            return yaml.safe_load(authors_file) or []
+
+    return Variable.get(AUTHORS_VARIABLE, default_var=[], deserialize_json=True)
+
+
+for entry in load_authors():
+    for example in entry.get("examples", list(DAG_FACTORIES)):
+        dag_id = f"dataform_{example}_example_{entry['author']}"
+        options = {
+            key: entry[key] for key in AUDIENCE_OPTIONS
+            if example == "audience" and key in entry
+        }
+        globals()[dag_id] = DAG_FACTORIES[example](
+            entry["author"],
+            project_id=entry.get("project_id"),
+            dag_id=dag_id,
+            **options
+        )
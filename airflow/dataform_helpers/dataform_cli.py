@@ -0,0 +1,83 @@
+"""
+Contains helpers to locate a Dataform CLI of the pinned version, so that
+tasks reuse an installed binary instead of running npm on every execution.
+"""
+
+import fcntl
+import logging
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from .dataform_runner import DEFAULT_NPM_TIMEOUT_SECONDS, run_command
+
+# Keep in sync with DATAFORM_CLI_VERSION in the run-dataform component image
+DATAFORM_CLI_VERSION = "1.21.1"
+
+DEFAULT_INSTALL_PREFIX = Path(tempfile.gettempdir()) / "dataform-cli"
+
+
+def installed_version(executable: str) -> Optional[str]:
+    """Returns the version reported by a Dataform CLI executable
+
+    Args:
+        executable (str): Path of the executable
+
+    Returns:
+        Optional[str]: The version, or None if the executable cannot run
+    """
+    try:
+        result = subprocess.run(
+            [executable, "--version"],
+            check=True, capture_output=True, text=True, timeout=60
+        )
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip()
+
+
+@lru_cache(maxsize=None)
+def resolve_dataform_cli(
+    version: str = DATAFORM_CLI_VERSION,
+    install_prefix: Path = DEFAULT_INSTALL_PREFIX
+) -> str:
+    """Returns the path of a Dataform CLI of the requested version.
+
+    A CLI already on the PATH (e.g. baked into the worker image) or
+    installed by a previous task of this worker is reused; npm only runs
+    when neither matches the version. The result is cached per process.
+
+    Args:
+        version (str): Required version of @dataform/cli
+        install_prefix (Path): Where versions missing from the worker are installed
+
+    Returns:
+        str: Path of the executable
+    """
+    version_prefix = Path(install_prefix) / version
+    local_executable = version_prefix / "bin" / "dataform"
+    candidates = [shutil.which("dataform"), str(local_executable)]
+
+    for candidate in candidates:
+        if candidate and installed_version(candidate) == version:
+            logging.info("Using Dataform CLI %s at %s", version, candidate)
+            return candidate
+
+    version_prefix.mkdir(parents=True, exist_ok=True)
+    with open(version_prefix / ".install.lock", "w") as lock_file:
+        # Another task of the worker may be installing the same version
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if installed_version(str(local_executable)) != version:
+            logging.info("Installing Dataform CLI %s into %s", version, version_prefix)
+            run_command(
+                [
+                    "npm", "install", "--global", "--prefix", str(version_prefix),
+                    f"@dataform/cli@{version}"
+                ],
+                timeout=DEFAULT_NPM_TIMEOUT_SECONDS
+            )
+
+    return str(local_executable)
@@ -0,0 +1,176 @@
+"""
+Contains helpers to split the actions of a Dataform project into shards
+that can run in parallel, on separate workers.
+
+Actions connected by a dependency, in either direction, always end up in
+the same shard, so that shards never wait on each other: each one runs its
+actions with `dataform run --actions ...`, which keeps the order among them.
+"""
+
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from .graph_cache import load_compiled_graph
+
+ACTION_TYPES = ("tables", "operations", "assertions")
+
+# Changes to these files may affect every action
+GLOBAL_FILES = ("dataform.json", "package.json", "package-lock.json")
+GLOBAL_DIRS = ("includes/",)
+
+
+def _target_name(target: dict) -> str:
+    return ".".join(
+        target[key] for key in ("database", "schema", "name") if target.get(key)
+    )
+
+
+def action_dependencies(
+    graph: dict,
+    tags: Optional[Sequence[str]] = None
+) -> Dict[str, List[str]]:
+    """Lists the enabled actions of the compiled graph with their dependencies
+
+    Args:
+        graph (dict): The compiled graph
+        tags (Sequence[str]): Only keeps the actions with one of these tags,
+            like `dataform run --tags`. All the actions are kept if None
+
+    Returns:
+        Dict[str, List[str]]: Dependencies of each action, in graph order.
+            Dependencies on actions that are not kept are dropped
+    """
+    # dependencyTargets reference targets, which are mapped to action names
+    names = {}
+    for action_type in ACTION_TYPES:
+        for action in graph.get(action_type, []):
+            if "target" in action:
+                target_name = _target_name(action["target"])
+                names[target_name] = action.get("name") or target_name
+
+    dependencies = {}
+    for action_type in ACTION_TYPES:
+        for action in graph.get(action_type, []):
+            if action.get("disabled"):
+                continue
+            if tags and not set(tags) & set(action.get("tags", [])):
+                continue
+
+            name = action.get("name") or _target_name(action["target"])
+            if "dependencyTargets" in action:
+                target_names = map(_target_name, action["dependencyTargets"])
+                dependencies[name] = [names.get(target, target) for target in target_names]
+            else:
+                dependencies[name] = list(action.get("dependencies", []))
+
+    return {
+        name: [dependency for dependency in action_deps if dependency in dependencies]
+        for name, action_deps in dependencies.items()
+    }
+
+
+def affected_actions(
+    graph: dict,
+    changed_files: Sequence[str],
+    tags: Optional[Sequence[str]] = None
+) -> Optional[List[str]]:
+    """Lists the actions defined in the changed files and all their dependents
+
+    Args:
+        graph (dict): The compiled graph
+        changed_files (Sequence[str]): Changed paths, relative to the project
+        tags (Sequence[str]): Only keeps the actions with one of these tags
+
+    Returns:
+        Optional[List[str]]: The affected actions in graph order, None if
+            a change (e.g. to dataform.json or includes/) affects all of them
+    """
+    if any(
+        path in GLOBAL_FILES or path.startswith(GLOBAL_DIRS) for path in changed_files
+    ):
+        return None
+
+    dependencies = action_dependencies(graph, tags)
+    dependents: Dict[str, List[str]] = {name: [] for name in dependencies}
+    for name, action_deps in dependencies.items():
+        for dependency in action_deps:
+            dependents[dependency].append(name)
+
+    changed = set(changed_files)
+    pending = [
+        action.get("name") or _target_name(action["target"])
+        for action_type in ACTION_TYPES
+        for action in graph.get(action_type, [])
+        if action.get("fileName") in changed
+    ]
+    affected = set()
+    while pending:
+        name = pending.pop()
+        if name in dependents and name not in affected:
+            affected.add(name)
+            pending.extend(dependents[name])
+
+    return [name for name in dependencies if name in affected]
+
+
+def partition_actions(
+    dependencies: Dict[str, List[str]],
+    shards: int
+) -> List[List[str]]:
+    """Splits the actions into at most `shards` independent groups
+
+    The connected components of the dependency graph are assigned, largest
+    first, to the shard with the fewest actions.
+
+    Args:
+        dependencies (Dict[str, List[str]]): Output of action_dependencies
+        shards (int): Maximum number of groups
+
+    Returns:
+        List[List[str]]: Non-empty groups of actions, each in graph order
+    """
+    parents = {name: name for name in dependencies}
+
+    def find(name: str) -> str:
+        while parents[name] != name:
+            parents[name] = parents[parents[name]]
+            name = parents[name]
+        return name
+
+    for name, action_deps in dependencies.items():
+        for dependency in action_deps:
+            parents[find(dependency)] = find(name)
+
+    components: Dict[str, List[str]] = {}
+    for name in dependencies:
+        components.setdefault(find(name), []).append(name)
+
+    groups: List[List[str]] = [[] for _ in range(max(shards, 1))]
+    for component in sorted(components.values(), key=len, reverse=True):
+        min(groups, key=len).extend(component)
+
+    order = {name: index for index, name in enumerate(dependencies)}
+    return [sorted(group, key=order.get) for group in groups if group]
+
+
+def plan_shards(
+    project_dir: Path,
+    shards: int,
+    tags: Optional[Sequence[str]] = None,
+    dataform: str = "dataform",
+    graph_cache_gcs_path: Optional[str] = None
+) -> List[List[str]]:
+    """Compiles the Dataform project and splits its actions into shards
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        shards (int): Maximum number of shards
+        tags (Sequence[str]): Only plans the actions with one of these tags
+        dataform (str): Dataform CLI executable
+        graph_cache_gcs_path (str): gs:// prefix caching the compiled graphs
+
+    Returns:
+        List[List[str]]: Actions of each shard
+    """
+    graph = load_compiled_graph(project_dir, graph_cache_gcs_path, dataform)
+    return partition_actions(action_dependencies(graph, tags), shards)
@@ -0,0 +1,189 @@
+"""
+Contains helpers to restore the npm dependencies of a Dataform project
+from a cache instead of installing them on every run.
+
+Entries are node_modules tarballs keyed on the hash of package.json,
+package-lock.json and the Node.js version. They are looked up in a local
+directory first, then in an optional GCS prefix, and built with npm and
+published to both when missing. Least recently used entries are evicted.
+"""
+
+import hashlib
+import logging
+import os
+import subprocess
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+from google.api_core import exceptions
+
+from .dataform_runner import DEFAULT_NPM_TIMEOUT_SECONDS, run_command
+from .gcs_transfer import get_storage_client, split_gcs_path
+
+DEFAULT_CACHE_DIR = Path(tempfile.gettempdir()) / "dataform-npm-cache"
+DEFAULT_MAX_ENTRIES = 10
+
+DEPENDENCY_FILES = ("package.json", "package-lock.json")
+
+
+def dependency_cache_key(project_dir: Path) -> str:
+    """Hashes everything that determines the content of node_modules
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+
+    Returns:
+        str: The cache key
+    """
+    digest = hashlib.sha256()
+    for file_name in DEPENDENCY_FILES:
+        file_path = Path(project_dir) / file_name
+        digest.update(file_name.encode("utf-8"))
+        if file_path.exists():
+            digest.update(file_path.read_bytes())
+
+    node_version = subprocess.run(
+        ["node", "--version"], check=True, capture_output=True, text=True
+    ).stdout.strip()
+    digest.update(node_version.encode("utf-8"))
+
+    return digest.hexdigest()[:32]
+
+
+def _install_with_npm(project_dir: Path):
+    has_lock_file = (Path(project_dir) / "package-lock.json").exists()
+    command = ["npm", "ci"] if has_lock_file else ["npm", "install"]
+    run_command(command, cwd=project_dir, timeout=DEFAULT_NPM_TIMEOUT_SECONDS)
+
+
+def _pack_node_modules(project_dir: Path, tarball_path: Path):
+    """Writes node_modules into the tarball, atomically"""
+    tarball_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(f"{tarball_path}.{os.getpid()}.tmp")
+    with tarfile.open(str(tmp_path), "w:gz", compresslevel=1) as tar:
+        tar.add(str(Path(project_dir) / "node_modules"), arcname="node_modules")
+    os.replace(tmp_path, tarball_path)
+
+
+def _unpack_node_modules(tarball_path: Path, project_dir: Path):
+    with tarfile.open(str(tarball_path), "r:gz") as tar:
+        tar.extractall(path=str(project_dir))
+    # Marks the entry as recently used for the eviction
+    os.utime(tarball_path)
+
+
+def _download_entry(gcs_cache_path: str, key: str, tarball_path: Path) -> bool:
+    bucket_name, prefix = split_gcs_path(gcs_cache_path)
+    blob = get_storage_client().bucket(bucket_name).blob(f"{prefix}/{key}.tar.gz")
+    tarball_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = Path(f"{tarball_path}.{os.getpid()}.tmp")
+    try:
+        blob.download_to_filename(str(tmp_path))
+    except exceptions.NotFound:
+        tmp_path.unlink(missing_ok=True)
+        return False
+
+    os.replace(tmp_path, tarball_path)
+    # customTime records the last use, for evict_gcs_entries and
+    # for lifecycle rules based on daysSinceCustomTime
+    blob.custom_time = datetime.now(timezone.utc)
+    blob.patch()
+    return True
+
+
+def _upload_entry(gcs_cache_path: str, key: str, tarball_path: Path):
+    bucket_name, prefix = split_gcs_path(gcs_cache_path)
+    blob = get_storage_client().bucket(bucket_name).blob(f"{prefix}/{key}.tar.gz")
+    blob.custom_time = datetime.now(timezone.utc)
+    blob.upload_from_filename(str(tarball_path))
+
+
+def evict_local_entries(cache_dir: Path, max_entries: int = DEFAULT_MAX_ENTRIES):
+    """Keeps only the max_entries most recently used tarballs of the cache
+
+    Args:
+        cache_dir (Path): Local cache directory
+        max_entries (int): Number of entries to keep
+    """
+    entries = sorted(
+        Path(cache_dir).glob("*.tar.gz"),
+        key=lambda path: path.stat().st_mtime,
+        reverse=True
+    )
+    for entry in entries[max_entries:]:
+        logging.info("Evicting npm cache entry %s", entry)
+        entry.unlink()
+
+
+def evict_gcs_entries(gcs_cache_path: str, max_entries: int = DEFAULT_MAX_ENTRIES):
+    """Keeps only the max_entries most recently used tarballs on GCS
+
+    Args:
+        gcs_cache_path (str): gs:// prefix of the cache
+        max_entries (int): Number of entries to keep
+    """
+    bucket_name, prefix = split_gcs_path(gcs_cache_path)
+    client = get_storage_client()
+    blobs = [
+        blob for blob in client.list_blobs(bucket_name, prefix=f"{prefix}/")
+        if blob.name.endswith(".tar.gz")
+    ]
+    blobs.sort(key=lambda blob: blob.custom_time or blob.time_created, reverse=True)
+    for blob in blobs[max_entries:]:
+        logging.info("Evicting npm cache entry gs://%s/%s", bucket_name, blob.name)
+        blob.delete()
+
+
+def install_dependencies(
+    project_dir: Path,
+    cache_dir: Path = DEFAULT_CACHE_DIR,
+    gcs_cache_path: Optional[str] = None,
+    max_entries: int = DEFAULT_MAX_ENTRIES
+) -> str:
+    """Provides node_modules for the Dataform project, from the cache when
+    possible, otherwise by running npm and caching the result
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        cache_dir (Path): Local cache directory
+        gcs_cache_path (str): Optional gs:// prefix shared between workers
+        max_entries (int): Number of entries kept in each cache
+
+    Returns:
+        str: The cache key of the dependencies
+    """
+    project_dir = Path(project_dir)
+    cache_dir = Path(cache_dir)
+    start = time.monotonic()
+
+    key = dependency_cache_key(project_dir)
+    tarball_path = cache_dir / f"{key}.tar.gz"
+
+    if tarball_path.exists():
+        source = "local cache"
+    elif gcs_cache_path and _download_entry(gcs_cache_path, key, tarball_path):
+        source = "GCS cache"
+    else:
+        source = None
+
+    if source:
+        _unpack_node_modules(tarball_path, project_dir)
+    else:
+        source = "npm"
+        _install_with_npm(project_dir)
+        _pack_node_modules(project_dir, tarball_path)
+        if gcs_cache_path:
+            _upload_entry(gcs_cache_path, key, tarball_path)
+            evict_gcs_entries(gcs_cache_path, max_entries)
+
+    evict_local_entries(cache_dir, max_entries)
+
+    logging.info(
+        "Installed npm dependencies %s from %s in %.2fs",
+        key, source, time.monotonic() - start
+    )
+    return key
@@ -0,0 +1,261 @@
+"""
+Contains helpers to clone a Dataform repository, optionally through a
+persistent bare mirror so that repeated clones only fetch new objects.
+
+The mirror lives on local disk and can be seeded from a git bundle on
+GCS, for workers whose local disk does not survive between runs.
+"""
+
+import fcntl
+import hashlib
+import logging
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from git import Git, Repo
+from google.api_core import exceptions
+from google.cloud import storage
+
+from .gcs_transfer import get_storage_client
+
+DEFAULT_CACHE_DIR = Path(tempfile.gettempdir()) / "dataform-git-cache"
+
+_COMMIT_SHA = re.compile(r"^[0-9a-f]{40}$")
+
+
+@dataclass
+class CloneOptions:
+    """How a repository is cloned.
+
+    Attributes:
+        ref (str): Branch, tag or commit to check out. Defaults to the remote HEAD
+        cache_dir (Path): Directory holding the bare mirrors. No cache when None
+        bundle_gcs_path (str): gs:// path of a bundle used to seed the mirror
+            when it is missing locally, and refreshed when the mirror changes
+        depth (int): History depth, only used when cloning without a cache
+        blob_filter (str): Partial clone filter (e.g. "blob:none"),
+            only used when cloning without a cache
+    """
+
+    ref: Optional[str] = None
+    cache_dir: Optional[Path] = None
+    bundle_gcs_path: Optional[str] = None
+    depth: Optional[int] = None
+    blob_filter: Optional[str] = None
+
+
+def _strip_credentials(repo_url: str) -> str:
+    parts = urlsplit(repo_url)
+    return urlunsplit(parts._replace(netloc=parts.hostname or ""))
+
+
+def mirror_path_for(repo_url: str, cache_dir: Path) -> Path:
+    """Returns the location of the mirror of a repository in the cache.
+
+    The key ignores the credentials embedded in the URL, so rotating an
+    access token keeps using the same mirror.
+
+    Args:
+        repo_url (str): URL of the repository
+        cache_dir (Path): Directory holding the bare mirrors
+
+    Returns:
+        Path: Path of the bare mirror
+    """
+    key = hashlib.sha1(_strip_credentials(repo_url).encode("utf-8")).hexdigest()
+    return Path(cache_dir) / f"{key[:16]}.git"
+
+
+@contextmanager
+def _locked(mirror_path: Path):
+    """Serializes access to a mirror between processes of the same worker"""
+    mirror_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(f"{mirror_path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def restore_mirror_from_bundle(bundle_gcs_path: str, mirror_path: Path) -> bool:
+    """Seeds a missing mirror from a git bundle stored on GCS
+
+    Args:
+        bundle_gcs_path (str): gs:// path of the bundle
+        mirror_path (Path): Path of the bare mirror to create
+
+    Returns:
+        bool: Whether the bundle existed and was restored
+    """
+    blob = storage.Blob.from_string(bundle_gcs_path, client=get_storage_client())
+    with tempfile.NamedTemporaryFile(suffix=".bundle") as bundle_file:
+        try:
+            blob.download_to_filename(bundle_file.name)
+        except exceptions.NotFound:
+            logging.info("No git bundle found at %s", bundle_gcs_path)
+            return False
+
+        Repo.clone_from(bundle_file.name, str(mirror_path), mirror=True)
+
+    logging.info("Restored git mirror from %s", bundle_gcs_path)
+    return True
+
+
+def publish_mirror_bundle(mirror_path: Path, bundle_gcs_path: str):
+    """Writes all the refs of a mirror into a git bundle on GCS
+
+    Args:
+        mirror_path (Path): Path of the bare mirror
+        bundle_gcs_path (str): gs:// path of the bundle
+    """
+    blob = storage.Blob.from_string(bundle_gcs_path, client=get_storage_client())
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bundle_path = Path(tmp_dir) / "mirror.bundle"
+        Repo(str(mirror_path)).git.bundle("create", str(bundle_path), "--all")
+        blob.upload_from_filename(str(bundle_path))
+
+    logging.info("Published git mirror to %s", bundle_gcs_path)
+
+
+def is_commit_sha(ref: Optional[str]) -> bool:
+    return bool(ref and _COMMIT_SHA.match(ref))
+
+
+def resolve_commit(repo_url: str, ref: Optional[str] = None) -> str:
+    """Returns the commit a branch, tag or the remote HEAD points to,
+    without cloning the repository
+
+    Args:
+        repo_url (str): URL of the repository
+        ref (str): Branch, tag or commit. Defaults to the remote HEAD
+
+    Returns:
+        str: Full SHA of the commit
+
+    Raises:
+        ValueError: If the remote has no such ref
+    """
+    if is_commit_sha(ref):
+        return ref
+    ref = ref or "HEAD"
+    # Annotated tags point to a tag object, the commit is on their peeled line
+    output = Git().ls_remote(repo_url, ref, f"{ref}^{{}}")
+    commits = dict(
+        reversed(line.split("\t", 1)) for line in output.splitlines() if "\t" in line
+    )
+    for name in (ref, f"refs/heads/{ref}", f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}"):
+        if name in commits:
+            logging.info("Resolved %s to commit %s", ref, commits[name])
+            return commits[name]
+    raise ValueError(f"No ref {ref} in {_strip_credentials(repo_url)}")
+
+
+def update_mirror(repo_url: str, mirror_path: Path) -> bool:
+    """Creates the bare mirror, or fetches only the new objects into it
+
+    Args:
+        repo_url (str): URL of the repository
+        mirror_path (Path): Path of the bare mirror
+
+    Returns:
+        bool: Whether any ref of the mirror changed
+    """
+    if not (mirror_path / "HEAD").exists():
+        Repo.clone_from(repo_url, str(mirror_path), mirror=True)
+        return True
+
+    repo = Repo(str(mirror_path))
+    repo.git.remote("set-url", "origin", repo_url)
+    refs_before = repo.git.for_each_ref()
+    repo.git.fetch("origin", "--prune")
+    return repo.git.for_each_ref() != refs_before
+
+
+def clone_repository(
+    repo_url: str,
+    destination_dir: Path,
+    options: Optional[CloneOptions] = None
+) -> Path:
+    """Clones a repository into destination_dir, which must not exist
+
+    With a cache, the ref is checked out as a detached worktree of the
+    cached bare mirror, after fetching the objects created since the last
+    run. Without one, a regular clone is made, shallow and / or partial
+    if requested.
+
+    Args:
+        repo_url (str): URL of the repository
+        destination_dir (Path): Where the repository is checked out
+        options (CloneOptions): How the repository is cloned
+
+    Returns:
+        Path: destination_dir
+    """
+    options = options or CloneOptions()
+    destination_dir = Path(destination_dir)
+    destination_dir.parent.mkdir(parents=True, exist_ok=True)
+    start = time.monotonic()
+
+    if options.cache_dir is None and options.bundle_gcs_path is None:
+        if is_commit_sha(options.ref):
+            # git clone --branch does not accept commits, the commit is fetched alone
+            repo = Repo.init(str(destination_dir))
+            repo.create_remote("origin", repo_url)
+            fetch_args = []
+            if options.depth:
+                fetch_args.append(f"--depth={options.depth}")
+            if options.blob_filter:
+                fetch_args.append(f"--filter={options.blob_filter}")
+            repo.git.fetch(*fetch_args, "origin", options.ref)
+            repo.git.checkout("--detach", "FETCH_HEAD")
+            logging.info("Fetched commit %s in %.2fs", options.ref, time.monotonic() - start)
+            return destination_dir
+
+        clone_kwargs = {}
+        if options.ref:
+            clone_kwargs["branch"] = options.ref
+        if options.depth:
+            clone_kwargs["depth"] = options.depth
+        if options.blob_filter:
+            clone_kwargs["filter"] = options.blob_filter
+        Repo.clone_from(repo_url, str(destination_dir), **clone_kwargs)
+        logging.info("Cloned repository in %.2fs", time.monotonic() - start)
+        return destination_dir
+
+    mirror_path = mirror_path_for(repo_url, options.cache_dir or DEFAULT_CACHE_DIR)
+    with _locked(mirror_path):
+        bundle_exists = False
+        if options.bundle_gcs_path:
+            if (mirror_path / "HEAD").exists():
+                bundle_exists = storage.Blob.from_string(
+                    options.bundle_gcs_path, client=get_storage_client()
+                ).exists()
+            else:
+                bundle_exists = restore_mirror_from_bundle(
+                    options.bundle_gcs_path, mirror_path
+                )
+
+        changed = update_mirror(repo_url, mirror_path)
+        if options.bundle_gcs_path and (changed or not bundle_exists):
+            publish_mirror_bundle(mirror_path, options.bundle_gcs_path)
+
+        mirror = Repo(str(mirror_path))
+        mirror.git.worktree("prune")
+        # git runs inside the mirror, so relative paths must be resolved first
+        mirror.git.worktree(
+            "add", "--detach", "--force",
+            str(destination_dir.absolute()), options.ref or "HEAD"
+        )
+
+    logging.info(
+        "Checked out %s from git mirror %s in %.2fs",
+        options.ref or "HEAD", mirror_path, time.monotonic() - start
+    )
+    return destination_dir
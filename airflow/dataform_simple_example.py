@@ -1,14 +1,16 @@
 import json
 from pathlib import Path
 import shutil
+import tempfile
+from typing import Optional
 
-from git import Repo
 from airflow.decorators import dag, task
 from airflow.utils.dates import days_ago
 from airflow.operators.bash import BashOperator
 from airflow.operators.python import get_current_context
-from google.cloud import secretmanager, storage
-import google.auth
+
+from dataform_helpers import metrics
+from dataform_helpers.gcp_project import get_project_id
 
 
 default_args = {
@@ -21,71 +23,55 @@ REPO_URL: str = "ADD_REPO_URL_HERE"
 # Secret Manager Credentials name
 CREDENTIALS_SECRET_NAME = "dataform_credentials"
 
+# Clones go through a bare mirror on the worker's local disk, so that only
+# new objects are fetched on each run. Use {"depth": 1} instead for a plain
+# shallow clone. See dataform_helpers.git_cache.CloneOptions
+GIT_CLONE_OPTIONS = {"cache_dir": Path(tempfile.gettempdir()) / "dataform-git-cache"}
+
 # AUTHOR: To be modified
 AUTHOR = 'alexb'
 
-# Automatically get the project ID
-_, PROJECT_ID = google.auth.default()
-
-
-class SecretManagerHelper:
-    # pylint: disable=too-few-public-methods
-    """Wrapper around Google Secret Manager."""
-
-    project_id: str
-    client: secretmanager.SecretManagerServiceClient
-
-    def __init__(self, project_id: str):
-        """Sets project and instantiates Secret Manager client"""
-        self.project_id = project_id
-        self.client = secretmanager.SecretManagerServiceClient()
-
-    def get_secret(self, secret_name: str) -> str:
-        """Using the secret name, fetches the secret value
-
-        Args:
-            secret_name (str): The name of the secret as defined in
-                Google Secret Manager
-
-        Returns:
-            str: The value stored in the secret
-        """
-        name = (
-            f"projects/{self.project_id}/secrets/{secret_name}/versions/latest"
-        )
 
-        response = self.client.access_secret_version(request={"name": name})
-        return response.payload.data.decode("UTF-8")
+def get_npm_cache_gcs_path(project_id: Optional[str] = None) -> str:
+    """node_modules tarballs keyed on the package-lock hash, shared between workers"""
+    return f"gs://{project_id or get_project_id()}-dataform-build/npm-cache"
 
 
 class LocalDiskHelper:
     @staticmethod
-    def clone_dataform_project(repo_url: str):
-        """Loads dataform project from Github into a local folder
+    def clone_dataform_project(repo_url: str, author: str = AUTHOR):
+        """Loads dataform project from Github into a local folder, through
+        the git mirror cache of the worker (see GIT_CLONE_OPTIONS)
 
         Args:
             repo_url (str): Github https path to repository
+            author (str): Author of the DAG, each author gets its own folder
 
         Returns:
             destination_dir (Path): Path to where the project will be saved.
         """
-        destination_dir = Path(Path.cwd() / "dataform_example")
+        destination_dir = Path(Path.cwd() / "dataform_example" / author)
         LocalDiskHelper.remove_dir_if_exists(destination_dir)
 
-        destination_dir.mkdir(parents=True, exist_ok=True)
-        Repo.clone_from(repo_url, str(destination_dir))
+        from dataform_helpers import git_cache
 
-        return destination_dir
+        with metrics.stage("clone", author=author):
+            return git_cache.clone_repository(
+                repo_url, destination_dir, git_cache.CloneOptions(**GIT_CLONE_OPTIONS)
+            )
 
     @staticmethod
-    def create_credentials_file(base_path: Path):
+    def create_credentials_file(base_path: Path, project_id: Optional[str] = None):
         """Using the credentials in the secret manager,
         creates the required credentials file for Dataform.
 
         Args:
             base_path (Path): Base path where to save the credentials
+            project_id (str): Project of the secret, the default one if None
         """
-        secret_manager_helper = SecretManagerHelper(PROJECT_ID)
+        from dataform_helpers.secret_helper import SecretManagerHelper
+
+        secret_manager_helper = SecretManagerHelper(project_id or get_project_id())
         credentials = json.loads(
             secret_manager_helper.get_secret(CREDENTIALS_SECRET_NAME)
         )
@@ -105,64 +91,98 @@ class LocalDiskHelper:
             shutil.rmtree(directory)
 
     @staticmethod
-    def overwrite_dataform_vars(dataform_json_path: str, dataform_vars: dict):
+    def overwrite_dataform_vars(dataform_json_path: str, dataform_vars: dict) -> str:
         """Overwrites dataform variables in the given dataform_json_path
 
         Args:
             dataform_json_path (str): Path pointing towards dataform.json file
             dataform_vars (dict): Variables to add / change in dataform.json
+
+        Returns:
+            str: Hash of the resulting variables, see
+                dataform_helpers.dataform_vars.patch_dataform_vars
         """
-        with open(dataform_json_path) as json_file:
-            json_data = json.load(json_file)
-
-        if "vars" not in json_data:
-            json_data["vars"] = {}
-
-        json_data["vars"] = {
-            **json_data["vars"],
-            **dataform_vars
-        }
-
-        with open(dataform_json_path, 'w') as out_file:
-            json.dump(json_data, out_file, indent=4)
-
-
-@dag(
-    'dataform_simple_example',
-    default_args=default_args,
-    schedule_interval=None,
-    tags=['dataform_example'],
-    start_date=days_ago(2),
-)
-def run_basic_example():
-
-    @task()
-    def edit_dataform_file():
-        config = get_current_context()['dag_run'].conf
-        example_value = config.get("example_value", "default-value")
-        base_dataform_folder = LocalDiskHelper.clone_dataform_project(REPO_URL)
-        LocalDiskHelper.create_credentials_file(base_dataform_folder)
-        file_path = base_dataform_folder / "dataform.json"
-
-        dataform_vars = {
-            "exampleValue": example_value,
-            "author": AUTHOR
-        }
-
-        LocalDiskHelper.overwrite_dataform_vars(file_path, dataform_vars)
-
-        return str(base_dataform_folder)
-
-    dataform_folder = edit_dataform_file()
-    run_dataform = BashOperator(
-        task_id="run_dataform",
-        bash_command=(
-            f'npm i -g @dataform/cli && cd {dataform_folder} && '
-            'npm install && cat dataform.json && dataform run'
-        )
+        from dataform_helpers.dataform_vars import patch_dataform_vars
+
+        return patch_dataform_vars(dataform_json_path, dataform_vars)
+
+
+def create_basic_example_dag(
+    author: str,
+    project_id: Optional[str] = None,
+    dag_id: str = 'dataform_simple_example'
+):
+    """Creates the DAG running the Dataform project for the given author.
+
+    Used for the single DAG of this file and by dataform_author_dags.py,
+    which generates one DAG per author from the same helpers.
+
+    Args:
+        author (str): Author passed to the Dataform variables
+        project_id (str): Project holding the credentials and the npm cache,
+            the default project of the worker if None
+        dag_id (str): ID of the DAG
+
+    Returns:
+        DAG: The DAG
+    """
+
+    @dag(
+        dag_id,
+        default_args=default_args,
+        schedule_interval=None,
+        tags=['dataform_example'],
+        start_date=days_ago(2),
     )
+    def run_basic_example():
+
+        @task()
+        def edit_dataform_file():
+            config = get_current_context()['dag_run'].conf
+            example_value = config.get("example_value", "default-value")
+            base_dataform_folder = LocalDiskHelper.clone_dataform_project(REPO_URL, author)
+            LocalDiskHelper.create_credentials_file(base_dataform_folder, project_id)
+            file_path = base_dataform_folder / "dataform.json"
+
+            dataform_vars = {
+                "exampleValue": example_value,
+                "author": author
+            }
+
+            LocalDiskHelper.overwrite_dataform_vars(file_path, dataform_vars)
+
+            from dataform_helpers import dataform_cli, dependency_cache
+
+            with metrics.stage("install_dependencies", author=author):
+                dependency_cache.install_dependencies(
+                    base_dataform_folder,
+                    gcs_cache_path=get_npm_cache_gcs_path(project_id)
+                )
+
+                # Resolved on the worker, only installed if the pinned version is missing
+                get_current_context()['ti'].xcom_push(
+                    key="dataform_cli",
+                    value=dataform_cli.resolve_dataform_cli()
+                )
+
+            # Logs the stages of the task and pushes them as its "metrics" XCom
+            metrics.write_summary()
+            get_current_context()['ti'].xcom_push(key="metrics", value=metrics.summary())
+
+            return str(base_dataform_folder)
+
+        dataform_folder = edit_dataform_file()
+        run_dataform = BashOperator(
+            task_id="run_dataform",
+            bash_command=(
+                f'cd {dataform_folder} && cat dataform.json && '
+                "{{ ti.xcom_pull(task_ids='edit_dataform_file', key='dataform_cli') }} run"
+            )
+        )
+
+        dataform_folder >> run_dataform
 
-    dataform_folder >> run_dataform
+    return run_basic_example()
 
 
-dataform_example_dag = run_basic_example()
+dataform_example_dag = create_basic_example_dag(AUTHOR)
@@ -0,0 +1,83 @@
+"""
+Measures how long the DAG files of this folder take to import, as the
+scheduler does on every parsing loop.
+
+Each file is imported in a fresh interpreter where airflow has already
+been imported, so that only the cost of the DAG file itself is measured.
+Exits with an error when a file exceeds the target, e.g. because a heavy
+import or a call to google.auth / Secret Manager was added at module level.
+
+Usage:
+    python measure_dag_parse_time.py [--target-seconds 0.5] [--repeat 3]
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+DAG_FOLDER = Path(__file__).resolve().parent
+
+DEFAULT_TARGET_SECONDS = 0.5
+
+_TIMING_SCRIPT = """
+import importlib.util, sys, time
+import airflow.decorators, airflow.operators.bash, airflow.operators.python
+sys.path.insert(0, sys.argv[2])
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location("dag_module", sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+print(time.perf_counter() - start)
+"""
+
+
+def measure_parse_time(dag_file: Path, repeat: int) -> float:
+    """Returns the best import time of the DAG file over repeat fresh imports
+
+    Args:
+        dag_file (Path): Path of the DAG file
+        repeat (int): Number of imports
+
+    Returns:
+        float: Import time in seconds
+    """
+    timings = []
+    for _ in range(repeat):
+        result = subprocess.run(
+            [sys.executable, "-c", _TIMING_SCRIPT, str(dag_file), str(DAG_FOLDER)],
+            check=True, capture_output=True, text=True
+        )
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--target-seconds",
+        help="Maximum import time of a DAG file",
+        type=float,
+        default=DEFAULT_TARGET_SECONDS
+    )
+
+    parser.add_argument(
+        "--repeat",
+        help="Number of imports per DAG file, the best one is reported",
+        type=int,
+        default=3
+    )
+
+    args = parser.parse_args()
+
+    slow_files = []
+    for dag_file in sorted(DAG_FOLDER.glob("dataform_*.py")):
+        seconds = measure_parse_time(dag_file, args.repeat)
+        print(f"{dag_file.name}: {seconds:.3f}s")
+        if seconds > args.target_seconds:
+            slow_files.append(dag_file.name)
+
+    if slow_files:
+        sys.exit(
+            f"Over the {args.target_seconds}s target: {', '.join(slow_files)}"
+        )
@@ -0,0 +1,435 @@
+"""
+In-process stand-in for the Cloud Storage JSON API, serving the subset used
+by the transfer helpers: listing, metadata, media downloads (with ranges),
+multipart and resumable uploads, and deletes, with generation preconditions.
+
+Objects are kept in memory. Every request can be delayed by a fixed latency,
+to approximate the round trip to GCS, and fail with a 503 at a given rate,
+to exercise the retries.
+
+Usage:
+    with FakeGCSServer(latency_seconds=0.01) as server:
+        os.environ["STORAGE_EMULATOR_HOST"] = server.url
+"""
+
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Maximum number of objects per listing page, like GCS
+LIST_PAGE_SIZE = 1000
+
+_OBJECT_PATH = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)$")
+_LIST_PATH = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)/o$")
+_DOWNLOAD_PATH = re.compile(r"^/download/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)$")
+_UPLOAD_PATH = re.compile(r"^/upload/storage/v1/b/(?P<bucket>[^/]+)/o$")
+_RANGE = re.compile(r"^bytes=(?P<start>\d+)-(?P<end>\d*)$")
+_CONTENT_RANGE = re.compile(r"^bytes (?:(?P<start>\d+)-(?P<end>\d+)|\*)/(?P<total>\d+|\*)$")
+
+
+@dataclass
+class FakeObject:
+    """An object stored by the fake server."""
+
+    data: bytes
+    content_type: str
+    generation: int
+    created: str = field(
+        default_factory=lambda: datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    )
+    md5_hash: str = field(init=False)
+
+    def __post_init__(self):
+        # Computed once, listings describe every object of the page
+        self.md5_hash = base64.b64encode(hashlib.md5(self.data).digest()).decode("utf-8")
+
+    def resource(self, bucket: str, name: str) -> dict:
+        """Returns the JSON resource of the object"""
+        return {
+            "kind": "storage#object",
+            "id": f"{bucket}/{name}/{self.generation}",
+            "bucket": bucket,
+            "name": name,
+            "size": str(len(self.data)),
+            "md5Hash": self.md5_hash,
+            "contentType": self.content_type,
+            "generation": str(self.generation),
+            "metageneration": "1",
+            "timeCreated": self.created,
+            "updated": self.created,
+        }
+
+
+@dataclass
+class _ResumableUpload:
+    bucket: str
+    name: str
+    content_type: str
+    if_generation_match: Optional[int]
+    data: bytearray = field(default_factory=bytearray)
+
+
+class FakeGCSServer:
+    """Threaded HTTP server holding the buckets in memory
+
+    Args:
+        latency_seconds (float): Delay added to every request
+        error_rate (float): Share of the requests answered with a 503
+        seed (int): Seed of the error injection
+    """
+
+    def __init__(
+        self,
+        latency_seconds: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0
+    ):
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.objects: Dict[str, Dict[str, FakeObject]] = {}
+        self.uploads: Dict[str, _ResumableUpload] = {}
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self._next_generation = 1
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeGCSServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "FakeGCSServer":
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def clear(self):
+        """Removes every object and pending upload"""
+        with self.lock:
+            self.objects.clear()
+            self.uploads.clear()
+
+    def object_names(self, bucket: str) -> List[str]:
+        with self.lock:
+            return sorted(self.objects.get(bucket, {}))
+
+    def put(
+        self,
+        bucket: str,
+        name: str,
+        data: bytes,
+        content_type: str = "application/octet-stream",
+        if_generation_match: Optional[int] = None
+    ) -> Optional[FakeObject]:
+        """Stores an object. Returns None when the precondition fails"""
+        with self.lock:
+            bucket_objects = self.objects.setdefault(bucket, {})
+            if not _generation_matches(bucket_objects.get(name), if_generation_match):
+                return None
+            fake_object = FakeObject(bytes(data), content_type, self._next_generation)
+            self._next_generation += 1
+            bucket_objects[name] = fake_object
+            return fake_object
+
+    def get(self, bucket: str, name: str) -> Optional[FakeObject]:
+        with self.lock:
+            return self.objects.get(bucket, {}).get(name)
+
+    def delete(
+        self,
+        bucket: str,
+        name: str,
+        if_generation_match: Optional[int] = None
+    ) -> HTTPStatus:
+        with self.lock:
+            bucket_objects = self.objects.get(bucket, {})
+            if name not in bucket_objects:
+                return HTTPStatus.NOT_FOUND
+            if not _generation_matches(bucket_objects[name], if_generation_match):
+                return HTTPStatus.PRECONDITION_FAILED
+            del bucket_objects[name]
+            return HTTPStatus.NO_CONTENT
+
+    def list(self, bucket: str, prefix: str, page_token: str, max_results: int) -> dict:
+        with self.lock:
+            names = sorted(
+                name for name in self.objects.get(bucket, {}) if name.startswith(prefix)
+            )
+            names = [name for name in names if name > page_token]
+            page = names[:max_results]
+            listing = {
+                "kind": "storage#objects",
+                "items": [
+                    self.objects[bucket][name].resource(bucket, name) for name in page
+                ],
+            }
+        if len(names) > max_results:
+            listing["nextPageToken"] = page[-1]
+        return listing
+
+
+def _generation_matches(fake_object: Optional[FakeObject], expected: Optional[int]) -> bool:
+    if expected is None:
+        return True
+    return (fake_object.generation if fake_object else 0) == expected
+
+
+def _optional_int(query: dict, key: str) -> Optional[int]:
+    return int(query[key][0]) if key in query else None
+
+
+def _parse_multipart(content_type: str, body: bytes):
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    parts = [
+        part for part in body.split(b"--" + boundary)
+        if part not in (b"", b"--", b"--\r\n", b"\r\n")
+    ]
+    metadata_part, media_part = parts[0], parts[1]
+    metadata = json.loads(metadata_part.split(b"\r\n\r\n", 1)[1])
+    media_headers, media = media_part.split(b"\r\n\r\n", 1)
+    media_type = re.search(rb"content-type:\s*(\S+)", media_headers, re.IGNORECASE)
+    # The media is followed by the CRLF preceding the closing boundary
+    return metadata, media[:-2], media_type.group(1).decode() if media_type else None
+
+
+def _make_handler(server: FakeGCSServer):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def _read_body(self) -> bytes:
+            length = int(self.headers.get("Content-Length", 0))
+            return self.rfile.read(length) if length else b""
+
+        def _send(self, status: int, body: bytes = b"", headers: Optional[dict] = None):
+            self.send_response(status)
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body and self.command != "HEAD":
+                self.wfile.write(body)
+
+        def _send_json(self, status: int, payload: dict, headers: Optional[dict] = None):
+            self._send(
+                status,
+                json.dumps(payload).encode("utf-8"),
+                {"Content-Type": "application/json", **(headers or {})}
+            )
+
+        def _send_error(self, status: int):
+            self._send_json(status, {"error": {"code": status, "message": status.phrase}})
+
+        def _handle(self, dispatch):
+            body = self._read_body()
+            with server.lock:
+                server.request_count += 1
+                fail = server.error_rate and server.random.random() < server.error_rate
+            if server.latency_seconds:
+                time.sleep(server.latency_seconds)
+            if fail:
+                self._send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+
+            url = urlsplit(self.path)
+            dispatch(url.path, parse_qs(url.query), body)
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self._handle(self._get)
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            self._handle(self._post)
+
+        def do_PUT(self):  # pylint: disable=invalid-name
+            self._handle(self._put)
+
+        def do_DELETE(self):  # pylint: disable=invalid-name
+            self._handle(self._delete)
+
+        def _get(self, path: str, query: dict, _):
+            match = _DOWNLOAD_PATH.match(path)
+            if match or query.get("alt") == ["media"]:
+                match = match or _OBJECT_PATH.match(path)
+                self._download(match["bucket"], unquote(match["name"]))
+                return
+
+            match = _OBJECT_PATH.match(path)
+            if match:
+                fake_object = server.get(match["bucket"], unquote(match["name"]))
+                if fake_object is None:
+                    self._send_error(HTTPStatus.NOT_FOUND)
+                else:
+                    self._send_json(
+                        HTTPStatus.OK,
+                        fake_object.resource(match["bucket"], unquote(match["name"]))
+                    )
+                return
+
+            match = _LIST_PATH.match(path)
+            if match:
+                self._send_json(HTTPStatus.OK, server.list(
+                    match["bucket"],
+                    query.get("prefix", [""])[0],
+                    query.get("pageToken", [""])[0],
+                    min(int(query.get("maxResults", [LIST_PAGE_SIZE])[0]), LIST_PAGE_SIZE)
+                ))
+                return
+
+            self._send_error(HTTPStatus.NOT_FOUND)
+
+        def _download(self, bucket: str, name: str):
+            fake_object = server.get(bucket, name)
+            if fake_object is None:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            headers = {
+                "Content-Type": fake_object.content_type,
+                "x-goog-generation": str(fake_object.generation),
+                "x-goog-hash": f"md5={fake_object.md5_hash}",
+                "x-goog-stored-content-length": str(len(fake_object.data)),
+            }
+            range_match = _RANGE.match(self.headers.get("Range", ""))
+            if not range_match:
+                self._send(HTTPStatus.OK, fake_object.data, headers)
+                return
+
+            total = len(fake_object.data)
+            start = int(range_match["start"])
+            end = min(int(range_match["end"] or total - 1), total - 1)
+            if start >= total:
+                self._send(
+                    HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, b"",
+                    {"Content-Range": f"bytes */{total}"}
+                )
+                return
+            headers["Content-Range"] = f"bytes {start}-{end}/{total}"
+            self._send(HTTPStatus.PARTIAL_CONTENT, fake_object.data[start:end + 1], headers)
+
+        def _post(self, path: str, query: dict, body: bytes):
+            match = _UPLOAD_PATH.match(path)
+            if not match:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            bucket = match["bucket"]
+            if_generation_match = _optional_int(query, "ifGenerationMatch")
+            upload_type = query.get("uploadType", [""])[0]
+
+            if upload_type == "multipart":
+                metadata, media, media_type = _parse_multipart(
+                    self.headers["Content-Type"], body
+                )
+                self._store(
+                    bucket, metadata["name"], media,
+                    metadata.get("contentType") or media_type, if_generation_match
+                )
+            elif upload_type == "resumable":
+                metadata = json.loads(body) if body else {}
+                name = metadata.get("name") or query["name"][0]
+                upload_id = uuid.uuid4().hex
+                with server.lock:
+                    server.uploads[upload_id] = _ResumableUpload(
+                        bucket, name,
+                        metadata.get("contentType")
+                        or self.headers.get("X-Upload-Content-Type", "application/octet-stream"),
+                        if_generation_match
+                    )
+                location = (
+                    f"{server.url}/upload/storage/v1/b/{bucket}/o"
+                    f"?uploadType=resumable&upload_id={upload_id}"
+                )
+                self._send(HTTPStatus.OK, b"", {"Location": location})
+            elif upload_type == "media":
+                self._store(
+                    bucket, query["name"][0], body,
+                    self.headers.get("Content-Type", "application/octet-stream"),
+                    if_generation_match
+                )
+            else:
+                self._send_error(HTTPStatus.BAD_REQUEST)
+
+        def _put(self, path: str, query: dict, body: bytes):
+            upload = server.uploads.get(query.get("upload_id", [""])[0])
+            if not _UPLOAD_PATH.match(path) or upload is None:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            content_range = _CONTENT_RANGE.match(self.headers.get("Content-Range", ""))
+            if content_range is None:
+                self._send_error(HTTPStatus.BAD_REQUEST)
+                return
+            if content_range["start"] is not None:
+                start = int(content_range["start"])
+                upload.data[start:start + len(body)] = body
+
+            if content_range["total"] != "*" and len(upload.data) >= int(content_range["total"]):
+                with server.lock:
+                    server.uploads.pop(query["upload_id"][0], None)
+                self._store(
+                    upload.bucket, upload.name, bytes(upload.data),
+                    upload.content_type, upload.if_generation_match
+                )
+                return
+
+            headers = {"Range": f"bytes=0-{len(upload.data) - 1}"} if upload.data else {}
+            self._send(HTTPStatus.PERMANENT_REDIRECT, b"", headers)
+
+        def _store(
+            self,
+            bucket: str,
+            name: str,
+            data: bytes,
+            content_type: str,
+            if_generation_match: Optional[int]
+        ):
+            fake_object = server.put(bucket, name, data, content_type, if_generation_match)
+            if fake_object is None:
+                self._send_error(HTTPStatus.PRECONDITION_FAILED)
+            else:
+                self._send_json(HTTPStatus.OK, fake_object.resource(bucket, name))
+
+        def _delete(self, path: str, query: dict, _):
+            match = _OBJECT_PATH.match(path)
+            if not match:
+                self._send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            status = server.delete(
+                match["bucket"], unquote(match["name"]),
+                _optional_int(query, "ifGenerationMatch")
+            )
+            if status == HTTPStatus.NO_CONTENT:
+                self._send(status)
+            else:
+                self._send_error(status)
+
+    return Handler
+
@@ -0,0 +1,214 @@
+"""
+Benchmarks the size and cold start of the component images, since pulling
+and starting them is a real fraction of each pipeline step on fresh nodes.
+
+For each image, reports its uncompressed size and number of layers, the
+time to pull it once removed from the local Docker cache (with --cold),
+and the time to start a container up to the parsed arguments of main.py,
+i.e. the interpreter start-up and the imports of the component.
+
+With --baseline, exits with an error when the size or the median pull or
+start time of an image exceeds the baseline by more than --max-regression.
+
+Usage:
+    python benchmarks/image_benchmark.py --project <gcp-project> [--tag latest]
+        [--cold] [--repeat 5] [--output results.json] [--baseline previous.json]
+    python benchmarks/image_benchmark.py --images <image> [<image> ...]
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from run_benchmarks import DEFAULT_MAX_REGRESSION, _format_seconds, describe
+
+DEFAULT_REPEAT = 5
+
+# Keep in sync with the IMAGE_NAME of build_image.sh of each component
+COMPONENT_IMAGES = (
+    "load-dataform-gcs",
+    "run-dataform-example",
+    "clone-and-run-dataform",
+)
+
+# Measured fields compared with the baseline
+COMPARED_FIELDS = ("size_bytes", "pull_seconds", "start_seconds")
+
+
+def docker(*args: str, check: bool = True) -> str:
+    """Runs a Docker command and returns its output"""
+    result = subprocess.run(
+        ["docker", *args], check=check, capture_output=True, text=True
+    )
+    return result.stdout.strip()
+
+
+def timed_docker(*args: str) -> float:
+    """Runs a Docker command and returns its duration"""
+    start = time.monotonic()
+    docker(*args)
+    return time.monotonic() - start
+
+
+def component_images(project: str, tag: str) -> List[str]:
+    return [
+        f"eu.gcr.io/{project}/kfp/dataform-basic-example/components/{name}:{tag}"
+        for name in COMPONENT_IMAGES
+    ]
+
+
+def measure_image(image: str, repeat: int, cold: bool) -> dict:
+    """Measures the size, pull time and start time of an image
+
+    Args:
+        image (str): Reference of the image
+        repeat (int): Number of pulls and starts measured
+        cold (bool): Whether to remove the image before each pull. Layers
+            shared with other local images stay cached
+
+    Returns:
+        dict: The measurements, with the percentiles of the durations
+    """
+    pull_seconds = []
+    for _ in range(repeat if cold else 1):
+        if cold:
+            docker("image", "rm", "--force", image, check=False)
+        pull_seconds.append(timed_docker("pull", "--quiet", image))
+
+    start_seconds = [
+        timed_docker("run", "--rm", image, "--help") for _ in range(repeat)
+    ]
+
+    inspected = json.loads(docker("image", "inspect", image))[0]
+    return {
+        "image": image,
+        "size_bytes": inspected["Size"],
+        "layers": len(inspected["RootFS"]["Layers"]),
+        # Only a cold pull measures the download of the layers
+        "pull_seconds": describe(pull_seconds) if cold else None,
+        "start_seconds": describe(start_seconds),
+    }
+
+
+def format_result(result: dict) -> str:
+    line = (
+        f"{result['image']:<80} {result['size_bytes'] / 2 ** 20:8.1f} MiB"
+        f" {result['layers']:3} layers"
+    )
+    if result["pull_seconds"]:
+        line += f"  pull p50 {_format_seconds(result['pull_seconds']['p50']):>9}"
+    line += f"  start p50 {_format_seconds(result['start_seconds']['p50']):>9}"
+    return line
+
+
+def _compared_value(result: dict, field: str) -> Optional[float]:
+    value = result.get(field)
+    return value["p50"] if isinstance(value, dict) else value
+
+
+def find_regressions(
+    results: List[dict],
+    baseline: List[dict],
+    max_regression: float
+) -> List[str]:
+    """Compares the sizes and median durations of the images found in both runs
+
+    Args:
+        results (List[dict]): Results of this run
+        baseline (List[dict]): Results of the reference run
+        max_regression (float): Tolerated increase, e.g. 0.2 for 20%
+
+    Returns:
+        List[str]: Description of each measurement above the tolerance
+    """
+    baseline_by_image: Dict[str, dict] = {result["image"]: result for result in baseline}
+    regressions = []
+    for result in results:
+        reference = baseline_by_image.get(result["image"])
+        if reference is None:
+            continue
+        for field in COMPARED_FIELDS:
+            current = _compared_value(result, field)
+            previous = _compared_value(reference, field)
+            if current and previous and current > previous * (1 + max_regression):
+                regressions.append(f"{result['image']} {field}: {previous} -> {current}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--project",
+        help="GCP project whose component images are measured",
+        type=str
+    )
+
+    parser.add_argument(
+        "--tag",
+        help="Tag of the component images",
+        type=str,
+        default="latest"
+    )
+
+    parser.add_argument(
+        "--images",
+        help="Images to measure instead of the component images",
+        type=str,
+        nargs="+"
+    )
+
+    parser.add_argument(
+        "--cold",
+        help="Removes each image from the local cache before pulling it",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--repeat",
+        help="Repetitions of each pull (with --cold) and start",
+        type=int,
+        default=DEFAULT_REPEAT
+    )
+
+    parser.add_argument(
+        "--output",
+        help="JSON file receiving the results",
+        type=Path
+    )
+
+    parser.add_argument(
+        "--baseline",
+        help="Results of a previous run to compare with",
+        type=Path
+    )
+
+    parser.add_argument(
+        "--max-regression",
+        help="Tolerated increase of the size and median durations compared to the baseline",
+        type=float,
+        default=DEFAULT_MAX_REGRESSION
+    )
+
+    args = parser.parse_args()
+    if not args.images and not args.project:
+        parser.error("--project or --images is required")
+
+    results = []
+    for image in args.images or component_images(args.project, args.tag):
+        results.append(measure_image(image, args.repeat, args.cold))
+        print(format_result(results[-1]))
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=4))
+
+    if args.baseline:
+        regressions = find_regressions(
+            results, json.loads(args.baseline.read_text()), args.max_regression
+        )
+        if regressions:
+            sys.exit("Above the baseline:\n" + "\n".join(regressions))
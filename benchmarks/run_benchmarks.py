@@ -0,0 +1,501 @@
+"""
+Benchmarks the GCS transfers, the Dataform vars patcher and the Dataform API
+polling against local stand-ins, so that regressions are caught before rollout.
+
+The transfers (save_snapshot / load_snapshot, behind upload_local_dir_to_gcs
+and download_folder_from_gcs_and_return_base_path of the DAGs) run against
+fake_gcs_server over synthetic Dataform projects of 100, 10k and 100k files.
+DataformAPIHelper of the Cloud Function polls stub_dataform_server, with the
+run durations and polling delays scaled down by --time-scale.
+
+Each case is repeated and reported with its throughput and the percentiles
+of its durations and of the latency of its HTTP requests. With --baseline,
+exits with an error when the median duration of a case exceeds the baseline
+by more than --max-regression.
+
+The helpers are imported from airflow/dataform_helpers, whose modules are
+byte-identical to the copies of the components, and from cloud_functions.
+The stand-ins do not check credentials: google.auth.default returns
+anonymous credentials.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--sizes 100,10000,100000] [--repeat 5]
+        [--latency-ms 10] [--output results.json] [--baseline previous.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+from fake_gcs_server import FakeGCSServer
+from stub_dataform_server import StubDataformServer
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+BENCHMARK_PROJECT = "benchmark"
+BENCHMARK_BUCKET = "benchmark"
+
+DEFAULT_SIZES = (100, 10_000, 100_000)
+DEFAULT_REPEAT = 5
+DEFAULT_LATENCY_MS = 10.0
+DEFAULT_TIME_SCALE = 0.01
+DEFAULT_MAX_REGRESSION = 0.2
+
+# Files per directory and size bounds of the synthetic SQLX files
+FILES_PER_DIR = 100
+FILE_SIZE_RANGE = (512, 4096)
+
+# Iterations of each vars patching case
+PATCH_ITERATIONS = 200
+
+# Real-time bounds of the stub Dataform run durations, before --time-scale
+RUN_SECONDS_RANGE = (30.0, 120.0)
+CONCURRENT_RUNS = 10
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Returns the percentile of the values, interpolated between the closest ranks
+
+    Args:
+        values (List[float]): The values
+        percent (float): Percentile, between 0 and 100
+
+    Returns:
+        float: The percentile, 0.0 if there are no values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def describe(values: List[float]) -> Dict[str, float]:
+    described = {f"p{percent}": percentile(values, percent) for percent in PERCENTILES}
+    described["min"] = min(values, default=0.0)
+    described["max"] = max(values, default=0.0)
+    return described
+
+
+class RequestRecorder:
+    """Records the latency of the HTTP requests made through a requests session"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+
+    def attach(self, session):
+        session.hooks["response"].append(self._record)
+
+    def _record(self, response, *_, **__):
+        self.latencies.append(response.elapsed.total_seconds())
+
+    def reset(self):
+        self.latencies = []
+
+
+def create_project(project_dir: Path, files: int, seed: int = 0):
+    """Writes a synthetic Dataform project, SQLX files spread in directories
+
+    Args:
+        project_dir (Path): Directory of the project, created if needed
+        files (int): Number of files, including dataform.json and package.json
+        seed (int): Seed of the file sizes and contents
+    """
+    generator = random.Random(seed)
+    project_dir.mkdir(parents=True, exist_ok=True)
+    (project_dir / "dataform.json").write_text(json.dumps({
+        "warehouse": "bigquery",
+        "defaultSchema": "dataform",
+        "vars": {"env": "benchmark"},
+    }, indent=4))
+    (project_dir / "package.json").write_text(json.dumps({
+        "dependencies": {"@dataform/core": "1.21.1"}
+    }, indent=4))
+
+    for index in range(files - 2):
+        action_dir = project_dir / "definitions" / f"group_{index // FILES_PER_DIR:04d}"
+        if index % FILES_PER_DIR == 0:
+            action_dir.mkdir(parents=True, exist_ok=True)
+        header = f'config {{ type: "table", tags: ["group_{index // FILES_PER_DIR}"] }}\n'
+        body = f"SELECT {index} AS id, '{generator.getrandbits(64):x}' AS value\n"
+        size = generator.randint(*FILE_SIZE_RANGE)
+        padding = "-- " + "x" * max(size - len(header) - len(body) - 4, 0) + "\n"
+        (action_dir / f"action_{index:06d}.sqlx").write_text(header + body + padding)
+
+
+def use_anonymous_credentials():
+    """Makes google.auth.default return anonymous credentials, accepted by the stand-ins"""
+    def anonymous_default(*_, **__):
+        return AnonymousCredentials(), BENCHMARK_PROJECT
+
+    google.auth.default = anonymous_default
+
+
+class Benchmarks:
+    """Runs the cases against the stand-ins and collects their results
+
+    Args:
+        work_dir (Path): Directory of the synthetic projects and downloads
+        gcs_server (FakeGCSServer): Started fake GCS server
+        repeat (int): Repetitions of each case
+    """
+
+    def __init__(self, work_dir: Path, gcs_server: FakeGCSServer, repeat: int):
+        self.work_dir = work_dir
+        self.gcs_server = gcs_server
+        self.repeat = repeat
+        self.results: List[dict] = []
+
+        # pylint: disable=import-outside-toplevel
+        from dataform_helpers import gcs_transfer
+
+        self.recorder = RequestRecorder()
+        # pylint: disable=protected-access
+        self.recorder.attach(gcs_transfer.get_storage_client()._http)
+
+    def measure(
+        self,
+        case: str,
+        run: Callable[[], None],
+        before: Optional[Callable[[], None]] = None,
+        repeat: Optional[int] = None,
+        files: int = 0,
+        size_bytes: int = 0
+    ) -> dict:
+        """Times repetitions of run, calling before (untimed) ahead of each
+
+        Args:
+            case (str): Name of the case
+            run (Callable): Measured operation
+            before (Callable): Preparation of each repetition
+            repeat (int): Repetitions, defaults to --repeat
+            files (int): Files handled by each repetition, for the throughput
+            size_bytes (int): Bytes handled by each repetition, for the throughput
+
+        Returns:
+            dict: The result of the case
+        """
+        durations = []
+        self.recorder.reset()
+        for _ in range(repeat or self.repeat):
+            if before:
+                before()
+            start = time.perf_counter()
+            run()
+            durations.append(time.perf_counter() - start)
+
+        seconds = describe(durations)
+        result = {
+            "case": case,
+            "files": files,
+            "repeat": len(durations),
+            "seconds": seconds,
+            "requests": len(self.recorder.latencies) // len(durations),
+            "request_seconds": describe(self.recorder.latencies),
+        }
+        if files and seconds["p50"]:
+            result["files_per_second"] = files / seconds["p50"]
+            result["mib_per_second"] = size_bytes / seconds["p50"] / 1024 / 1024
+        self.results.append(result)
+        print(format_result(result), flush=True)
+        return result
+
+    def transfers(self, files: int):
+        """Uploads, re-syncs and downloads a project of the given size in every format"""
+        # pylint: disable=import-outside-toplevel
+        from dataform_helpers import snapshot
+
+        project_dir = self.work_dir / "projects" / str(files)
+        if not project_dir.exists():
+            create_project(project_dir, files)
+        size_bytes = sum(
+            path.stat().st_size for path in project_dir.rglob("*") if path.is_file()
+        )
+        download_dir = self.work_dir / "downloads"
+
+        def remove_download_dir():
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+        for snapshot_format in snapshot.SNAPSHOT_FORMATS:
+            prefix = f"{snapshot_format}-{files}"
+            destination = f"gs://{BENCHMARK_BUCKET}/{prefix}"
+
+            self.measure(
+                f"upload[{snapshot_format}]",
+                lambda: snapshot.save_snapshot(project_dir, destination, snapshot_format),
+                before=self.gcs_server.clear,
+                files=files, size_bytes=size_bytes
+            )
+            if snapshot_format == snapshot.FILES_FORMAT:
+                self.measure(
+                    "sync_unchanged[files]",
+                    lambda: snapshot.save_snapshot(project_dir, destination, snapshot_format),
+                    files=files, size_bytes=size_bytes
+                )
+            self.measure(
+                f"download[{snapshot_format}]",
+                lambda: snapshot.load_snapshot(BENCHMARK_BUCKET, prefix, download_dir),
+                before=remove_download_dir,
+                files=files, size_bytes=size_bytes
+            )
+        self.gcs_server.clear()
+        remove_download_dir()
+
+    def patch_vars(self):
+        """Patches dataform.json with changed and with identical variables"""
+        # pylint: disable=import-outside-toplevel
+        from dataform_helpers.dataform_vars import patch_dataform_vars
+
+        project_dir = self.work_dir / "projects" / "vars"
+        create_project(project_dir, 2)
+        dataform_json_path = project_dir / "dataform.json"
+        values = iter(range(sys.maxsize))
+
+        self.measure(
+            "patch_vars[changed]",
+            lambda: patch_dataform_vars(dataform_json_path, {"run": str(next(values))}),
+            repeat=PATCH_ITERATIONS
+        )
+        self.measure(
+            "patch_vars[unchanged]",
+            lambda: patch_dataform_vars(dataform_json_path, {"env": "benchmark"}),
+            repeat=PATCH_ITERATIONS
+        )
+
+    def dataform_api(self, time_scale: float, latency_seconds: float):
+        """Triggers stub runs and waits for them with DataformAPIHelper
+
+        Besides the durations, reports the lag between the end of the runs
+        and their detection, and the number of polls per run, both at the
+        real timescale. The request latency is not scaled, so it weighs more
+        in the lag than it does in production.
+        """
+        run_seconds = tuple(seconds * time_scale for seconds in RUN_SECONDS_RANGE)
+        with StubDataformServer(run_seconds, latency_seconds=latency_seconds) as server:
+            helper = create_api_helper(server.url, time_scale)
+            self.recorder.attach(helper.session)
+
+            cases = (("execute_run", 1), (f"wait_for_runs[{CONCURRENT_RUNS}]", CONCURRENT_RUNS))
+            for case, runs in cases:
+                lags = []
+
+                def run_and_wait():
+                    if runs == 1:
+                        run_ids = [helper.execute_run()["id"]]
+                    else:
+                        run_ids = [helper.trigger_run() for _ in range(runs)]
+                        helper.wait_for_runs(run_ids)
+                    detected_at = time.monotonic()
+                    lags.append(
+                        detected_at - max(server.runs[run_id].finishes_at for run_id in run_ids)
+                    )
+
+                server.runs.clear()
+                result = self.measure(case, run_and_wait)
+                polls = [run.polls for run in server.runs.values()]
+                result["time_scale"] = time_scale
+                result["lag_seconds"] = describe([lag / time_scale for lag in lags])
+                result["polls_per_run"] = sum(polls) / len(polls)
+                print(
+                    f"    lag p50 {result['lag_seconds']['p50']:.1f}s "
+                    f"p99 {result['lag_seconds']['p99']:.1f}s, "
+                    f"{result['polls_per_run']:.1f} polls per run (real timescale)"
+                )
+
+
+def create_api_helper(base_url: str, time_scale: float):
+    """Returns a DataformAPIHelper of the Cloud Function calling the stub server,
+    with its polling delays scaled like the stub run durations
+
+    Args:
+        base_url (str): URL of the stub server
+        time_scale (float): Ratio between the benchmark time and the real time
+
+    Returns:
+        DataformAPIHelper: The helper
+    """
+    # pylint: disable=import-outside-toplevel
+    import main
+
+    class BenchmarkDataformAPIHelper(main.DataformAPIHelper):
+        POLL_INITIAL_SECONDS = main.DataformAPIHelper.POLL_INITIAL_SECONDS * time_scale
+        POLL_MAX_SECONDS = main.DataformAPIHelper.POLL_MAX_SECONDS * time_scale
+        POLL_TIMEOUT_SECONDS = main.DataformAPIHelper.POLL_TIMEOUT_SECONDS * time_scale
+
+        def __init__(self):  # pylint: disable=super-init-not-called
+            # The stub accepts any key, Secret Manager is not called
+            self.api_key = BENCHMARK_PROJECT
+            self.headers = {"Authorization": f"Bearer {self.api_key}"}
+            self.base_url = f"{base_url}/v1/project/{main.DATAFORM_PROJECT_ID}/run"
+            self.session = main.HTTP_SESSION
+
+    return BenchmarkDataformAPIHelper()
+
+
+def _format_seconds(seconds: float) -> str:
+    return f"{seconds:.3f}s" if seconds >= 0.1 else f"{seconds * 1000:.2f}ms"
+
+
+def format_result(result: dict) -> str:
+    seconds = result["seconds"]
+    files = f"{result['files']:>7} files" if result["files"] else " " * 13
+    line = f"{result['case']:<28} {files}  " + "  ".join(
+        f"p{percent} {_format_seconds(seconds[f'p{percent}']):>9}" for percent in PERCENTILES
+    )
+    if "files_per_second" in result:
+        line += (
+            f"  {result['files_per_second']:9.0f} files/s"
+            f"  {result['mib_per_second']:7.2f} MiB/s"
+        )
+    if result["requests"]:
+        request_seconds = result["request_seconds"]
+        line += (
+            f"  {result['requests']} requests, p50 {_format_seconds(request_seconds['p50'])}"
+            f" p99 {_format_seconds(request_seconds['p99'])}"
+        )
+    return line
+
+
+def find_regressions(
+    results: List[dict],
+    baseline: List[dict],
+    max_regression: float
+) -> List[str]:
+    """Compares the median durations of the cases found in both runs
+
+    Args:
+        results (List[dict]): Results of this run
+        baseline (List[dict]): Results of the reference run
+        max_regression (float): Tolerated slowdown, e.g. 0.2 for 20%
+
+    Returns:
+        List[str]: Description of each case slower than tolerated
+    """
+    baseline_seconds = {
+        (result["case"], result["files"]): result["seconds"]["p50"] for result in baseline
+    }
+    regressions = []
+    for result in results:
+        reference = baseline_seconds.get((result["case"], result["files"]))
+        current = result["seconds"]["p50"]
+        if reference and current > reference * (1 + max_regression):
+            files = f" ({result['files']} files)" if result["files"] else ""
+            regressions.append(
+                f"{result['case']}{files}: "
+                f"{_format_seconds(reference)} -> {_format_seconds(current)}"
+            )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--sizes",
+        help="Comma-separated numbers of files of the synthetic projects",
+        default=",".join(str(size) for size in DEFAULT_SIZES)
+    )
+
+    parser.add_argument(
+        "--repeat",
+        help="Repetitions of each transfer and Dataform API case",
+        type=int,
+        default=DEFAULT_REPEAT
+    )
+
+    parser.add_argument(
+        "--latency-ms",
+        help="Latency added to each request by the stand-ins",
+        type=float,
+        default=DEFAULT_LATENCY_MS
+    )
+
+    parser.add_argument(
+        "--error-rate",
+        help="Share of the fake GCS requests failing with a 503, to exercise retries",
+        type=float,
+        default=0.0
+    )
+
+    parser.add_argument(
+        "--time-scale",
+        help="Ratio applied to the Dataform run durations and polling delays",
+        type=float,
+        default=DEFAULT_TIME_SCALE
+    )
+
+    parser.add_argument(
+        "--work-dir",
+        help="Directory keeping the synthetic projects between runs. Temporary if not set",
+        type=Path
+    )
+
+    parser.add_argument(
+        "--output",
+        help="JSON file receiving the results",
+        type=Path
+    )
+
+    parser.add_argument(
+        "--baseline",
+        help="Results of a previous run to compare with",
+        type=Path
+    )
+
+    parser.add_argument(
+        "--max-regression",
+        help="Tolerated slowdown of the median duration compared to the baseline",
+        type=float,
+        default=DEFAULT_MAX_REGRESSION
+    )
+
+    parser.add_argument("--verbose", action="store_true")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    with FakeGCSServer(args.latency_ms / 1000, args.error_rate) as fake_gcs:
+        os.environ["STORAGE_EMULATOR_HOST"] = fake_gcs.url
+        os.environ.setdefault("AUTHOR", BENCHMARK_PROJECT)
+        os.environ["PREWARM_SECRETS"] = "false"
+        use_anonymous_credentials()
+        sys.path[:0] = [str(REPO_ROOT / "airflow"), str(REPO_ROOT / "cloud_functions")]
+
+        work_dir = args.work_dir or Path(tempfile.mkdtemp(prefix="dataform-benchmarks-"))
+        try:
+            benchmarks = Benchmarks(work_dir, fake_gcs, args.repeat)
+            for size in args.sizes.split(","):
+                benchmarks.transfers(int(size))
+            benchmarks.patch_vars()
+            benchmarks.dataform_api(args.time_scale, args.latency_ms / 1000)
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        args.output.write_text(json.dumps(benchmarks.results, indent=4))
+
+    if args.baseline:
+        regressions = find_regressions(
+            benchmarks.results,
+            json.loads(args.baseline.read_text()),
+            args.max_regression
+        )
+        if regressions:
+            sys.exit("Slower than the baseline:\n" + "\n".join(regressions))
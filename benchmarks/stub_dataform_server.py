@@ -0,0 +1,145 @@
+"""
+In-process stand-in for the Dataform web API used by the Cloud Function:
+POST /v1/project/<id>/run triggers a run, GET /v1/project/<id>/run/<run_id>
+returns it. A run stays RUNNING for a random duration, then ends with the
+configured status.
+
+Usage:
+    with StubDataformServer(run_seconds=(0.5, 2.0)) as server:
+        helper.base_url = f"{server.url}/v1/project/123/run"
+"""
+
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+_RUNS_PATH = re.compile(r"^/v1/project/(?P<project>[^/]+)/run$")
+_RUN_PATH = re.compile(r"^/v1/project/(?P<project>[^/]+)/run/(?P<run_id>[^/]+)$")
+
+
+@dataclass
+class StubRun:
+    """A run triggered on the stub server."""
+
+    run_id: str
+    run_config: Optional[dict]
+    finishes_at: float
+    final_status: str
+    polls: int = 0
+
+    def status(self) -> str:
+        return self.final_status if time.monotonic() >= self.finishes_at else "RUNNING"
+
+
+class StubDataformServer:
+    """Threaded HTTP server simulating Dataform runs
+
+    Args:
+        run_seconds (Tuple[float, float]): Bounds of the uniform run duration
+        final_status (str): Status of the runs once finished
+        latency_seconds (float): Delay added to every request
+        seed (int): Seed of the run durations
+    """
+
+    def __init__(
+        self,
+        run_seconds: Tuple[float, float] = (1.0, 1.0),
+        final_status: str = "SUCCESSFUL",
+        latency_seconds: float = 0.0,
+        seed: int = 0
+    ):
+        self.run_seconds = run_seconds
+        self.final_status = final_status
+        self.latency_seconds = latency_seconds
+        self.random = random.Random(seed)
+        self.runs: Dict[str, StubRun] = {}
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), _make_handler(self))
+        self._httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubDataformServer":
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "StubDataformServer":
+        return self.start()
+
+    def __exit__(self, *_):
+        self.stop()
+
+    def trigger(self, run_config: Optional[dict]) -> StubRun:
+        with self.lock:
+            run = StubRun(
+                run_id=uuid.uuid4().hex,
+                run_config=run_config,
+                finishes_at=time.monotonic() + self.random.uniform(*self.run_seconds),
+                final_status=self.final_status,
+            )
+            self.runs[run.run_id] = run
+        return run
+
+
+def _make_handler(server: StubDataformServer):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *_):
+            pass
+
+        def _send_json(self, status: int, payload: dict):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _before_request(self) -> bytes:
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else b""
+            with server.lock:
+                server.request_count += 1
+            if server.latency_seconds:
+                time.sleep(server.latency_seconds)
+            return body
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            body = self._before_request()
+            if not _RUNS_PATH.match(self.path):
+                self._send_json(HTTPStatus.NOT_FOUND, {"message": "Not found"})
+                return
+
+            run = server.trigger(json.loads(body or b"{}").get("runConfig"))
+            self._send_json(HTTPStatus.OK, {"id": run.run_id, "status": run.status()})
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            self._before_request()
+            match = _RUN_PATH.match(self.path)
+            run = server.runs.get(match["run_id"]) if match else None
+            if run is None:
+                self._send_json(HTTPStatus.NOT_FOUND, {"message": "Not found"})
+                return
+
+            with server.lock:
+                run.polls += 1
+            self._send_json(HTTPStatus.OK, {"id": run.run_id, "status": run.status()})
+
+    return Handler
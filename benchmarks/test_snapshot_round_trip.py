@@ -0,0 +1,97 @@
+"""
+Checks that a Dataform project saved to GCS with save_snapshot is loaded
+back unchanged, against the fake GCS server.
+
+Usage:
+    python -m pytest benchmarks/test_snapshot_round_trip.py
+"""
+
+import os
+import sys
+from pathlib import Path
+
+import google.auth
+import pytest
+from google.auth.credentials import AnonymousCredentials
+
+from fake_gcs_server import FakeGCSServer
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT / "airflow"))
+
+# pylint: disable=wrong-import-position
+from dataform_helpers import gcs_transfer  # noqa: E402
+from dataform_helpers.snapshot import SNAPSHOT_FORMATS, load_snapshot, save_snapshot  # noqa: E402
+
+BUCKET = "round-trip"
+
+# Top-level snapshots/ folder, named like the root of the cached snapshots
+PROJECT_FILES = {
+    "dataform.json": '{"vars": {}}',
+    "definitions/a.sqlx": "SELECT 1",
+    "snapshots/s.sqlx": "SELECT 2",
+}
+
+
+@pytest.fixture(name="gcs_server")
+def fixture_gcs_server(monkeypatch):
+    with FakeGCSServer() as server:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", server.url)
+        monkeypatch.setattr(
+            google.auth, "default", lambda *_, **__: (AnonymousCredentials(), BUCKET)
+        )
+        # The client is created per server, as it keeps its endpoint
+        monkeypatch.setattr(gcs_transfer, "_client", None)
+        yield server
+
+
+def create_project(project_dir: Path) -> Path:
+    for relative_path, content in PROJECT_FILES.items():
+        (project_dir / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (project_dir / relative_path).write_text(content)
+    return project_dir
+
+
+def read_project(project_dir: Path) -> dict:
+    return {
+        path.relative_to(project_dir).as_posix(): path.read_text()
+        for path in project_dir.rglob("*") if path.is_file()
+    }
+
+
+@pytest.mark.parametrize("snapshot_format", SNAPSHOT_FORMATS)
+def test_round_trip_keeps_all_files(gcs_server, tmp_path, snapshot_format):
+    project_dir = create_project(tmp_path / "project")
+
+    save_snapshot(project_dir, f"gs://{BUCKET}/author/project", snapshot_format)
+    loaded_dir = load_snapshot(BUCKET, "author/project", tmp_path / "loaded")
+
+    assert read_project(loaded_dir) == PROJECT_FILES
+
+
+def test_sync_of_unchanged_project_uploads_nothing(gcs_server, tmp_path):
+    project_dir = create_project(tmp_path / "project")
+    gcs_path = f"gs://{BUCKET}/author/project"
+
+    gcs_transfer.sync_local_dir_to_gcs(project_dir, gcs_path)
+    # Without its manifest, the prefix is compared with the listing
+    gcs_server.delete(BUCKET, f"author/project/{gcs_transfer.SYNC_MANIFEST_NAME}")
+    summary = gcs_transfer.sync_local_dir_to_gcs(project_dir, gcs_path)
+
+    assert summary.files == 0
+    assert summary.skipped == len(PROJECT_FILES)
+
+
+def test_sync_detects_objects_changed_after_the_manifest(gcs_server, tmp_path):
+    project_dir = create_project(tmp_path / "project")
+    gcs_path = f"gs://{BUCKET}/author/project"
+
+    gcs_transfer.sync_local_dir_to_gcs(project_dir, gcs_path)
+    # Written without going through the sync, the manifest is now stale
+    gcs_server.put(BUCKET, "author/project/definitions/a.sqlx", b"SELECT 3")
+    summary = gcs_transfer.sync_local_dir_to_gcs(project_dir, gcs_path)
+
+    assert summary.files == 1
+    assert gcs_server.get(BUCKET, "author/project/definitions/a.sqlx").data == b"SELECT 1"
+    # The refreshed manifest is trusted again
+    assert gcs_transfer.sync_local_dir_to_gcs(project_dir, gcs_path).files == 0
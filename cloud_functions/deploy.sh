@@ -4,18 +4,63 @@
 set -o errexit -o pipefail -o noclobber -o nounset
 
 # Argument parsing
+mode="blocking"
+batch_window=0
 while [[ "$#" -gt 0 ]]; do case $1 in
   -a|--author) author="$2"; shift;;
+  -m|--mode) mode="$2"; shift;;
+  -w|--batch-window) batch_window="$2"; shift;;
   *) echo "Unknown parameter passed: $1"; exit 1;;
 esac; shift; done
 
 [ -n "${author-}" ] || (echo "Missing required argument '--author'" && exit 1)
+[[ "${mode}" == "blocking" || "${mode}" == "async" ]] || (echo "'--mode' must be 'blocking' or 'async'" && exit 1)
 
 BUCKET="da-concepts-dev-gcs-workshop"
+REGION="europe-west1"
+# Holds the states of async runs and the batch queue and lock. Kept out of
+# the trigger bucket, where each of these writes would invoke the trigger
+RUN_STATE_BUCKET="${BUCKET}-dataform-runs"
+FUNCTION_TIMEOUT_SECONDS=540
+# In blocking mode, the batch window and the wait for the run share the timeout
+MIN_RUN_WAIT_SECONDS=60
+
+if [[ "${mode}" == "blocking" ]] && (( batch_window > FUNCTION_TIMEOUT_SECONDS - MIN_RUN_WAIT_SECONDS )); then
+  echo "'--batch-window' must leave ${MIN_RUN_WAIT_SECONDS}s of the ${FUNCTION_TIMEOUT_SECONDS}s timeout to wait for the run, use '--mode async'"
+  exit 1
+fi
+
+if [[ "${mode}" == "async" || "${batch_window}" -gt 0 ]]; then
+  gsutil ls -b gs://${RUN_STATE_BUCKET} > /dev/null 2>&1 || \
+    gsutil mb -l ${REGION} gs://${RUN_STATE_BUCKET}
+fi
+
+ENV_VARS="AUTHOR=${author},TRIGGER_MODE=${mode},RUN_STATE_BUCKET=${RUN_STATE_BUCKET},BATCH_WINDOW_SECONDS=${batch_window},FUNCTION_TIMEOUT_SECONDS=${FUNCTION_TIMEOUT_SECONDS}"
 
 gcloud functions deploy execute_dataform_run_${author} \
---set-env-vars AUTHOR=${author} \
+--set-env-vars ${ENV_VARS} \
 --runtime python38 \
---region europe-west1 \
+--region ${REGION} \
+--timeout ${FUNCTION_TIMEOUT_SECONDS}s \
 --trigger-resource ${BUCKET} \
 --trigger-event google.storage.object.finalize
+
+if [[ "${mode}" == "async" ]]; then
+  # In async mode, the runs are completed by a checker triggered every minute
+  CHECK_TOPIC="dataform-run-checks-${author}"
+
+  gcloud pubsub topics describe ${CHECK_TOPIC} > /dev/null 2>&1 || \
+    gcloud pubsub topics create ${CHECK_TOPIC}
+
+  gcloud functions deploy check_dataform_runs_${author} \
+  --set-env-vars ${ENV_VARS} \
+  --runtime python38 \
+  --region ${REGION} \
+  --trigger-topic ${CHECK_TOPIC}
+
+  gcloud scheduler jobs describe ${CHECK_TOPIC} > /dev/null 2>&1 || \
+    gcloud scheduler jobs create pubsub ${CHECK_TOPIC} \
+    --schedule "* * * * *" \
+    --topic ${CHECK_TOPIC} \
+    --message-body "{}"
+fi
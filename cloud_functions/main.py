@@ -1,12 +1,17 @@
 """This file contains the main Cloud Function code."""
+import random
 import time
 import json
 import requests
 import logging
 import os
-from google.cloud import secretmanager
+from typing import Dict, Iterable, List, Optional
 import google.auth
 from google.cloud import storage
+from google.api_core import exceptions
+
+import metrics
+from secret_helper import SecretManagerHelper
 
 _, PROJECT_ID = google.auth.default()
 
@@ -14,71 +19,373 @@ DATAFORM_PROJECT_ID = "5650608764747776"
 
 AUTHOR = os.environ["AUTHOR"]
 
+# "blocking": the function waits for the Dataform run to finish.
+# "async": the function only triggers the run and records it in GCS;
+# check_dataform_runs_<author> completes the bookkeeping later.
+TRIGGER_MODE = os.environ.get("TRIGGER_MODE", "blocking")
+TRIGGER_MODES = ("blocking", "async")
+if TRIGGER_MODE not in TRIGGER_MODES:
+    raise ValueError(f"TRIGGER_MODE must be one of {TRIGGER_MODES}, not {TRIGGER_MODE!r}")
 
-class SecretManagerHelper:
-    # pylint: disable=too-few-public-methods
-    """Wrapper around Google Secret Manager."""
+# Bucket and prefix where the state of triggered runs, the batch queue and
+# its lock are stored. A bucket other than the trigger bucket, so that these
+# writes do not invoke the trigger function, see deploy.sh
+RUN_STATE_BUCKET = os.environ.get("RUN_STATE_BUCKET")
+RUN_STATE_PREFIX = f"dataform_runs/{AUTHOR}"
 
-    project_id: str
-    client: secretmanager.SecretManagerServiceClient
+# Keep in sync with the --timeout of the trigger function in deploy.sh
+FUNCTION_TIMEOUT_SECONDS = int(os.environ.get("FUNCTION_TIMEOUT_SECONDS", "540"))
+# Left at the end of an invocation to report its metrics and return
+FUNCTION_TIMEOUT_MARGIN_SECONDS = 15
 
-    def __init__(self, project_id: str):
-        """Sets project and instantiates Secret Manager client"""
-        self.project_id = project_id
-        self.client = secretmanager.SecretManagerServiceClient()
+# When > 0, the events received within this many seconds are merged into
+# a single Dataform run instead of triggering one run per uploaded file
+BATCH_WINDOW_SECONDS = int(os.environ.get("BATCH_WINDOW_SECONDS", "0"))
 
-    def get_secret(self, secret_name: str) -> str:
-        """Using the secret name, fetches the secret value
+# Fetch the Dataform API key at cold start, so warm invocations find the
+# Secret Manager client and the key already cached
+PREWARM_SECRETS = os.environ.get("PREWARM_SECRETS", "true") == "true"
 
-        Args:
-            secret_name (str): The name of the secret as defined in
-                Google Secret Manager
+# Keys of the uploaded JSON files forwarded to the Dataform run config
+RUN_CONFIG_KEYS = ("tags", "actions", "vars", "includeDependencies", "fullRefresh")
+
+# Reused by warm instances, so that polling does not open a connection per request
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount(
+    "https://", requests.adapters.HTTPAdapter(pool_maxsize=10, max_retries=3)
+)
 
-        Returns:
-            str: The value stored in the secret
-        """
-        name = (
-            f"projects/{self.project_id}/secrets/{secret_name}/versions/latest"
-        )
 
-        response = self.client.access_secret_version(request={"name": name})
-        return response.payload.data.decode("UTF-8")
+class DataformRunError(Exception):
+    """Raised when a Dataform run does not finish successfully."""
 
 
 class DataformAPIHelper:
 
     API_KEY_SECRET_NAME = "dataform_api_key"
 
+    RUNNING_STATUS = "RUNNING"
+    TERMINAL_STATUSES = ("SUCCESSFUL", "FAILED", "CANCELLED", "TIMED_OUT")
+
+    # Polling starts fast for short runs and backs off for long ones
+    POLL_INITIAL_SECONDS = 2
+    POLL_MAX_SECONDS = 30
+    # Stays under the 540s maximum duration of a Cloud Function. Shortened
+    # to the time left in the invocation, see execute_run
+    POLL_TIMEOUT_SECONDS = 500
+
+    REQUEST_TIMEOUT_SECONDS = 30
+
     def __init__(self, gcp_project_id: str, dataform_project_id: str) -> None:
         self.api_key = SecretManagerHelper(gcp_project_id).get_secret(self.API_KEY_SECRET_NAME)
         self.headers = {
             "Authorization": f"Bearer {self.api_key}"
         }
         self.base_url = f'https://api.dataform.co/v1/project/{dataform_project_id}/run'
+        self.session = HTTP_SESSION
 
-    def trigger_run(self):
-        response = requests.post(
+    def trigger_run(self, run_config: Optional[dict] = None):
+        response = self.session.post(
             url=self.base_url,
-            # TODO: Add tags
-            data="{}",
-            headers=self.headers
+            data=json.dumps({"runConfig": run_config}) if run_config else "{}",
+            headers=self.headers,
+            timeout=self.REQUEST_TIMEOUT_SECONDS
         )
+        response.raise_for_status()
 
         return response.json()['id']
 
-    def wait_for_finish(self, run_id: str):
-        run_url = f"{self.base_url}/{run_id}"
-        response = requests.get(run_url, headers=self.headers)
+    def get_run(self, run_id: str) -> dict:
+        """Fetches the current state of a run
+
+        Args:
+            run_id (str): ID of the run
+
+        Returns:
+            dict: The run, including its status
+        """
+        response = self.session.get(
+            f"{self.base_url}/{run_id}",
+            headers=self.headers,
+            timeout=self.REQUEST_TIMEOUT_SECONDS
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def wait_for_runs(
+        self,
+        run_ids: Iterable[str],
+        timeout: Optional[float] = None
+    ) -> Dict[str, dict]:
+        """Polls several runs until they all reach a terminal status.
+
+        All pending runs are checked in each round, and the delay between
+        rounds grows exponentially, with jitter, up to POLL_MAX_SECONDS.
+
+        Args:
+            run_ids (Iterable[str]): IDs of the runs
+            timeout (float): Maximum wall-clock seconds to wait.
+                Defaults to POLL_TIMEOUT_SECONDS
+
+        Returns:
+            Dict[str, dict]: The final state of each run, by run ID
+        """
+        pending = list(run_ids)
+        finished = {}
+        deadline = time.monotonic() + (
+            self.POLL_TIMEOUT_SECONDS if timeout is None else timeout
+        )
+        delay = self.POLL_INITIAL_SECONDS
+
+        while True:
+            for run_id in list(pending):
+                run = self.get_run(run_id)
+                if run['status'] in self.TERMINAL_STATUSES:
+                    logging.info("Dataform run %s finished: %s", run_id, run['status'])
+                    finished[run_id] = run
+                    pending.remove(run_id)
+                elif run['status'] != self.RUNNING_STATUS:
+                    logging.warning("Unknown status of Dataform run %s: %s", run_id, run)
 
-        while response.json()['status'] == 'RUNNING':
-            # Check every 5 seconds
-            time.sleep(5)
-            response = requests.get(run_url, headers=self.headers)
-            logging.warning(response.json())
+            remaining = deadline - time.monotonic()
+            if not pending:
+                return finished
+            if remaining <= 0:
+                raise TimeoutError(f"Dataform runs still running: {pending}")
+
+            time.sleep(min(delay * random.uniform(0.5, 1.0), remaining))
+            delay = min(delay * 2, self.POLL_MAX_SECONDS)
+
+    def wait_for_finish(self, run_id: str, timeout: Optional[float] = None) -> dict:
+        return self.wait_for_runs([run_id], timeout)[run_id]
+
+    def execute_run(self, run_config: Optional[dict] = None, deadline: Optional[float] = None):
+        """Triggers a run and waits for it to finish
+
+        Args:
+            run_config (dict): Config of the run
+            deadline (float): time.monotonic() after which the run is no
+                longer waited for, e.g. the end of the invocation
+
+        Returns:
+            dict: The final state of the run
+
+        Raises:
+            DataformRunError: If the run did not succeed
+            TimeoutError: If the run did not finish before the deadline
+        """
+        with metrics.stage("dataform_api_trigger"):
+            run_id = self.trigger_run(run_config)
+        timeout = self.POLL_TIMEOUT_SECONDS
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        with metrics.stage("dataform_api_wait", run_id=run_id) as wait_metrics:
+            run = self.wait_for_finish(run_id, timeout)
+            wait_metrics.labels["run_status"] = run['status']
+
+        if run['status'] != 'SUCCESSFUL':
+            raise DataformRunError(f"Dataform run {run_id} ended with status {run['status']}")
+        return run
+
+
+if PREWARM_SECRETS:
+    try:
+        SecretManagerHelper(PROJECT_ID).prewarm(DataformAPIHelper.API_KEY_SECRET_NAME)
+    except Exception as error:  # pylint: disable=broad-except
+        # Invocations fetch the key themselves if the warm-up failed
+        logging.warning("Could not prewarm secrets: %s", error)
+
+
+class RunStateHelper:
+    """Persists the runs triggered in async mode as small GCS objects.
+
+    Pending runs are stored under <prefix>/pending/<run_id>.run-state and
+    moved to <prefix>/finished/ once they reach a terminal status. The
+    extension is not .json, so the objects never trigger a new run.
+    """
+
+    STATE_EXTENSION = ".run-state"
+
+    def __init__(self, project_id: str, bucket: str, prefix: str = RUN_STATE_PREFIX):
+        self.bucket = storage.Client(project_id).bucket(bucket)
+        self.prefix = prefix
+
+    def _blob_name(self, folder: str, run_id: str) -> str:
+        return f"{self.prefix}/{folder}/{run_id}{self.STATE_EXTENSION}"
+
+    def save_pending(self, run_id: str, state: dict):
+        self.bucket.blob(self._blob_name("pending", run_id)).upload_from_string(
+            json.dumps(state), content_type="application/json"
+        )
+
+    def list_pending(self) -> Dict[str, dict]:
+        """Returns the state of every pending run, by run ID"""
+        pending = {}
+        for blob in self.bucket.list_blobs(prefix=f"{self.prefix}/pending/"):
+            run_id = blob.name.rsplit("/", 1)[-1][:-len(self.STATE_EXTENSION)]
+            pending[run_id] = json.loads(blob.download_as_bytes())
+        return pending
+
+    def mark_finished(self, run_id: str, state: dict):
+        self.bucket.blob(self._blob_name("finished", run_id)).upload_from_string(
+            json.dumps(state), content_type="application/json"
+        )
+        self.bucket.blob(self._blob_name("pending", run_id)).delete()
 
-    def execute_run(self):
-        run_id = self.trigger_run()
-        self.wait_for_finish(run_id)
+
+class RunBatchHelper:
+    """Queues the run requests of an author in GCS, so that a burst of
+    uploads is merged into a single Dataform run.
+
+    The first request of a burst takes the leader lock (a create-only
+    object) and, after BATCH_WINDOW_SECONDS, releases it and claims every
+    queued request. Requests that find the lock taken only enqueue
+    themselves. Each request is claimed by deleting it with a generation
+    precondition, so concurrent leaders never run the same request twice.
+    """
+
+    REQUEST_EXTENSION = ".run-request"
+
+    def __init__(self, project_id: str, bucket: str, prefix: str = RUN_STATE_PREFIX):
+        self.bucket = storage.Client(project_id).bucket(bucket)
+        self.queue_prefix = f"{prefix}/queue/"
+        self.lock_blob = self.bucket.blob(f"{prefix}/batch.lock")
+
+    def enqueue(self, request_id: str, request: dict):
+        # Names sort by arrival time, so later requests win when merging
+        blob_name = (
+            f"{self.queue_prefix}{time.time_ns():020d}-{request_id}"
+            f"{self.REQUEST_EXTENSION}"
+        )
+        self.bucket.blob(blob_name).upload_from_string(
+            json.dumps(request), content_type="application/json"
+        )
+
+    def try_lead(self) -> bool:
+        """Takes the leader lock, breaking it if a crashed leader left it behind
+
+        Returns:
+            bool: Whether this invocation is the leader of the batch
+        """
+        try:
+            self.lock_blob.upload_from_string(str(time.time()), if_generation_match=0)
+            return True
+        except exceptions.PreconditionFailed:
+            pass
+
+        try:
+            self.lock_blob.reload()
+        except exceptions.NotFound:
+            return self.try_lead()
+
+        lock_age = time.time() - self.lock_blob.time_created.timestamp()
+        if lock_age > 2 * BATCH_WINDOW_SECONDS + 60:
+            logging.warning("Breaking stale batch lock created %.0fs ago", lock_age)
+            try:
+                self.lock_blob.delete(if_generation_match=self.lock_blob.generation)
+            except (exceptions.NotFound, exceptions.PreconditionFailed):
+                pass
+            return self.try_lead()
+        return False
+
+    def release(self):
+        try:
+            self.lock_blob.delete()
+        except exceptions.NotFound:
+            pass
+
+    def claim_requests(self) -> List[dict]:
+        """Removes the queued requests from the queue and returns them, oldest first"""
+        claimed = []
+        for blob in self.bucket.list_blobs(prefix=self.queue_prefix):
+            try:
+                request = json.loads(
+                    blob.download_as_bytes(if_generation_match=blob.generation)
+                )
+                blob.delete(if_generation_match=blob.generation)
+            except (exceptions.NotFound, exceptions.PreconditionFailed):
+                # Claimed by another leader
+                continue
+            claimed.append(request)
+        return claimed
+
+
+def get_run_state_bucket() -> str:
+    """Returns the bucket of the run states and batch queue, which must be set
+    in async mode or when batching"""
+    if not RUN_STATE_BUCKET:
+        raise ValueError(
+            "RUN_STATE_BUCKET must be set when TRIGGER_MODE is async "
+            "or BATCH_WINDOW_SECONDS is above 0"
+        )
+    return RUN_STATE_BUCKET
+
+
+def extract_run_config(json_content: dict) -> dict:
+    """Keeps the keys of an uploaded file that configure the Dataform run"""
+    return {
+        key: value for key, value in json_content.items()
+        if key in RUN_CONFIG_KEYS
+    }
+
+
+def merge_run_configs(run_configs: List[dict]) -> dict:
+    """Merges run configs, oldest first: lists (tags, actions) are united
+    in order, dicts (vars) are merged with later values winning, and flags
+    are enabled if any config enables them.
+
+    Args:
+        run_configs (List[dict]): Configs to merge
+
+    Returns:
+        dict: The merged config
+    """
+    merged = {}
+    for run_config in run_configs:
+        for key, value in run_config.items():
+            if isinstance(value, list):
+                merged[key] = merged.get(key, []) + [
+                    item for item in value if item not in merged.get(key, [])
+                ]
+            elif isinstance(value, dict):
+                merged[key] = {**merged.get(key, {}), **value}
+            elif isinstance(value, bool):
+                merged[key] = merged.get(key, False) or value
+            else:
+                merged[key] = value
+    return merged
+
+
+def dispatch_run(run_config: dict, sources: List[str], deadline: Optional[float] = None):
+    """Runs Dataform in the configured TRIGGER_MODE
+
+    Args:
+        run_config (dict): Config of the Dataform run
+        sources (List[str]): GCS paths of the files that requested the run
+        deadline (float): time.monotonic() until which a blocking run is
+            waited for
+    """
+    api_helper = DataformAPIHelper(PROJECT_ID, DATAFORM_PROJECT_ID)
+
+    try:
+        if TRIGGER_MODE != "async":
+            api_helper.execute_run(run_config, deadline)
+            return
+
+        with metrics.stage("dataform_api_trigger"):
+            run_id = api_helper.trigger_run(run_config)
+        RunStateHelper(PROJECT_ID, get_run_state_bucket()).save_pending(run_id, {
+            "run_id": run_id,
+            "author": AUTHOR,
+            "sources": sources,
+            "run_config": run_config,
+            "triggered_at": time.time(),
+        })
+        logging.info("Triggered Dataform run %s for %s", run_id, sources)
+    finally:
+        # Warm instances reuse the process: each invocation reports its own stages
+        metrics.write_summary()
+        metrics.reset()
 
 
 def download_gcs_file(project_id: str, bucket: str, path: str):
@@ -92,11 +399,14 @@ def download_gcs_file(project_id: str, bucket: str, path: str):
     return json.loads(blob_content)
 
 
-def execute_dataform_run_alexb(event: dict, _):
+def execute_dataform_run_alexb(event: dict, context):
     """Background Cloud Function to be triggered by Cloud Storage.
     Args:
         event (dict):  The dictionary with data specific to this type of event.
+        context (google.cloud.functions.Context): Metadata of the event.
     """
+    # The invocation is killed after FUNCTION_TIMEOUT_SECONDS, batch window included
+    deadline = time.monotonic() + FUNCTION_TIMEOUT_SECONDS - FUNCTION_TIMEOUT_MARGIN_SECONDS
     bucket = event['bucket']
     path = event['name']
 
@@ -107,6 +417,65 @@ def execute_dataform_run_alexb(event: dict, _):
             bucket=bucket,
             path=path
         )
-        # TODO: Add tags to the API Helper
         print(json_content)
-        DataformAPIHelper(PROJECT_ID, DATAFORM_PROJECT_ID).execute_run()
+        run_config = extract_run_config(json_content)
+        source = f"gs://{bucket}/{path}"
+
+        if BATCH_WINDOW_SECONDS <= 0:
+            dispatch_run(run_config, [source], deadline)
+            return
+
+        batch_helper = RunBatchHelper(PROJECT_ID, get_run_state_bucket())
+        batch_helper.enqueue(context.event_id, {"source": source, "run_config": run_config})
+        if not batch_helper.try_lead():
+            return
+
+        time.sleep(BATCH_WINDOW_SECONDS)
+        # Released before claiming: requests queued after the claim
+        # start a new batch instead of being left behind
+        batch_helper.release()
+        requests_to_run = batch_helper.claim_requests()
+        if requests_to_run:
+            dispatch_run(
+                merge_run_configs([request["run_config"] for request in requests_to_run]),
+                [request["source"] for request in requests_to_run],
+                deadline
+            )
+
+
+def check_dataform_runs_alexb(event: dict, _):
+    """Background Cloud Function completing the runs triggered in async mode,
+    to be triggered periodically, e.g. by Cloud Scheduler through Pub/Sub.
+
+    Each pending run is checked once, without waiting: finished runs are
+    moved to the finished folder with their final status. A run that cannot
+    be checked is left pending for the next invocation.
+
+    Args:
+        event (dict):  The dictionary with data specific to this type of event.
+    """
+    state_helper = RunStateHelper(PROJECT_ID, get_run_state_bucket())
+    pending = state_helper.list_pending()
+    if not pending:
+        return
+
+    api_helper = DataformAPIHelper(PROJECT_ID, DATAFORM_PROJECT_ID)
+    for run_id, state in pending.items():
+        try:
+            run = api_helper.get_run(run_id)
+            if run['status'] not in DataformAPIHelper.TERMINAL_STATUSES:
+                continue
+
+            state_helper.mark_finished(run_id, {
+                **state,
+                "status": run['status'],
+                "checked_at": time.time(),
+            })
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("Could not check Dataform run %s", run_id)
+            continue
+
+        if run['status'] == 'SUCCESSFUL':
+            logging.info("Dataform run %s succeeded", run_id)
+        else:
+            logging.error("Dataform run %s ended with status %s", run_id, run['status'])
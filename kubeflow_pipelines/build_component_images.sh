@@ -4,17 +4,22 @@
 set -o errexit -o pipefail -o noclobber -o nounset
 
 # Argument parsing
+tag=latest
 while [[ "$#" -gt 0 ]]; do case $1 in
   -p|--project) project="$2"; shift;;
-  -a|--author) author="$2"; shift;;
+  -t|--tag) tag="$2"; shift;;
   *) echo "Unknown parameter passed: $1"; exit 1;;
 esac; shift; done
 
 [ -n "${project-}" ] || (echo "Missing required argument '--project'" && exit 1)
-[ -n "${author-}" ] || (echo "Missing required argument '--author'" && exit 1)
 
-cd "components/1_load_repo_and_edit_config/" && ./build_image.sh --project ${project} --author ${author}
-cd -
+# The images are shared by all the authors, and built in parallel
+pids=()
+for component in 1_load_repo_and_edit_config 2_run_dataform 3_clone_and_run_dataform; do
+  (cd "components/${component}" && ./build_image.sh --project "${project}" --tag "${tag}") &
+  pids+=($!)
+done
 
-cd "components/2_run_dataform" && ./build_image.sh --project ${project} --author ${author}
-cd -
+for pid in "${pids[@]}"; do
+  wait "${pid}"
+done
@@ -3,22 +3,25 @@
 # Argument parsing
 while [[ "$#" -gt 0 ]]; do case $1 in
   -p|--project) project="$2"; shift;;
-  -a|--author) author="$2"; shift;;
+  -t|--tag) tag="$2"; shift;;
   *) echo "Unknown parameter passed: $1"; exit 1;;
 esac; shift; done
 
 [ -n "${project-}" ] || (echo "Missing required argument '--project'" && exit 1)
-[ -n "${author-}" ] || (echo "Missing required argument '--author'" && exit 1)
 
-IMAGE_NAME=load-dataform-gcs-${author}
-IMAGE_TAG=latest
+# The image is shared by all the authors, who pass their name at runtime.
+# Build another tag (e.g. your name) to try changes to the component
+IMAGE_NAME=load-dataform-gcs
+IMAGE_TAG=${tag:-latest}
 
-BASE_GCR_PATH=eu.gcr.io/${project}/kfp/dataform-basic-example/${author}/components
-FULL_IMAGE_NAME=${BASE_GCR_PATH}/${IMAGE_NAME}:${IMAGE_TAG}
+BASE_GCR_PATH=eu.gcr.io/${project}/kfp/dataform-basic-example/components
+FULL_IMAGE_NAME=${BASE_GCR_PATH}/${IMAGE_NAME}
 
 GCS_SOURCE_STAGING_DIR="${project}-staging/kfp/${IMAGE_NAME}"
 
-# Build the Docker image using Cloud Build and store it in Cloud Registry
+# Build the Docker image using Cloud Build and store it in Cloud Registry,
+# reusing the layers of the previous build, see ../cloudbuild.yaml
 gcloud builds submit . \
-    --tag "${FULL_IMAGE_NAME}" \
-    --gcs-source-staging-dir=gs://${GCS_SOURCE_STAGING_DIR}/${author}/docker_images
+    --config ../cloudbuild.yaml \
+    --substitutions "_IMAGE=${FULL_IMAGE_NAME},_TAG=${IMAGE_TAG}" \
+    --gcs-source-staging-dir=gs://${GCS_SOURCE_STAGING_DIR}/docker_images
@@ -1,6 +1,19 @@
 import argparse
+import atexit
+import logging
+from pathlib import Path
 
-from src.load_and_save_to_gcs import clone_repo_and_save_to_gcs
+from src.gcs_transfer import DEFAULT_MAX_WORKERS
+from src.git_cache import CloneOptions, resolve_commit
+from src.graph_cache import hash_vars
+from src.load_and_save_to_gcs import clone_repo_and_save_to_gcs, snapshot_gcs_prefix
+from src.metrics import stage, write_summary
+from src.snapshot import FILES_FORMAT, SNAPSHOT_FORMATS
+
+
+def write_output(path: Path, value: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(value)
 
 
 if __name__ == "__main__":
@@ -12,6 +25,36 @@ if __name__ == "__main__":
         type=str,
     )
 
+    parser.add_argument(
+        "--repo-ref",
+        help="Branch, tag or commit to check out. Defaults to the remote HEAD",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--git-cache-dir",
+        help="Directory holding bare mirrors of the cloned repositories",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--git-bundle-gcs-path",
+        help="gs:// path of a git bundle used to seed and persist the mirror",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--clone-depth",
+        help="History depth of the clone, when no mirror is used",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--clone-filter",
+        help="Partial clone filter (e.g. blob:none), when no mirror is used",
+        type=str,
+    )
+
     parser.add_argument(
         "--example-value",
         help="Example value",
@@ -19,7 +62,11 @@ if __name__ == "__main__":
         required=True
     )
 
-    # TODO: Add author param
+    parser.add_argument(
+        "--author",
+        help="Author of the run, prefixing the GCS prefix of the project",
+        type=str,
+    )
 
     parser.add_argument(
         "--output-gcs-bucket",
@@ -33,16 +80,162 @@ if __name__ == "__main__":
         type=str,
     )
 
+    parser.add_argument(
+        "--snapshot-gcs-prefix",
+        help=(
+            "Saves the project under this prefix, as output by --resolve-only, "
+            "instead of <author>/<output-gcs-prefix>. It already includes the "
+            "author, so it is used as is"
+        ),
+        type=str,
+    )
+
+    parser.add_argument(
+        "--upload-workers",
+        help="Number of files uploaded to GCS in parallel",
+        type=int,
+        default=DEFAULT_MAX_WORKERS
+    )
+
+    parser.add_argument(
+        "--snapshot-format",
+        help=(
+            "How the project is saved on GCS: one object per file, "
+            "or a single compressed archive"
+        ),
+        type=str,
+        choices=SNAPSHOT_FORMATS,
+        default=FILES_FORMAT
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help=(
+            "Records the files changed since the last successful run, "
+            "so that the runner only runs the affected actions"
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--handoff-dir",
+        help=(
+            "Directory shared with the runner (pipeline volume or output "
+            "artifact) receiving a copy of the project"
+        ),
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--handoff-run-id",
+        help="ID of the pipeline run, stamped on the project handed to the runner",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--skip-gcs-upload",
+        help=(
+            "Only hands the project off through --handoff-dir, when the runner "
+            "is guaranteed to mount it"
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--resolve-only",
+        help=(
+            "Instead of loading the project, resolves --repo-ref to a commit and "
+            "hashes the vars, so that the load step can be cached on them"
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--commit-output-path",
+        help="File receiving the commit resolved with --resolve-only",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--input-vars-hash-output-path",
+        help=(
+            "File receiving the hash of the vars given to the loader, with "
+            "--resolve-only. Not the vars_hash of the build info, which hashes "
+            "them merged with the vars of dataform.json"
+        ),
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--snapshot-prefix-output-path",
+        help=(
+            "File receiving the GCS prefix of the snapshot of the commit and vars, "
+            "with --resolve-only. It includes the author and --output-gcs-prefix: "
+            "pass it as is, to the loader as --snapshot-gcs-prefix and to the "
+            "runner as --input-gcs-prefix without --author"
+        ),
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--metrics-output-path",
+        help="KFP metrics file receiving the duration and transfers of each stage",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--openmetrics-output-path",
+        help="File receiving the stage metrics in the OpenMetrics text format",
+        type=Path,
+    )
+
+    logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
+    if args.skip_gcs_upload and args.handoff_dir is None:
+        parser.error("--skip-gcs-upload requires --handoff-dir")
+    # Also written when the load fails
+    atexit.register(write_summary, args.metrics_output_path, args.openmetrics_output_path)
 
-    # TODO: Add author
     dataform_vars = {
         "exampleValue": args.example_value
     }
+    if args.author:
+        # As in the Airflow DAGs
+        dataform_vars["author"] = args.author
 
-    clone_repo_and_save_to_gcs(
-        repo_url=args.repo_url,
-        dataform_vars=dataform_vars,
-        gcs_bucket=args.output_gcs_bucket,
-        gcs_prefix=args.output_gcs_prefix
-    )
+    if args.author:
+        args.output_gcs_prefix = f"{args.author}/{args.output_gcs_prefix}"
+
+    if args.resolve_only:
+        with stage("resolve"):
+            commit = resolve_commit(args.repo_url, args.repo_ref)
+        input_vars_hash = hash_vars(dataform_vars)
+        if args.commit_output_path:
+            write_output(args.commit_output_path, commit)
+        if args.input_vars_hash_output_path:
+            write_output(args.input_vars_hash_output_path, input_vars_hash)
+        if args.snapshot_prefix_output_path:
+            write_output(
+                args.snapshot_prefix_output_path,
+                snapshot_gcs_prefix(args.output_gcs_prefix, commit, input_vars_hash)
+            )
+    else:
+        clone_repo_and_save_to_gcs(
+            repo_url=args.repo_url,
+            dataform_vars=dataform_vars,
+            gcs_bucket=args.output_gcs_bucket,
+            gcs_prefix=args.snapshot_gcs_prefix or args.output_gcs_prefix,
+            max_workers=args.upload_workers,
+            snapshot_format=args.snapshot_format,
+            incremental=args.incremental,
+            handoff_dir=args.handoff_dir,
+            handoff_run_id=args.handoff_run_id,
+            upload_to_gcs=not args.skip_gcs_upload,
+            clone_options=CloneOptions(
+                ref=args.repo_ref,
+                cache_dir=args.git_cache_dir,
+                bundle_gcs_path=args.git_bundle_gcs_path,
+                depth=args.clone_depth,
+                blob_filter=args.clone_filter
+            )
+        )
@@ -0,0 +1,114 @@
+"""
+Contains helpers to run only the Dataform actions affected by the commits
+made since the last successful run.
+
+The commit and vars hash of the last successful run are recorded on GCS.
+The loader diffs the cloned commit against it and adds the changed files
+to the build info of the project (see graph_cache), which the runner maps
+to actions through the compiled graph.
+"""
+
+import json
+import logging
+import subprocess
+from pathlib import Path
+from typing import List, Optional
+
+from google.api_core import exceptions
+
+from .gcs_transfer import get_storage_client, split_gcs_path
+from .graph_cache import BUILD_INFO_NAME, read_build_info
+
+LAST_RUN_NAME = "last-successful-run.json"
+RUN_STATE_DIR = "run-state"
+
+
+def default_run_state_gcs_path(gcs_bucket: str, gcs_prefix: str) -> str:
+    """Returns where the run state of the project saved under the prefix is kept
+
+    Args:
+        gcs_bucket (str): Bucket where the project is saved
+        gcs_prefix (str): Prefix where the project is saved
+
+    Returns:
+        str: gs:// prefix of the run state
+    """
+    return f"gs://{gcs_bucket}/{RUN_STATE_DIR}/{gcs_prefix}"
+
+
+def _last_run_blob(run_state_gcs_path: str):
+    bucket_name, prefix = split_gcs_path(run_state_gcs_path)
+    return get_storage_client().bucket(bucket_name).blob(f"{prefix}/{LAST_RUN_NAME}")
+
+
+def read_last_successful_run(run_state_gcs_path: str) -> Optional[dict]:
+    """Reads the build info of the last successful run
+
+    Args:
+        run_state_gcs_path (str): gs:// prefix of the run state
+
+    Returns:
+        Optional[dict]: The build info, None if no run succeeded yet
+    """
+    try:
+        return json.loads(_last_run_blob(run_state_gcs_path).download_as_bytes())
+    except exceptions.NotFound:
+        return None
+
+
+def record_successful_run(run_state_gcs_path: str, build_info: dict):
+    """Records the build info of a successful run
+
+    Args:
+        run_state_gcs_path (str): gs:// prefix of the run state
+        build_info (dict): Build info of the project that ran
+    """
+    _last_run_blob(run_state_gcs_path).upload_from_string(
+        json.dumps(build_info), content_type="application/json"
+    )
+
+
+def changed_files(project_dir: Path, base_commit: str) -> Optional[List[str]]:
+    """Lists the files changed between base_commit and the checked out commit
+
+    Args:
+        project_dir (Path): Path of the cloned Dataform project
+        base_commit (str): Commit to diff against
+
+    Returns:
+        Optional[List[str]]: Paths relative to the project, None if the
+            base commit is not in the local history (e.g. shallow clone)
+    """
+    try:
+        result = subprocess.run(
+            ["git", "diff", "--name-only", base_commit, "HEAD"],
+            cwd=str(project_dir), check=True, capture_output=True, text=True
+        )
+    except subprocess.CalledProcessError as error:
+        logging.warning("Cannot diff against %s: %s", base_commit, error.stderr)
+        return None
+    return result.stdout.splitlines()
+
+
+def record_changes(project_dir: Path, run_state_gcs_path: str) -> dict:
+    """Adds the files changed since the last successful run to the build
+    info of the project. "changed_files" is None when everything must run
+
+    Args:
+        project_dir (Path): Path of the cloned Dataform project, with its build info
+        run_state_gcs_path (str): gs:// prefix of the run state
+
+    Returns:
+        dict: The updated build info
+    """
+    build_info = read_build_info(project_dir)
+    last_run = read_last_successful_run(run_state_gcs_path)
+
+    build_info["base_commit"] = None
+    build_info["changed_files"] = None
+    if last_run and last_run["vars_hash"] == build_info["vars_hash"]:
+        build_info["base_commit"] = last_run["commit"]
+        build_info["changed_files"] = changed_files(project_dir, last_run["commit"])
+
+    (Path(project_dir) / BUILD_INFO_NAME).write_text(json.dumps(build_info, indent=4))
+    return build_info
@@ -0,0 +1,149 @@
+"""
+Contains helpers to hand the Dataform project from the loader to the runner
+through a directory both steps mount (a pipeline volume or a KFP artifact)
+instead of a GCS upload followed by a download.
+
+The loader stamps the project with the ID of the run and copies it under
+<handoff_dir>/project. The runner only uses a copy stamped by its own run,
+and otherwise falls back to the GCS snapshot, e.g. when the directory is
+not shared with the loader. The loader can skip the GCS upload when the
+directory is always shared, like a volume mounted by both steps.
+"""
+
+import json
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Optional
+
+from .gcs_transfer import iterate_local_files
+from .metrics import record_transfer
+
+HANDOFF_PROJECT_DIR = "project"
+HANDOFF_MARKER_NAME = ".dataform-handoff.json"
+
+
+class StaleHandoffError(RuntimeError):
+    """Raised when the project found for a run was written by another run"""
+
+
+def write_handoff_marker(project_dir: Path, run_id: str):
+    """Stamps the project with the ID of the run that prepared it
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        run_id (str): ID of the pipeline run
+    """
+    marker = {"run_id": run_id, "written_at": time.time()}
+    (Path(project_dir) / HANDOFF_MARKER_NAME).write_text(json.dumps(marker))
+
+
+def read_handoff_marker(project_dir: Path) -> Optional[dict]:
+    """Reads the stamp of the project
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+
+    Returns:
+        Optional[dict]: The stamp, None if the project has none
+    """
+    marker_path = Path(project_dir) / HANDOFF_MARKER_NAME
+    if not marker_path.exists():
+        return None
+    return json.loads(marker_path.read_text())
+
+
+def check_handoff_run(project_dir: Path, run_id: str):
+    """Checks that the project was prepared by the given run
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        run_id (str): ID of the pipeline run
+
+    Raises:
+        StaleHandoffError: If the project was prepared by another run
+    """
+    marker = read_handoff_marker(project_dir)
+    found_run_id = marker["run_id"] if marker else None
+    if found_run_id != run_id:
+        raise StaleHandoffError(
+            f"Project in {project_dir} was prepared by run {found_run_id}, "
+            f"not by run {run_id}"
+        )
+
+
+def _copy_project(source_dir: Path, destination_dir: Path):
+    start = time.monotonic()
+    shutil.copytree(source_dir, destination_dir, symlinks=True)
+
+    files = 0
+    total_bytes = 0
+    for path_to_file in iterate_local_files(destination_dir):
+        files += 1
+        total_bytes += path_to_file.lstat().st_size
+    logging.info(
+        "Copied %d files (%d bytes) from %s to %s in %.2fs",
+        files, total_bytes, source_dir, destination_dir, time.monotonic() - start
+    )
+    record_transfer(objects=files, bytes=total_bytes)
+
+
+def save_to_handoff_dir(project_dir: Path, handoff_dir: Path) -> Path:
+    """Copies the project into the hand-off directory, replacing the
+    previous one only once the copy is complete
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        handoff_dir (Path): Directory shared with the runner
+
+    Returns:
+        Path: Path of the copy
+    """
+    handoff_dir = Path(handoff_dir)
+    handoff_dir.mkdir(parents=True, exist_ok=True)
+    target_dir = handoff_dir / HANDOFF_PROJECT_DIR
+    tmp_dir = handoff_dir / f".{HANDOFF_PROJECT_DIR}.{os.getpid()}.tmp"
+
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    _copy_project(Path(project_dir), tmp_dir)
+    shutil.rmtree(target_dir, ignore_errors=True)
+    os.replace(tmp_dir, target_dir)
+    return target_dir
+
+
+def load_from_handoff_dir(
+    handoff_dir: Path,
+    destination_dir: Path,
+    run_id: Optional[str] = None
+) -> Optional[Path]:
+    """Copies the project handed off by the loader, so that the hand-off
+    directory stays untouched by npm and Dataform
+
+    Args:
+        handoff_dir (Path): Directory shared with the loader
+        destination_dir (Path): Where to copy the project, replaced if it exists
+        run_id (str): Only accepts a project stamped by this run. Any project
+            is accepted if None, e.g. for an artifact written for this run
+
+    Returns:
+        Optional[Path]: destination_dir, None if the hand-off directory has
+            no project of the run
+    """
+    source_dir = Path(handoff_dir) / HANDOFF_PROJECT_DIR
+    if not source_dir.is_dir():
+        logging.warning("No project handed off in %s", handoff_dir)
+        return None
+    if run_id is not None:
+        try:
+            check_handoff_run(source_dir, run_id)
+        except StaleHandoffError as error:
+            logging.warning("Ignoring the handed off project: %s", error)
+            return None
+
+    destination_dir = Path(destination_dir)
+    shutil.rmtree(destination_dir, ignore_errors=True)
+    destination_dir.parent.mkdir(parents=True, exist_ok=True)
+    _copy_project(source_dir, destination_dir)
+    return destination_dir
@@ -0,0 +1,220 @@
+"""
+Contains helpers to measure where the time of a run goes.
+
+    with metrics.stage("download"):
+        ...
+
+Each stage records its wall time and status, plus the objects, bytes and
+retries of the GCS transfers made during it. Finished stages are logged as
+one JSON line, sent to StatsD when STATSD_ADDRESS (host:port) is set, and
+kept in the run summary, which the entry points write out as a KFP metrics
+file, an OpenMetrics file or an Airflow XCom.
+"""
+
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from functools import wraps
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+STATSD_ADDRESS_ENV = "STATSD_ADDRESS"
+METRIC_PREFIX = "dataform"
+
+# Fields of StageMetrics exported as metrics
+EXPORTED_FIELDS = ("seconds", "objects", "bytes", "retries")
+
+
+@dataclass
+class StageMetrics:
+    """Measurements of a stage."""
+
+    stage: str
+    seconds: float = 0.0
+    objects: int = 0
+    bytes: int = 0
+    retries: int = 0
+    status: str = "ok"
+    labels: Dict[str, str] = field(default_factory=dict)
+
+    def add(self, objects: int = 0, bytes: int = 0, retries: int = 0):  # pylint: disable=redefined-builtin
+        """Adds transferred objects, bytes and retries to the stage"""
+        self.objects += objects
+        self.bytes += bytes
+        self.retries += retries
+
+
+_stages: List[StageMetrics] = []
+_stages_lock = threading.Lock()
+
+# Stack of the stages running in each thread
+_local = threading.local()
+
+
+def current_stage() -> Optional[StageMetrics]:
+    """Returns the innermost stage running in this thread, if any"""
+    running = getattr(_local, "running", [])
+    return running[-1] if running else None
+
+
+def record_transfer(objects: int = 0, bytes: int = 0, retries: int = 0):  # pylint: disable=redefined-builtin
+    """Adds a transfer to the current stage. Does nothing outside of a stage"""
+    metrics = current_stage()
+    if metrics is not None:
+        metrics.add(objects, bytes, retries)
+
+
+def _send_to_statsd(metrics: StageMetrics):
+    address = os.environ.get(STATSD_ADDRESS_ENV)
+    if not address:
+        return
+
+    host, _, port = address.rpartition(":")
+    name = f"{METRIC_PREFIX}.{metrics.stage}"
+    lines = [
+        f"{name}.seconds:{metrics.seconds * 1000:.0f}|ms",
+        f"{name}.objects:{metrics.objects}|c",
+        f"{name}.bytes:{metrics.bytes}|c",
+        f"{name}.retries:{metrics.retries}|c",
+        f"{name}.{metrics.status}:1|c",
+    ]
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as statsd_socket:
+            statsd_socket.sendto("\n".join(lines).encode("utf-8"), (host, int(port)))
+    except (OSError, ValueError) as error:
+        logging.warning("Cannot send metrics to StatsD at %s: %s", address, error)
+
+
+@contextmanager
+def stage(name: str, **labels: str) -> Iterator[StageMetrics]:
+    """Measures the enclosed block as a stage of the run
+
+    Args:
+        name (str): Name of the stage
+        labels (str): Extra dimensions of the stage, e.g. the author
+
+    Yields:
+        StageMetrics: The measurements, which the block can add to
+    """
+    metrics = StageMetrics(stage=name, labels=labels)
+    if not hasattr(_local, "running"):
+        _local.running = []
+    _local.running.append(metrics)
+
+    start = time.monotonic()
+    try:
+        yield metrics
+    except BaseException:
+        metrics.status = "error"
+        raise
+    finally:
+        metrics.seconds = time.monotonic() - start
+        _local.running.pop()
+        with _stages_lock:
+            _stages.append(metrics)
+
+        logging.info(json.dumps({"event": "dataform_stage", **asdict(metrics)}))
+        _send_to_statsd(metrics)
+
+
+def timed(name: str):
+    """Decorator measuring each call of the function as a stage
+
+    Args:
+        name (str): Name of the stage
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary() -> dict:
+    """Returns the stages finished so far in this process
+
+    Returns:
+        dict: The stages, in completion order, and their total duration
+    """
+    with _stages_lock:
+        stages = [asdict(metrics) for metrics in _stages]
+    return {
+        "stages": stages,
+        "total_seconds": sum(metrics["seconds"] for metrics in stages),
+    }
+
+
+def reset():
+    """Forgets the finished stages"""
+    with _stages_lock:
+        _stages.clear()
+
+
+def _metric_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def to_openmetrics() -> str:
+    """Formats the run summary in the OpenMetrics text format
+
+    Returns:
+        str: The exposition, one gauge per exported field
+    """
+    stages = summary()["stages"]
+    lines = []
+    for field_name in EXPORTED_FIELDS:
+        metric_name = f"{METRIC_PREFIX}_stage_{field_name}"
+        lines.append(f"# TYPE {metric_name} gauge")
+        for metrics in stages:
+            labels = {"stage": metrics["stage"], "status": metrics["status"], **metrics["labels"]}
+            label_text = ",".join(
+                f'{key}="{_metric_label(str(value))}"' for key, value in labels.items()
+            )
+            lines.append(f"{metric_name}{{{label_text}}} {metrics[field_name]}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def _kfp_metric_name(*parts: str) -> str:
+    # KFP only accepts names matching ^[a-z]([-a-z0-9]{0,62}[a-z0-9])?$
+    name = re.sub(r"[^a-z0-9]+", "-", "-".join(parts).lower()).strip("-")
+    return name[:64].rstrip("-")
+
+
+def write_summary(
+    kfp_metrics_path: Optional[Path] = None,
+    openmetrics_path: Optional[Path] = None
+):
+    """Logs the run summary and writes it to the requested files
+
+    Args:
+        kfp_metrics_path (Path): KFP metrics file, e.g. /mlpipeline-metrics.json
+        openmetrics_path (Path): File receiving the OpenMetrics exposition
+    """
+    run_summary = summary()
+    logging.info(json.dumps({"event": "dataform_run_summary", **run_summary}))
+
+    if kfp_metrics_path:
+        kfp_metrics = [
+            {
+                "name": _kfp_metric_name(metrics["stage"], field_name),
+                "numberValue": metrics[field_name],
+                "format": "RAW",
+            }
+            for metrics in run_summary["stages"]
+            for field_name in EXPORTED_FIELDS
+        ]
+        Path(kfp_metrics_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(kfp_metrics_path).write_text(json.dumps({"metrics": kfp_metrics}))
+
+    if openmetrics_path:
+        Path(openmetrics_path).parent.mkdir(parents=True, exist_ok=True)
+        Path(openmetrics_path).write_text(to_openmetrics())
@@ -0,0 +1,269 @@
+"""
+Contains helpers to save and load a Dataform project snapshot on GCS.
+
+A snapshot is either one GCS object per file ("files"), synced
+incrementally against the previous snapshot, or a single
+compressed tar archive plus a small manifest, both stored under
+<prefix>/_snapshot/. Archives are written to and extracted from the GCS
+streams directly, without landing on local disk.
+"""
+
+import json
+import logging
+import tarfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Optional
+
+from google.api_core import exceptions
+
+from .gcs_transfer import (
+    DEFAULT_MAX_WORKERS,
+    download_gcs_prefix,
+    get_storage_client,
+    iterate_local_files,
+    split_gcs_path,
+    sync_local_dir_to_gcs,
+)
+from .metrics import record_transfer
+
+FILES_FORMAT = "files"
+ARCHIVE_FORMATS = ("tar.gz", "tar.zst")
+SNAPSHOT_FORMATS = (FILES_FORMAT, *ARCHIVE_FORMATS)
+
+SNAPSHOT_DIR = "_snapshot"
+MANIFEST_NAME = "manifest.json"
+
+# Size of the requests used to stream the archive from / to GCS
+STREAM_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+class _UnflushableWriter:
+    # pylint: disable=too-few-public-methods
+    """Hides flush() of a GCS blob writer, which cannot flush
+    without finalizing the upload."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        pass
+
+
+def _snapshot_blob_name(gcs_prefix: str, file_name: str) -> str:
+    snapshot_path = f"{SNAPSHOT_DIR}/{file_name}"
+    return f"{gcs_prefix}/{snapshot_path}" if gcs_prefix else snapshot_path
+
+
+def _archive_name(archive_format: str) -> str:
+    return f"project.{archive_format}"
+
+
+def _check_member(member: tarfile.TarInfo):
+    """Refuses archive members that would be extracted outside the target"""
+    member_path = Path(member.name)
+    if member_path.is_absolute() or ".." in member_path.parts:
+        raise ValueError(f"Unsafe path in snapshot archive: {member.name}")
+    if member.issym() or member.islnk():
+        link_path = Path(member.linkname)
+        if link_path.is_absolute() or ".." in link_path.parts:
+            raise ValueError(f"Unsafe link in snapshot archive: {member.name}")
+
+
+def upload_dir_as_archive(
+    local_dir_path,
+    destination_gcs_path: str,
+    archive_format: str = "tar.gz"
+) -> dict:
+    """Streams a local directory to GCS as a single compressed tar archive
+    and writes the manifest describing it
+
+    Args:
+        local_dir_path (str): The path to the local directory.
+        destination_gcs_path (str): The path to the GCS location.
+        archive_format (str): One of ARCHIVE_FORMATS
+
+    Returns:
+        dict: The manifest of the snapshot
+    """
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError(f"Unknown archive format: {archive_format}")
+
+    local_dir_path = Path(local_dir_path)
+    bucket_name, prefix = split_gcs_path(destination_gcs_path)
+    bucket = get_storage_client().bucket(bucket_name)
+    archive_name = _archive_name(archive_format)
+    archive_blob = bucket.blob(_snapshot_blob_name(prefix, archive_name))
+
+    files = 0
+    total_bytes = 0
+    start = time.monotonic()
+    with archive_blob.open("wb", chunk_size=STREAM_CHUNK_SIZE) as blob_writer:
+        if archive_format == "tar.gz":
+            output, tar_mode = blob_writer, "w|gz"
+        else:
+            import zstandard  # pylint: disable=import-outside-toplevel
+            output = zstandard.ZstdCompressor().stream_writer(
+                _UnflushableWriter(blob_writer), closefd=False
+            )
+            tar_mode = "w|"
+
+        with tarfile.open(fileobj=output, mode=tar_mode) as tar:
+            for path_to_file in iterate_local_files(local_dir_path):
+                tar_info = tar.gettarinfo(
+                    str(path_to_file),
+                    arcname=path_to_file.relative_to(local_dir_path).as_posix()
+                )
+                with open(path_to_file, "rb") as file_obj:
+                    tar.addfile(tar_info, file_obj)
+                files += 1
+                total_bytes += tar_info.size
+
+        if output is not blob_writer:
+            output.close()
+
+    manifest = {
+        "format": archive_format,
+        "archive": archive_name,
+        "files": files,
+        "bytes": total_bytes,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
+    bucket.blob(_snapshot_blob_name(prefix, MANIFEST_NAME)).upload_from_string(
+        json.dumps(manifest), content_type="application/json"
+    )
+
+    logging.info(
+        "Archived %d files (%d bytes) to gs://%s/%s in %.2fs",
+        files, total_bytes, bucket_name, archive_blob.name, time.monotonic() - start
+    )
+    record_transfer(objects=files, bytes=total_bytes)
+    return manifest
+
+
+def read_manifest(gcs_bucket: str, gcs_prefix: str) -> Optional[dict]:
+    """Reads the snapshot manifest under the GCS prefix
+
+    Args:
+        gcs_bucket (str): Name of the GCS bucket
+        gcs_prefix (str): Prefix where the project is saved
+
+    Returns:
+        Optional[dict]: The manifest, or None if the project is not archived
+    """
+    blob = get_storage_client().bucket(gcs_bucket).blob(
+        _snapshot_blob_name(gcs_prefix.strip("/"), MANIFEST_NAME)
+    )
+    try:
+        return json.loads(blob.download_as_bytes())
+    except exceptions.NotFound:
+        return None
+
+
+def remove_snapshot_archive(gcs_bucket: str, gcs_prefix: str):
+    """Removes the archive and manifest under the GCS prefix, if any
+
+    Args:
+        gcs_bucket (str): Name of the GCS bucket
+        gcs_prefix (str): Prefix where the project is saved
+    """
+    client = get_storage_client()
+    snapshot_prefix = _snapshot_blob_name(gcs_prefix.strip("/"), "")
+    for blob in client.list_blobs(gcs_bucket, prefix=snapshot_prefix):
+        blob.delete()
+
+
+def extract_archive_from_gcs(
+    gcs_bucket: str,
+    gcs_prefix: str,
+    manifest: dict,
+    local_dir_path: Path
+):
+    """Streams the snapshot archive from GCS and extracts it on the fly
+
+    Args:
+        gcs_bucket (str): Name of the GCS bucket
+        gcs_prefix (str): Prefix where the project is saved
+        manifest (dict): Manifest returned by read_manifest
+        local_dir_path (Path): Directory to extract the project into
+    """
+    blob = get_storage_client().bucket(gcs_bucket).blob(
+        _snapshot_blob_name(gcs_prefix.strip("/"), manifest["archive"])
+    )
+    local_dir_path = Path(local_dir_path)
+    local_dir_path.mkdir(parents=True, exist_ok=True)
+
+    start = time.monotonic()
+    with blob.open("rb", chunk_size=STREAM_CHUNK_SIZE) as blob_reader:
+        if manifest["format"] == "tar.gz":
+            source, tar_mode = blob_reader, "r|gz"
+        else:
+            import zstandard  # pylint: disable=import-outside-toplevel
+            source = zstandard.ZstdDecompressor().stream_reader(blob_reader)
+            tar_mode = "r|"
+
+        with tarfile.open(fileobj=source, mode=tar_mode) as tar:
+            for member in tar:
+                _check_member(member)
+                tar.extract(member, path=str(local_dir_path))
+
+    logging.info(
+        "Extracted %d files (%d bytes) from gs://%s/%s in %.2fs",
+        manifest["files"], manifest["bytes"], gcs_bucket, blob.name,
+        time.monotonic() - start
+    )
+    record_transfer(objects=manifest["files"], bytes=manifest["bytes"])
+
+
+def save_snapshot(
+    local_dir_path,
+    destination_gcs_path: str,
+    snapshot_format: str = FILES_FORMAT,
+    max_workers: int = DEFAULT_MAX_WORKERS
+):
+    """Saves a local Dataform project to GCS in the requested format
+
+    Args:
+        local_dir_path (str): The path to the local directory.
+        destination_gcs_path (str): The path to the GCS location.
+        snapshot_format (str): One of SNAPSHOT_FORMATS
+        max_workers (int): Number of concurrent transfers for the "files" format
+    """
+    if snapshot_format == FILES_FORMAT:
+        # A leftover archive would shadow the files for the readers
+        remove_snapshot_archive(*split_gcs_path(destination_gcs_path))
+        sync_local_dir_to_gcs(local_dir_path, destination_gcs_path, max_workers)
+    else:
+        upload_dir_as_archive(local_dir_path, destination_gcs_path, snapshot_format)
+
+
+def load_snapshot(
+    gcs_bucket: str,
+    gcs_prefix: str,
+    local_destination_path: Path,
+    max_workers: int = DEFAULT_MAX_WORKERS
+) -> Path:
+    """Loads a Dataform project saved with save_snapshot, whatever its format
+
+    Args:
+        gcs_bucket (str): Name of the GCS bucket
+        gcs_prefix (str): Prefix where the project is saved
+        local_destination_path (Path): Local directory to download into
+        max_workers (int): Number of concurrent downloads for the "files" format
+
+    Returns:
+        Path: Local path of the project, <local_destination_path>/<gcs_prefix>
+    """
+    base_path = Path(local_destination_path / Path(gcs_prefix))
+    manifest = read_manifest(gcs_bucket, gcs_prefix)
+
+    if manifest is None:
+        download_gcs_prefix(gcs_bucket, gcs_prefix, local_destination_path, max_workers)
+    else:
+        extract_archive_from_gcs(gcs_bucket, gcs_prefix, manifest, base_path)
+
+    return base_path
@@ -1,9 +1,17 @@
 import argparse
-import os
+import atexit
+import json
+import logging
 from pathlib import Path
 import shutil
 
-from src.download_and_run_dataform import download_folder_from_gcs_and_return_base_path
+from src.change_detection import default_run_state_gcs_path
+from src.dataform_runner import DEFAULT_RUN_TIMEOUT_SECONDS
+from src.dataform_shards import plan_shards
+from src.dependency_cache import DEFAULT_CACHE_DIR, install_dependencies
+from src.download_and_run_dataform import load_dataform_project, run_dataform_project
+from src.gcs_transfer import DEFAULT_MAX_WORKERS
+from src.metrics import stage, write_summary
 
 
 if __name__ == "__main__":
@@ -30,16 +38,183 @@ if __name__ == "__main__":
         required=True
     )
 
+    parser.add_argument(
+        "--author",
+        help="Author of the run, prefixing the GCS prefix of the project",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--download-workers",
+        help="Number of files downloaded from GCS in parallel",
+        type=int,
+        default=DEFAULT_MAX_WORKERS
+    )
+
+    parser.add_argument(
+        "--handoff-dir",
+        help=(
+            "Directory shared with the loader (pipeline volume or input "
+            "artifact), used instead of GCS when it holds the project of the run"
+        ),
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--handoff-run-id",
+        help="ID of the pipeline run, which must have prepared the project",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--expected-commit",
+        help="Commit the project must have been built from",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--npm-cache-dir",
+        help="Local directory caching the node_modules of the project",
+        type=Path,
+        default=DEFAULT_CACHE_DIR
+    )
+
+    parser.add_argument(
+        "--npm-cache-gcs-path",
+        help="gs:// prefix caching the node_modules, shared between runs",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--tags",
+        help="Only runs (or plans) the actions with one of these tags",
+        type=str,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "--actions-json",
+        help="JSON list of the actions to run, e.g. one shard of --plan-shards",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--plan-shards",
+        help=(
+            "Instead of running the project, splits its actions into at most "
+            "this number of independent shards, written to --shards-output-path"
+        ),
+        type=int,
+    )
+
+    parser.add_argument(
+        "--shards-output-path",
+        help="File receiving the JSON list of shards, each a list of actions",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--graph-cache-gcs-path",
+        help=(
+            "gs:// prefix caching the compiled graphs, "
+            "gs://<input-gcs-bucket>/compiled-graphs by default"
+        ),
+        type=str,
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help=(
+            "Only runs the actions affected by the files changed since the "
+            "last successful run, as recorded by the loader with --incremental"
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--run-timeout-seconds",
+        help="Seconds after which `dataform run` is killed and the component fails",
+        type=float,
+        default=DEFAULT_RUN_TIMEOUT_SECONDS
+    )
+
+    parser.add_argument(
+        "--actions-output-path",
+        help=(
+            "File receiving the JSON list of the actions run, "
+            "with their status and estimated duration"
+        ),
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--metrics-output-path",
+        help="KFP metrics file receiving the duration and transfers of each stage",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--openmetrics-output-path",
+        help="File receiving the stage metrics in the OpenMetrics text format",
+        type=Path,
+    )
+
+    logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
+    if args.author:
+        args.input_gcs_prefix = f"{args.author}/{args.input_gcs_prefix}"
+    # Also written when the run fails
+    atexit.register(write_summary, args.metrics_output_path, args.openmetrics_output_path)
 
-    base_path: Path = download_folder_from_gcs_and_return_base_path(
-        project_id=args.project_id,
-        gcs_bucket=args.input_gcs_bucket,
-        gcs_prefix=args.input_gcs_prefix,
-        local_destination_path=Path("output")
+    with stage("download"):
+        base_path: Path = load_dataform_project(
+            project_id=args.project_id,
+            gcs_bucket=args.input_gcs_bucket,
+            gcs_prefix=args.input_gcs_prefix,
+            local_destination_path=Path("output"),
+            max_workers=args.download_workers,
+            handoff_dir=args.handoff_dir,
+            handoff_run_id=args.handoff_run_id,
+            expected_commit=args.expected_commit
+        )
+
+    with stage("install_dependencies"):
+        install_dependencies(
+            base_path,
+            cache_dir=args.npm_cache_dir,
+            gcs_cache_path=args.npm_cache_gcs_path
+        )
+
+    graph_cache_gcs_path = (
+        args.graph_cache_gcs_path or f"gs://{args.input_gcs_bucket}/compiled-graphs"
     )
 
-    os.system(f"cd {str(base_path)} && npm install && dataform run")
+    if args.plan_shards:
+        with stage("plan_shards"):
+            shards = plan_shards(
+                base_path, args.plan_shards, args.tags,
+                graph_cache_gcs_path=graph_cache_gcs_path
+            )
+        logging.info("Planned %d shards: %s", len(shards), shards)
+        args.shards_output_path.parent.mkdir(parents=True, exist_ok=True)
+        args.shards_output_path.write_text(json.dumps(shards))
+    else:
+        action_results = run_dataform_project(
+            base_path,
+            graph_cache_gcs_path,
+            actions=json.loads(args.actions_json) if args.actions_json else None,
+            tags=args.tags,
+            run_state_gcs_path=(
+                default_run_state_gcs_path(args.input_gcs_bucket, args.input_gcs_prefix)
+                if args.incremental else None
+            ),
+            run_timeout_seconds=args.run_timeout_seconds
+        )
+
+        # Written even when nothing ran, KFP requires the declared outputs
+        if args.actions_output_path:
+            args.actions_output_path.parent.mkdir(parents=True, exist_ok=True)
+            args.actions_output_path.write_text(json.dumps(action_results))
 
     if base_path.exists() and base_path.is_dir():
         shutil.rmtree(base_path)
@@ -0,0 +1,276 @@
+"""
+Contains helpers to run npm and the Dataform CLI as managed subprocesses.
+
+The output of a command is forwarded to the logs line by line while it
+runs, a non-zero exit status raises CalledProcessError, and the command,
+with its children, is killed once its timeout expires.
+
+`dataform run` has no machine-readable output: `--json` only applies to
+the compiled graph and to dry runs, and the result of each action is printed
+as a line of text, without timings. The outcome of an action is therefore
+parsed from that line, and its duration is only estimated from the moment the
+line is printed: the action is assumed to start when the last of its
+dependencies in the run finished, or when the run started. The estimate
+includes the time the action waited for a free connection.
+"""
+
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence
+
+DEFAULT_RUN_TIMEOUT_SECONDS = 4 * 60 * 60
+DEFAULT_NPM_TIMEOUT_SECONDS = 15 * 60
+
+# Time given to a command to exit after SIGTERM, before it is killed
+TERMINATE_GRACE_SECONDS = 10
+
+# Number of actions listed in the summary of a run
+SLOWEST_ACTIONS_LOGGED = 5
+
+_ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+# Human-readable result lines of the CLI, e.g. "Table created:  dataset.table [table]",
+# "Assertion failed:  dataset.check". To be revisited when upgrading the CLI
+_ACTION_RESULT = re.compile(
+    r"^(?P<label>(?:Table|View|Incremental table|Assertion|Operation|Declaration|Skipping)"
+    r"[\w ]*?):\s+(?P<target>[^\s\[]+)"
+)
+
+
+@dataclass
+class ActionResult:
+    """Outcome of an action of a Dataform run."""
+
+    name: str
+    status: str
+    # Since the start of the run, when its result line was printed
+    finished_after_seconds: float
+    # Inferred from the dependencies of the action, not reported by Dataform,
+    # see the module docstring. None when the dependencies are unknown
+    estimated_seconds: Optional[float] = None
+
+
+@dataclass
+class DataformRunResult:
+    """Outcome of a Dataform run."""
+
+    seconds: float
+    actions: List[ActionResult] = field(default_factory=list)
+
+    def slowest_actions(self, count: int = SLOWEST_ACTIONS_LOGGED) -> List[ActionResult]:
+        timed_actions = [
+            action for action in self.actions if action.estimated_seconds is not None
+        ]
+        return sorted(
+            timed_actions, key=lambda action: action.estimated_seconds, reverse=True
+        )[:count]
+
+
+def _terminate(process: subprocess.Popen):
+    """Stops the process group of the command, forcefully if it does not exit"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.wait(TERMINATE_GRACE_SECONDS)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def _forward_output(stream, name: str, on_line: Optional[Callable[[str], None]]):
+    for line in stream:
+        line = _ANSI_ESCAPE.sub("", line.rstrip("\n"))
+        logging.info("[%s] %s", name, line)
+        if on_line is None:
+            continue
+        try:
+            on_line(line)
+        except Exception:  # pylint: disable=broad-except
+            # The output must keep being read, or the command would block
+            logging.exception("Cannot process output line of %s", name)
+
+
+def run_command(
+    command: Sequence[str],
+    cwd: Optional[Path] = None,
+    timeout: Optional[float] = None,
+    on_line: Optional[Callable[[str], None]] = None,
+    env: Optional[Dict[str, str]] = None
+):
+    """Runs a command, forwarding its output (stdout and stderr) to the logs
+
+    Args:
+        command (Sequence[str]): Executable and arguments, not run through a shell
+        cwd (Path): Working directory of the command
+        timeout (float): Seconds after which the command is killed. No limit if None
+        on_line (Callable[[str], None]): Also called with each line of output
+        env (Dict[str, str]): Variables added to the environment of the command
+
+    Raises:
+        subprocess.CalledProcessError: If the command exits with a non-zero status
+        subprocess.TimeoutExpired: If the command was killed after the timeout
+    """
+    command = [str(arg) for arg in command]
+    name = Path(command[0]).name
+    start = time.monotonic()
+    process = subprocess.Popen(
+        command,
+        cwd=str(cwd) if cwd else None,
+        env={**os.environ, **(env or {})},
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors="replace",
+        bufsize=1,
+        # Own process group, so that the children of npm / dataform are stopped too
+        start_new_session=True,
+    )
+    reader = threading.Thread(
+        target=_forward_output, args=(process.stdout, name, on_line), daemon=True
+    )
+    reader.start()
+
+    try:
+        returncode = process.wait(timeout)
+    except BaseException:
+        logging.error("Stopping %s after %.2fs", name, time.monotonic() - start)
+        _terminate(process)
+        raise
+    finally:
+        # A leftover grandchild may keep the output open
+        reader.join(TERMINATE_GRACE_SECONDS)
+
+    logging.info(
+        "%s exited with status %d in %.2fs", name, returncode, time.monotonic() - start
+    )
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+class _ActionTracker:
+    """Turns the result lines of `dataform run` into ActionResults"""
+
+    def __init__(self, dependencies: Optional[Dict[str, List[str]]], start: float):
+        self.dependencies = dependencies
+        self.start = start
+        self.finished: Dict[str, float] = {}
+        self.actions: List[ActionResult] = []
+
+    def _action_name(self, target: str) -> str:
+        # Lines name the schema and table, action names may include the database
+        if self.dependencies is None or target in self.dependencies:
+            return target
+        suffix = f".{target}"
+        return next(
+            (name for name in self.dependencies if name.endswith(suffix)), target
+        )
+
+    def on_line(self, line: str):
+        """Records the action whose result is printed on the line, if any"""
+        match = _ACTION_RESULT.match(line.strip())
+        if not match:
+            return
+
+        label = match["label"].lower()
+        if "failed" in label:
+            status = "failed"
+        elif label.startswith("skipping"):
+            status = "skipped"
+        else:
+            status = "successful"
+
+        name = self._action_name(match["target"])
+        finished = time.monotonic() - self.start
+        estimated_seconds = None
+        if self.dependencies is not None:
+            started = max(
+                (
+                    self.finished[dependency]
+                    for dependency in self.dependencies.get(name, [])
+                    if dependency in self.finished
+                ),
+                default=0.0
+            )
+            estimated_seconds = round(finished - started, 3)
+        self.finished[name] = finished
+
+        action = ActionResult(name, status, round(finished, 3), estimated_seconds)
+        self.actions.append(action)
+        logging.info(json.dumps({"event": "dataform_action", **asdict(action)}))
+
+
+def run_dataform(
+    project_dir: Path,
+    dataform: str = "dataform",
+    actions: Optional[Sequence[str]] = None,
+    tags: Optional[Sequence[str]] = None,
+    dependencies: Optional[Dict[str, List[str]]] = None,
+    timeout: Optional[float] = DEFAULT_RUN_TIMEOUT_SECONDS
+) -> DataformRunResult:
+    """Runs `dataform run` on the project and estimates the duration of each
+    of its actions
+
+    Args:
+        project_dir (Path): Path of the Dataform project, with its credentials
+        dataform (str): Dataform CLI executable
+        actions (Sequence[str]): Only runs these actions. Takes precedence over tags
+        tags (Sequence[str]): Only runs the actions with one of these tags
+        dependencies (Dict[str, List[str]]): Dependencies of the actions, see
+            dataform_shards.action_dependencies, from which the duration of
+            each action is estimated. Without them, only the time at which
+            each action finished is known
+        timeout (float): Seconds after which the run is killed. No limit if None
+
+    Returns:
+        DataformRunResult: Duration of the run and estimated duration of each action
+
+    Raises:
+        subprocess.CalledProcessError: If the run fails
+        subprocess.TimeoutExpired: If the run was killed after the timeout
+    """
+    command = [dataform, "run"]
+    if actions is not None:
+        command += ["--actions", *actions]
+    elif tags:
+        command += ["--tags", *tags]
+
+    start = time.monotonic()
+    tracker = _ActionTracker(dependencies, start)
+    try:
+        run_command(
+            command,
+            cwd=project_dir,
+            timeout=timeout,
+            on_line=tracker.on_line,
+            env={"NO_COLOR": "1", "FORCE_COLOR": "0"}
+        )
+    except subprocess.CalledProcessError:
+        failed = [action.name for action in tracker.actions if action.status == "failed"]
+        logging.error(
+            "Dataform run failed after %d finished actions, failed actions: %s",
+            len(tracker.actions), failed or "none reported"
+        )
+        raise
+
+    result = DataformRunResult(round(time.monotonic() - start, 3), tracker.actions)
+    logging.info(
+        "Dataform ran %d actions in %.2fs, slowest (estimated): %s",
+        len(result.actions), result.seconds,
+        ", ".join(
+            f"{action.name} (~{action.estimated_seconds:.1f}s)"
+            for action in result.slowest_actions()
+        )
+        or "unknown"
+    )
+    return result
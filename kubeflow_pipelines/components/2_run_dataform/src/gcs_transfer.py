@@ -0,0 +1,500 @@
+"""
+Contains helpers to transfer directories between local disk and Google Cloud Storage
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import requests
+from google.api_core import exceptions
+from google.auth.exceptions import TransportError
+from google.cloud import storage
+
+from .metrics import record_transfer
+
+DEFAULT_MAX_WORKERS = 32
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_SECONDS = 0.5
+
+# Object stored next to the synced files, describing them by path
+SYNC_MANIFEST_NAME = ".gcs-sync-manifest.json"
+
+RETRYABLE_EXCEPTIONS = (
+    exceptions.TooManyRequests,
+    exceptions.ServerError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    TransportError,
+)
+
+_client: Optional[storage.Client] = None
+# Size of the connection pool mounted on the session of the client
+_pool_size = 0
+_client_lock = threading.Lock()
+
+
+@dataclass
+class TransferSummary:
+    """Statistics of a directory transfer."""
+
+    files: int = 0
+    bytes: int = 0
+    retries: int = 0
+    seconds: float = 0.0
+    skipped: int = 0
+    deleted: int = 0
+
+    def log(self, action: str, location: str):
+        """Logs the summary in a single line
+
+        Args:
+            action (str): Name of the transfer, e.g. "Uploaded"
+            location (str): Source or destination of the transfer
+        """
+        throughput = self.bytes / self.seconds / 1024 / 1024 if self.seconds else 0.0
+        logging.info(
+            "%s %d files (%d bytes) %s in %.2fs (%.2f MiB/s, %d retries, "
+            "%d unchanged, %d deleted)",
+            action, self.files, self.bytes, location,
+            self.seconds, throughput, self.retries, self.skipped, self.deleted
+        )
+        record_transfer(self.files + self.deleted, self.bytes, self.retries)
+
+
+def get_storage_client(max_workers: int = DEFAULT_MAX_WORKERS) -> storage.Client:
+    """Returns a process-wide storage client, creating it on first use.
+
+    The HTTP connection pool is sized to the number of workers, so that
+    concurrent transfers reuse connections instead of opening new ones. It
+    is only replaced when more workers than its size are requested, as the
+    connections of the previous pool are dropped.
+
+    Args:
+        max_workers (int): Number of threads that will share the client
+
+    Returns:
+        storage.Client: The shared client
+    """
+    global _client, _pool_size  # pylint: disable=global-statement
+
+    with _client_lock:
+        if _client is None:
+            _client = storage.Client()
+            _pool_size = 0
+        if max_workers <= _pool_size:
+            return _client
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_workers,
+            pool_maxsize=max_workers
+        )
+        # pylint: disable=protected-access
+        _client._http.mount("https://", adapter)
+        # Endpoints set through STORAGE_EMULATOR_HOST are usually plain HTTP
+        _client._http.mount("http://", adapter)
+        _pool_size = max_workers
+
+    return _client
+
+
+def split_gcs_path(gcs_path: str) -> Tuple[str, str]:
+    """Splits a gs://bucket/prefix path into bucket and prefix
+
+    Args:
+        gcs_path (str): Full GCS path
+
+    Returns:
+        Tuple[str, str]: The bucket name and the prefix without trailing slash
+    """
+    bucket_name, _, prefix = gcs_path.replace("gs://", "", 1).partition("/")
+    return bucket_name, prefix.strip("/")
+
+
+def call_with_retries(
+    func: Callable,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff_seconds: float = DEFAULT_BACKOFF_SECONDS
+):
+    """Calls func, retrying transient errors with exponential backoff and jitter
+
+    Args:
+        func (Callable): Function without arguments to call
+        max_retries (int): Number of retries before the error is raised
+        backoff_seconds (float): Delay before the first retry
+
+    Returns:
+        Tuple: The result of func and the number of retries needed
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(), attempt
+        except RETRYABLE_EXCEPTIONS as error:
+            if attempt == max_retries:
+                raise
+
+            delay = backoff_seconds * (2 ** attempt) * (1 + random.random())
+            logging.warning("Retrying in %.2fs after error: %s", delay, error)
+            time.sleep(delay)
+
+
+def run_bounded(
+    func: Callable,
+    items: Iterable,
+    max_workers: int = DEFAULT_MAX_WORKERS
+):
+    """Applies func to every item in a thread pool, keeping at most
+    2 * max_workers items in flight so that large inputs are consumed lazily.
+
+    Args:
+        func (Callable): Function applied on each item
+        items (Iterable): Items to process, can be a generator
+        max_workers (int): Number of threads
+
+    Yields:
+        The result of func for every item, in completion order
+    """
+    max_in_flight = 2 * max_workers
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(func, item))
+
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        for future in wait(pending).done:
+            yield future.result()
+
+
+def iterate_local_files(local_dir_path: Path):
+    """Recursively yields all the files under a local directory
+
+    Args:
+        local_dir_path (Path): The path to the local directory.
+
+    Yields:
+        Path: Path of each file
+    """
+    for root, _, file_names in os.walk(local_dir_path):
+        for file_name in file_names:
+            yield Path(root) / file_name
+
+
+def _join_blob_name(prefix: str, relative_path: str) -> str:
+    return f"{prefix}/{relative_path}" if prefix else relative_path
+
+
+def _listing_prefix(prefix: str) -> str:
+    # Without the trailing slash, "folder" would also list "folder_2/..."
+    prefix = prefix.strip("/")
+    return f"{prefix}/" if prefix else ""
+
+
+def _is_synced_object(blob_name: str, listing_prefix: str) -> bool:
+    return not (
+        blob_name.endswith("/")
+        or blob_name[len(listing_prefix):] == SYNC_MANIFEST_NAME
+    )
+
+
+def upload_local_dir_to_gcs(
+    local_dir_path,
+    destination_gcs_path: str,
+    max_workers: int = DEFAULT_MAX_WORKERS
+) -> TransferSummary:
+    """Upload the contents of a local directory to GCS, in parallel
+
+    Note: The structure of the local directory is replicated on Cloud Storage.
+
+    Args:
+        local_dir_path (str): The path to the local directory.
+        destination_gcs_path (str): The path to the GCS location.
+        max_workers (int): Number of concurrent uploads
+
+    Returns:
+        TransferSummary: Number of files, bytes, retries and duration
+    """
+    local_dir_path = Path(local_dir_path)
+    bucket_name, prefix = split_gcs_path(destination_gcs_path)
+    bucket = get_storage_client(max_workers).bucket(bucket_name)
+
+    def upload_file(path_to_file: Path):
+        relative_path = path_to_file.relative_to(local_dir_path).as_posix()
+        blob_name = _join_blob_name(prefix, relative_path)
+        blob = bucket.blob(blob_name)
+        _, retries = call_with_retries(
+            lambda: blob.upload_from_filename(str(path_to_file))
+        )
+        logging.debug("Uploaded: %s -> gs://%s/%s", path_to_file, bucket_name, blob_name)
+        return path_to_file.stat().st_size, retries
+
+    summary = TransferSummary()
+    start = time.monotonic()
+    for size, retries in run_bounded(
+        upload_file, iterate_local_files(local_dir_path), max_workers
+    ):
+        summary.files += 1
+        summary.bytes += size
+        summary.retries += retries
+    summary.seconds = time.monotonic() - start
+
+    summary.log("Uploaded", f"to {destination_gcs_path}")
+    return summary
+
+
+def download_gcs_prefix(
+    gcs_bucket: str,
+    gcs_prefix: str,
+    local_destination_path: Path,
+    max_workers: int = DEFAULT_MAX_WORKERS
+) -> TransferSummary:
+    """Downloads all the objects under a GCS prefix, in parallel
+
+    Listing pages are consumed as they arrive: the directories of each page
+    are created once, then its objects are handed to the worker pool, so
+    downloads start before the listing is complete.
+
+    Note: The structure of the GCS prefix is replicated under
+    local_destination_path, including the prefix itself. The sync manifest
+    is left out.
+
+    Args:
+        gcs_bucket (str): Name of the GCS bucket
+        gcs_prefix (str): Prefix of the objects to download
+        local_destination_path (Path): Local directory to download into
+        max_workers (int): Number of concurrent downloads
+
+    Returns:
+        TransferSummary: Number of files, bytes, retries and duration
+    """
+    local_destination_path = Path(local_destination_path)
+    client = get_storage_client(max_workers)
+    listing_prefix = _listing_prefix(gcs_prefix)
+    created_dirs = set()
+
+    def iterate_blobs():
+        blobs = client.list_blobs(gcs_bucket, prefix=listing_prefix)
+        for page in blobs.pages:
+            page_blobs = [
+                blob for blob in page if _is_synced_object(blob.name, listing_prefix)
+            ]
+
+            for blob in page_blobs:
+                parent = (local_destination_path / blob.name).parent
+                if parent not in created_dirs:
+                    parent.mkdir(parents=True, exist_ok=True)
+                    created_dirs.add(parent)
+
+            yield from page_blobs
+
+    def download_blob(blob: storage.Blob):
+        file_path = local_destination_path / blob.name
+        _, retries = call_with_retries(
+            lambda: blob.download_to_filename(str(file_path))
+        )
+        return blob.size or 0, retries
+
+    summary = TransferSummary()
+    start = time.monotonic()
+    for size, retries in run_bounded(download_blob, iterate_blobs(), max_workers):
+        summary.files += 1
+        summary.bytes += size
+        summary.retries += retries
+    summary.seconds = time.monotonic() - start
+
+    summary.log("Downloaded", f"from gs://{gcs_bucket}/{gcs_prefix}")
+    return summary
+
+
+def compute_md5(path_to_file: Path) -> str:
+    """Computes the MD5 of a file, base64-encoded like the GCS md5Hash
+
+    Args:
+        path_to_file (Path): Path of the file
+
+    Returns:
+        str: The base64-encoded MD5 digest
+    """
+    md5 = hashlib.md5()
+    with open(path_to_file, "rb") as file_obj:
+        for chunk in iter(lambda: file_obj.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode("utf-8")
+
+
+def build_local_manifest(
+    local_dir_path: Path,
+    max_workers: int = DEFAULT_MAX_WORKERS
+) -> Dict[str, dict]:
+    """Describes every file under a local directory by size and MD5
+
+    Args:
+        local_dir_path (Path): The path to the local directory.
+        max_workers (int): Number of files hashed in parallel
+
+    Returns:
+        Dict[str, dict]: Relative POSIX path -> {"size": int, "md5": str}
+    """
+    local_dir_path = Path(local_dir_path)
+
+    def describe_file(path_to_file: Path):
+        relative_path = path_to_file.relative_to(local_dir_path).as_posix()
+        return relative_path, {
+            "size": path_to_file.stat().st_size,
+            "md5": compute_md5(path_to_file),
+        }
+
+    return dict(
+        run_bounded(describe_file, iterate_local_files(local_dir_path), max_workers)
+    )
+
+
+def read_remote_manifest(
+    bucket: storage.Bucket,
+    prefix: str
+) -> Optional[Dict[str, dict]]:
+    """Reads the sync manifest stored under the prefix
+
+    Args:
+        bucket (storage.Bucket): Bucket of the prefix
+        prefix (str): Prefix of the synced directory
+
+    Returns:
+        Optional[Dict[str, dict]]: Relative POSIX path -> {"size": int, "md5": str},
+            or None if the prefix has no manifest
+    """
+    manifest_blob = bucket.blob(_join_blob_name(prefix, SYNC_MANIFEST_NAME))
+    try:
+        return json.loads(manifest_blob.download_as_bytes())
+    except exceptions.NotFound:
+        return None
+
+
+def read_current_remote_manifest(
+    bucket: storage.Bucket,
+    prefix: str
+) -> Tuple[Dict[str, dict], bool]:
+    """Describes the objects under the prefix from its sync manifest, or from
+    their listing when the manifest is missing or older than the newest object,
+    e.g. after an object was written without going through sync_local_dir_to_gcs
+
+    Args:
+        bucket (storage.Bucket): Bucket of the prefix
+        prefix (str): Prefix of the synced directory
+
+    Returns:
+        Tuple[Dict[str, dict], bool]: Relative POSIX path -> {"size": int, "md5": str},
+            and whether it comes from an up to date manifest
+    """
+    listing_prefix = _listing_prefix(prefix)
+    manifest_name = _join_blob_name(prefix, SYNC_MANIFEST_NAME)
+    manifest_blob = None
+    blobs = []
+    for blob in bucket.list_blobs(prefix=listing_prefix):
+        if blob.name == manifest_name:
+            manifest_blob = blob
+        elif _is_synced_object(blob.name, listing_prefix):
+            blobs.append(blob)
+
+    if manifest_blob is not None:
+        newest_update = max((blob.updated for blob in blobs), default=None)
+        if newest_update is None or manifest_blob.updated >= newest_update:
+            remote_manifest = read_remote_manifest(bucket, prefix)
+            if remote_manifest is not None:
+                return remote_manifest, True
+        else:
+            logging.warning(
+                "Sync manifest of gs://%s/%s is older than its objects, comparing "
+                "with their listing instead", bucket.name, prefix
+            )
+    return {
+        blob.name[len(listing_prefix):]: {"size": blob.size, "md5": blob.md5_hash}
+        for blob in blobs
+    }, False
+
+
+def sync_local_dir_to_gcs(
+    local_dir_path,
+    destination_gcs_path: str,
+    max_workers: int = DEFAULT_MAX_WORKERS
+) -> TransferSummary:
+    """Makes the GCS location mirror a local directory, transferring only
+    the files whose size or MD5 differ from the remote manifest and
+    deleting the objects that no longer exist locally.
+
+    Note: The manifest is written last, so an interrupted sync is
+    completed by the next one. Objects changed on GCS without going
+    through this function make the manifest stale, in which case the
+    objects are compared by their listing instead.
+
+    Args:
+        local_dir_path (str): The path to the local directory.
+        destination_gcs_path (str): The path to the GCS location.
+        max_workers (int): Number of concurrent hashes, uploads and deletes
+
+    Returns:
+        TransferSummary: Number of files, bytes, retries and duration
+    """
+    local_dir_path = Path(local_dir_path)
+    bucket_name, prefix = split_gcs_path(destination_gcs_path)
+    bucket = get_storage_client(max_workers).bucket(bucket_name)
+
+    start = time.monotonic()
+    local_manifest = build_local_manifest(local_dir_path, max_workers)
+    remote_manifest, manifest_is_current = read_current_remote_manifest(bucket, prefix)
+
+    changed_paths = [
+        relative_path for relative_path, entry in local_manifest.items()
+        if remote_manifest.get(relative_path) != entry
+    ]
+    stale_paths = [
+        relative_path for relative_path in remote_manifest
+        if relative_path not in local_manifest
+    ]
+
+    def upload_file(relative_path: str):
+        blob = bucket.blob(_join_blob_name(prefix, relative_path))
+        _, retries = call_with_retries(
+            lambda: blob.upload_from_filename(str(local_dir_path / relative_path))
+        )
+        return local_manifest[relative_path]["size"], retries
+
+    def delete_blob(relative_path: str):
+        blob = bucket.blob(_join_blob_name(prefix, relative_path))
+        try:
+            _, retries = call_with_retries(blob.delete)
+        except exceptions.NotFound:
+            retries = 0
+        return retries
+
+    summary = TransferSummary(skipped=len(local_manifest) - len(changed_paths))
+    for size, retries in run_bounded(upload_file, changed_paths, max_workers):
+        summary.files += 1
+        summary.bytes += size
+        summary.retries += retries
+    for retries in run_bounded(delete_blob, stale_paths, max_workers):
+        summary.deleted += 1
+        summary.retries += retries
+
+    if changed_paths or stale_paths or not manifest_is_current:
+        bucket.blob(_join_blob_name(prefix, SYNC_MANIFEST_NAME)).upload_from_string(
+            json.dumps(local_manifest, sort_keys=True),
+            content_type="application/json"
+        )
+    summary.seconds = time.monotonic() - start
+
+    summary.log("Synced", f"to {destination_gcs_path}")
+    return summary
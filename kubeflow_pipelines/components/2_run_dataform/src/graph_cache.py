@@ -0,0 +1,221 @@
+"""
+Contains helpers to compile a Dataform project once per configuration and
+reuse the compiled graph afterwards.
+
+The loader records the commit and the hash of the Dataform variables of the
+project in a build info file saved along with it. Consumers of the compiled
+graph (shard planning, change detection...) look it up on GCS under that
+key and the version of their Dataform CLI, and only run `dataform compile`
+when it is missing.
+"""
+
+import hashlib
+import json
+import logging
+import subprocess
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from google.api_core import exceptions
+
+from .gcs_transfer import get_storage_client, split_gcs_path
+
+BUILD_INFO_NAME = ".dataform-build.json"
+
+
+def hash_vars(dataform_vars: dict) -> str:
+    """Returns a stable hash of Dataform variables, whatever their order
+
+    Args:
+        dataform_vars (dict): The variables
+
+    Returns:
+        str: The hash
+    """
+    serialized = json.dumps(dataform_vars, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def hash_dataform_vars(dataform_json_path: Path) -> str:
+    """Returns a stable hash of the variables of dataform.json
+
+    Args:
+        dataform_json_path (Path): Path of dataform.json
+
+    Returns:
+        str: The hash
+    """
+    with open(dataform_json_path) as json_file:
+        return hash_vars(json.load(json_file).get("vars", {}))
+
+
+def write_build_info(project_dir: Path, vars_hash: Optional[str] = None) -> dict:
+    """Records the commit and the variables of the project in its build info file
+
+    Args:
+        project_dir (Path): Path of the cloned Dataform project
+        vars_hash (str): Hash of the variables, e.g. as returned by
+            patch_dataform_vars. Computed from dataform.json when None
+
+    Returns:
+        dict: The build info, with the "key" of the project, see graph_cache_key
+    """
+    project_dir = Path(project_dir)
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        cwd=str(project_dir), check=True, capture_output=True, text=True
+    ).stdout.strip()
+    if vars_hash is None:
+        vars_hash = hash_dataform_vars(project_dir / "dataform.json")
+
+    build_info = {
+        "commit": commit,
+        "vars_hash": vars_hash,
+        "key": f"{commit}-{vars_hash[:16]}",
+    }
+    (project_dir / BUILD_INFO_NAME).write_text(json.dumps(build_info, indent=4))
+    return build_info
+
+
+def read_build_info(project_dir: Path) -> Optional[dict]:
+    """Reads the build info file of the project
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+
+    Returns:
+        Optional[dict]: The build info, None if the project has none
+    """
+    build_info_path = Path(project_dir) / BUILD_INFO_NAME
+    if not build_info_path.exists():
+        return None
+    return json.loads(build_info_path.read_text())
+
+
+@lru_cache(maxsize=None)
+def dataform_cli_version(dataform: str = "dataform") -> str:
+    """Returns the version of the Dataform CLI
+
+    Args:
+        dataform (str): Dataform CLI executable
+
+    Returns:
+        str: The version, as printed by `dataform --version`
+    """
+    return subprocess.run(
+        [dataform, "--version"], check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+def graph_cache_key(build_info: dict, cli_version: str) -> str:
+    """Returns the key of the compiled graph of a project
+
+    Args:
+        build_info (dict): Build info of the project, see write_build_info
+        cli_version (str): Version of the Dataform CLI compiling it, as
+            graphs compiled by other versions may differ
+
+    Returns:
+        str: The key
+    """
+    return f"{build_info['key']}-dataform-{cli_version}"
+
+
+def compile_graph(project_dir: Path, dataform: str = "dataform") -> dict:
+    """Compiles the Dataform project
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        dataform (str): Dataform CLI executable
+
+    Returns:
+        dict: The compiled graph, as printed by `dataform compile --json`
+    """
+    result = subprocess.run(
+        [dataform, "compile", "--json"],
+        cwd=str(project_dir), check=True, capture_output=True, text=True
+    )
+    return json.loads(result.stdout)
+
+
+def _graph_blob(project_dir: Path, gcs_cache_path: Optional[str], dataform: str):
+    """Returns the cache blob of the compiled graph of the project, None
+    without cache or build info. Records the version of the Dataform CLI
+    compiling the project in its build info"""
+    build_info = read_build_info(project_dir)
+    if not gcs_cache_path or not build_info:
+        return None
+
+    cli_version = dataform_cli_version(dataform)
+    if build_info.get("dataform_cli_version") != cli_version:
+        build_info["dataform_cli_version"] = cli_version
+        (Path(project_dir) / BUILD_INFO_NAME).write_text(json.dumps(build_info, indent=4))
+
+    bucket_name, prefix = split_gcs_path(gcs_cache_path)
+    return get_storage_client().bucket(bucket_name).blob(
+        f"{prefix}/{graph_cache_key(build_info, cli_version)}.json"
+    )
+
+
+def _download_graph(blob) -> Optional[dict]:
+    start = time.monotonic()
+    try:
+        graph = json.loads(blob.download_as_bytes())
+    except exceptions.NotFound:
+        return None
+    logging.info("Reused compiled graph %s in %.2fs", blob.name, time.monotonic() - start)
+    return graph
+
+
+def find_cached_graph(
+    project_dir: Path,
+    gcs_cache_path: Optional[str] = None,
+    dataform: str = "dataform"
+) -> Optional[dict]:
+    """Returns the compiled graph of the project if it is cached, without
+    ever compiling it
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        gcs_cache_path (str): gs:// prefix of the cache. No cache when None
+        dataform (str): Dataform CLI executable
+
+    Returns:
+        Optional[dict]: The compiled graph, None if it is not cached
+    """
+    blob = _graph_blob(project_dir, gcs_cache_path, dataform)
+    return None if blob is None else _download_graph(blob)
+
+
+def load_compiled_graph(
+    project_dir: Path,
+    gcs_cache_path: Optional[str] = None,
+    dataform: str = "dataform"
+) -> dict:
+    """Returns the compiled graph of the project, from the cache when its
+    build info and CLI version match an entry, otherwise by compiling it and
+    caching the result
+
+    Args:
+        project_dir (Path): Path of the Dataform project
+        gcs_cache_path (str): gs:// prefix of the cache. No cache when None
+        dataform (str): Dataform CLI executable
+
+    Returns:
+        dict: The compiled graph
+    """
+    blob = _graph_blob(project_dir, gcs_cache_path, dataform)
+    if blob is not None:
+        graph = _download_graph(blob)
+        if graph is not None:
+            return graph
+
+    start = time.monotonic()
+    graph = compile_graph(project_dir, dataform)
+    if blob is not None:
+        blob.upload_from_string(json.dumps(graph), content_type="application/json")
+
+    logging.info("Compiled the project in %.2fs", time.monotonic() - start)
+    return graph
@@ -1,35 +1,106 @@
 """
 Contains helpers to manage Google Secret Manager
+
+The Secret Manager client is created once per process and secret payloads
+are cached in memory, so that warm Cloud Function instances and long-lived
+workers do not pay the gRPC channel setup and an RPC on every access.
 """
 
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
 from google.cloud import secretmanager
 
+# How long a secret fetched through the "latest" alias is reused
+DEFAULT_TTL_SECONDS = 300
+
+_client: Optional[secretmanager.SecretManagerServiceClient] = None
+_client_lock = threading.Lock()
+
+# (project, secret, version) -> (expiry as time.monotonic(), payload)
+_cache: Dict[Tuple[str, str, str], Tuple[float, str]] = {}
+_cache_lock = threading.Lock()
+
+
+def get_client() -> secretmanager.SecretManagerServiceClient:
+    """Returns the process-wide Secret Manager client, creating it on first use"""
+    global _client  # pylint: disable=global-statement
+
+    with _client_lock:
+        if _client is None:
+            _client = secretmanager.SecretManagerServiceClient()
+    return _client
+
 
 class SecretManagerHelper:
-    # pylint: disable=too-few-public-methods
     """Wrapper around Google Secret Manager."""
 
     project_id: str
-    client: secretmanager.SecretManagerServiceClient
+    ttl_seconds: float
 
-    def __init__(self, project_id: str):
-        """Sets project and instantiates Secret Manager client"""
+    def __init__(self, project_id: str, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        """Sets project and cache duration of the secrets"""
         self.project_id = project_id
-        self.client = secretmanager.SecretManagerServiceClient()
+        self.ttl_seconds = ttl_seconds
+
+    @property
+    def client(self) -> secretmanager.SecretManagerServiceClient:
+        return get_client()
 
-    def get_secret(self, secret_name: str) -> str:
+    def get_secret(self, secret_name: str, version: str = "latest") -> str:
         """Using the secret name, fetches the secret value
 
+        Values are served from the in-memory cache when possible. Pinned
+        versions are immutable and cached for the lifetime of the process,
+        while the "latest" alias is refreshed after ttl_seconds.
+
         Args:
             secret_name (str): The name of the secret as defined in
                 Google Secret Manager
+            version (str): Version of the secret, "latest" by default
 
         Returns:
             str: The value stored in the secret
         """
+        key = (self.project_id, secret_name, version)
+        now = time.monotonic()
+
+        with _cache_lock:
+            cached = _cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
         name = (
-            f"projects/{self.project_id}/secrets/{secret_name}/versions/latest"
+            f"projects/{self.project_id}/secrets/{secret_name}/versions/{version}"
         )
 
         response = self.client.access_secret_version(request={"name": name})
-        return response.payload.data.decode("UTF-8")
+        payload = response.payload.data.decode("UTF-8")
+
+        expiry = float("inf") if version != "latest" else now + self.ttl_seconds
+        with _cache_lock:
+            _cache[key] = (expiry, payload)
+        return payload
+
+    def invalidate(self, secret_name: Optional[str] = None):
+        """Drops cached values, e.g. after a secret has been rotated
+
+        Args:
+            secret_name (str): Secret to drop. All the secrets of the
+                project are dropped when None
+        """
+        with _cache_lock:
+            for key in list(_cache):
+                if key[0] == self.project_id and secret_name in (None, key[1]):
+                    del _cache[key]
+
+    def prewarm(self, *secret_names: str):
+        """Creates the client and caches the given secrets ahead of their use
+
+        Args:
+            secret_names (str): Names of the secrets to fetch
+        """
+        for secret_name in secret_names:
+            self.get_secret(secret_name)
+        get_client()
@@ -0,0 +1,228 @@
+import argparse
+import atexit
+import json
+import logging
+from pathlib import Path
+
+from src.clone_and_run import clone_and_run_dataform
+from src.dataform_runner import DEFAULT_RUN_TIMEOUT_SECONDS
+from src.dependency_cache import DEFAULT_CACHE_DIR
+from src.gcs_transfer import DEFAULT_MAX_WORKERS
+from src.git_cache import CloneOptions
+from src.metrics import write_summary
+from src.snapshot import FILES_FORMAT, SNAPSHOT_FORMATS
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--project-id",
+        help="GCP_PROJECT_ID",
+        type=str,
+        required=True
+    )
+
+    parser.add_argument(
+        "--repo-url",
+        help="Github URL containing the Dataform Code",
+        type=str,
+        required=True
+    )
+
+    parser.add_argument(
+        "--repo-ref",
+        help="Branch, tag or commit to check out. Defaults to the remote HEAD",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--git-cache-dir",
+        help="Directory holding bare mirrors of the cloned repositories",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--git-bundle-gcs-path",
+        help="gs:// path of a git bundle used to seed and persist the mirror",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--clone-depth",
+        help="History depth of the clone, when no mirror is used",
+        type=int,
+    )
+
+    parser.add_argument(
+        "--clone-filter",
+        help="Partial clone filter (e.g. blob:none), when no mirror is used",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--example-value",
+        help="Example value",
+        type=str,
+        required=True
+    )
+
+    parser.add_argument(
+        "--gcs-bucket",
+        help="GCS bucket of the run state, caches and audit copy",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--gcs-prefix",
+        help="GCS prefix of the run state and audit copy",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--author",
+        help="Author of the run, prefixing the GCS prefix of the project",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--save-audit-copy",
+        help=(
+            "Also saves the project on gs://<gcs-bucket>/<gcs-prefix>, "
+            "in the background while it runs"
+        ),
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--snapshot-format",
+        help="How the audit copy is saved on GCS",
+        type=str,
+        choices=SNAPSHOT_FORMATS,
+        default=FILES_FORMAT
+    )
+
+    parser.add_argument(
+        "--upload-workers",
+        help="Number of files of the audit copy uploaded to GCS in parallel",
+        type=int,
+        default=DEFAULT_MAX_WORKERS
+    )
+
+    parser.add_argument(
+        "--npm-cache-dir",
+        help="Local directory caching the node_modules of the project",
+        type=Path,
+        default=DEFAULT_CACHE_DIR
+    )
+
+    parser.add_argument(
+        "--npm-cache-gcs-path",
+        help="gs:// prefix caching the node_modules, shared between runs",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--tags",
+        help="Only runs the actions with one of these tags",
+        type=str,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "--actions-json",
+        help="JSON list of the actions to run",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--graph-cache-gcs-path",
+        help=(
+            "gs:// prefix caching the compiled graphs, "
+            "gs://<gcs-bucket>/compiled-graphs by default"
+        ),
+        type=str,
+    )
+
+    parser.add_argument(
+        "--incremental",
+        help="Only runs the actions affected by the files changed since the last successful run",
+        action="store_true"
+    )
+
+    parser.add_argument(
+        "--run-timeout-seconds",
+        help="Seconds after which `dataform run` is killed and the component fails",
+        type=float,
+        default=DEFAULT_RUN_TIMEOUT_SECONDS
+    )
+
+    parser.add_argument(
+        "--actions-output-path",
+        help=(
+            "File receiving the JSON list of the actions run, "
+            "with their status and estimated duration"
+        ),
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--metrics-output-path",
+        help="KFP metrics file receiving the duration and transfers of each stage",
+        type=Path,
+    )
+
+    parser.add_argument(
+        "--openmetrics-output-path",
+        help="File receiving the stage metrics in the OpenMetrics text format",
+        type=Path,
+    )
+
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    if (args.incremental or args.save_audit_copy) and not (args.gcs_bucket and args.gcs_prefix):
+        parser.error("--incremental and --save-audit-copy require --gcs-bucket and --gcs-prefix")
+    if args.author and args.gcs_prefix:
+        args.gcs_prefix = f"{args.author}/{args.gcs_prefix}"
+    # Also written when the run fails
+    atexit.register(write_summary, args.metrics_output_path, args.openmetrics_output_path)
+
+    dataform_vars = {
+        "exampleValue": args.example_value
+    }
+    if args.author:
+        # As in the Airflow DAGs
+        dataform_vars["author"] = args.author
+
+    graph_cache_gcs_path = args.graph_cache_gcs_path or (
+        f"gs://{args.gcs_bucket}/compiled-graphs" if args.gcs_bucket else None
+    )
+
+    action_results = clone_and_run_dataform(
+        project_id=args.project_id,
+        repo_url=args.repo_url,
+        dataform_vars=dataform_vars,
+        gcs_bucket=args.gcs_bucket,
+        gcs_prefix=args.gcs_prefix,
+        clone_options=CloneOptions(
+            ref=args.repo_ref,
+            cache_dir=args.git_cache_dir,
+            bundle_gcs_path=args.git_bundle_gcs_path,
+            depth=args.clone_depth,
+            blob_filter=args.clone_filter
+        ),
+        incremental=args.incremental,
+        actions=json.loads(args.actions_json) if args.actions_json else None,
+        tags=args.tags,
+        graph_cache_gcs_path=graph_cache_gcs_path,
+        npm_cache_dir=args.npm_cache_dir,
+        npm_cache_gcs_path=args.npm_cache_gcs_path,
+        run_timeout_seconds=args.run_timeout_seconds,
+        save_audit_copy=args.save_audit_copy,
+        snapshot_format=args.snapshot_format,
+        max_workers=args.upload_workers
+    )
+
+    if args.actions_output_path:
+        args.actions_output_path.parent.mkdir(parents=True, exist_ok=True)
+        args.actions_output_path.write_text(json.dumps(action_results))
@@ -0,0 +1,143 @@
+"""
+Contains the fused entry point of the pipeline: the project is cloned,
+configured and run in a single process, without the GCS round-trip
+between the load and run components.
+
+GCS is only written to for the optional caches and run state, and for an
+optional audit copy of the project, uploaded in the background while the
+project runs.
+"""
+
+import logging
+import shutil
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+from src.change_detection import default_run_state_gcs_path
+from src.dataform_runner import DEFAULT_RUN_TIMEOUT_SECONDS
+from src.dependency_cache import DEFAULT_CACHE_DIR, install_dependencies
+from src.download_and_run_dataform import create_credentials_file, run_dataform_project
+from src.gcs_transfer import DEFAULT_MAX_WORKERS
+from src.git_cache import CloneOptions
+from src.load_and_save_to_gcs import prepare_dataform_project, remove_dir_if_exists
+from src.metrics import stage
+from src.snapshot import FILES_FORMAT, save_snapshot
+
+
+def _save_audit_copy(
+    project_dir: Path,
+    gcs_destination: str,
+    snapshot_format: str,
+    max_workers: int
+) -> Future:
+    """Uploads a copy of the project in the background, taken before the
+    credentials and dependencies are added to it
+
+    Returns:
+        Future: Done once the copy is uploaded and removed
+    """
+    audit_dir = Path(tempfile.mkdtemp(prefix="dataform-audit-")) / project_dir.name
+    shutil.copytree(project_dir, audit_dir, symlinks=True)
+
+    def upload():
+        try:
+            with stage("audit_upload", snapshot_format=snapshot_format):
+                save_snapshot(audit_dir, gcs_destination, snapshot_format, max_workers)
+        finally:
+            shutil.rmtree(audit_dir.parent, ignore_errors=True)
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="audit")
+    future = executor.submit(upload)
+    executor.shutdown(wait=False)
+    return future
+
+
+def clone_and_run_dataform(
+    project_id: str,
+    repo_url: str,
+    dataform_vars: dict,
+    gcs_bucket: Optional[str] = None,
+    gcs_prefix: Optional[str] = None,
+    clone_options: Optional[CloneOptions] = None,
+    incremental: bool = False,
+    actions: Optional[Sequence[str]] = None,
+    tags: Optional[Sequence[str]] = None,
+    graph_cache_gcs_path: Optional[str] = None,
+    npm_cache_dir: Path = DEFAULT_CACHE_DIR,
+    npm_cache_gcs_path: Optional[str] = None,
+    run_timeout_seconds: Optional[float] = DEFAULT_RUN_TIMEOUT_SECONDS,
+    save_audit_copy: bool = False,
+    snapshot_format: str = FILES_FORMAT,
+    max_workers: int = DEFAULT_MAX_WORKERS
+) -> List[dict]:
+    """Clones the Dataform project, sets its vars and runs it
+
+    Args:
+        project_id (str): GCP project containing the credentials secret
+        repo_url (str): URL of the repository
+        dataform_vars (dict): Vars set in dataform.json
+        gcs_bucket (str): Bucket of the run state and audit copy
+        gcs_prefix (str): Prefix of the run state and audit copy
+        clone_options (CloneOptions): How the repository is cloned
+        incremental (bool): Whether to only run the actions affected by the
+            files changed since the last successful run. Requires gcs_bucket
+        actions (Sequence[str]): Only runs these actions. Takes precedence over tags
+        tags (Sequence[str]): Only runs the actions with one of these tags
+        graph_cache_gcs_path (str): gs:// prefix caching the compiled graphs
+        npm_cache_dir (Path): Local directory caching the node_modules
+        npm_cache_gcs_path (str): gs:// prefix caching the node_modules
+        run_timeout_seconds (float): Seconds after which `dataform run` is killed
+        save_audit_copy (bool): Whether to save the project as run on
+            gs://<gcs_bucket>/<gcs_prefix>, like the load component does
+        snapshot_format (str): How the audit copy is saved, see snapshot.py
+        max_workers (int): Number of concurrent uploads of the audit copy
+
+    Returns:
+        List[dict]: Status and estimated duration of each action run, see
+            dataform_runner.ActionResult
+    """
+    if (incremental or save_audit_copy) and not (gcs_bucket and gcs_prefix):
+        raise ValueError("incremental and save_audit_copy require a GCS bucket and prefix")
+
+    run_state_gcs_path = (
+        default_run_state_gcs_path(gcs_bucket, gcs_prefix) if incremental else None
+    )
+    base_path = Path(Path.cwd() / "dataform")
+    prepare_dataform_project(
+        repo_url,
+        dataform_vars,
+        base_path,
+        clone_options=clone_options,
+        run_state_gcs_path=run_state_gcs_path
+    )
+
+    audit_upload = None
+    if save_audit_copy:
+        audit_upload = _save_audit_copy(
+            base_path, f"gs://{gcs_bucket}/{gcs_prefix}", snapshot_format, max_workers
+        )
+
+    try:
+        create_credentials_file(project_id, base_path)
+        with stage("install_dependencies"):
+            install_dependencies(
+                base_path, cache_dir=npm_cache_dir, gcs_cache_path=npm_cache_gcs_path
+            )
+        return run_dataform_project(
+            base_path,
+            graph_cache_gcs_path,
+            actions=actions,
+            tags=tags,
+            run_state_gcs_path=run_state_gcs_path,
+            run_timeout_seconds=run_timeout_seconds
+        )
+    finally:
+        remove_dir_if_exists(base_path)
+        if audit_upload is not None:
+            try:
+                audit_upload.result()
+            except Exception:  # pylint: disable=broad-except
+                # The copy is only kept for auditing, the run itself is done
+                logging.exception("Cannot save the audit copy of the project")
@@ -0,0 +1,98 @@
+"""
+Contains helpers to patch the variables of a Dataform project.
+
+dataform.json is only rewritten when the merged variables differ from the
+current ones, so that its modification time and the content hashes derived
+from it (GCS sync manifest, caches) stay unchanged for a no-op patch.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+
+from .graph_cache import hash_vars
+
+# Dataform only accepts string values in the vars of dataform.json
+DEFAULT_VALUE_TYPE = str
+
+
+class InvalidDataformVarsError(ValueError):
+    """Raised when a Dataform variable does not match the declared schema"""
+
+
+def validate_dataform_vars(
+    dataform_vars: dict,
+    schema: Optional[Dict[str, type]] = None
+):
+    """Checks the type of each variable against the schema
+
+    Args:
+        dataform_vars (dict): The variables
+        schema (Dict[str, type]): Expected type of some variables. The others
+            must be strings
+
+    Raises:
+        InvalidDataformVarsError: If a variable has an unexpected type
+    """
+    schema = schema or {}
+    for name, value in dataform_vars.items():
+        expected_type = schema.get(name, DEFAULT_VALUE_TYPE)
+        if not isinstance(value, expected_type):
+            raise InvalidDataformVarsError(
+                f"Dataform variable {name} should be a {expected_type.__name__}, "
+                f"got {type(value).__name__}: {value!r}"
+            )
+
+
+def patch_dataform_vars(
+    dataform_json_path: Path,
+    dataform_vars: dict,
+    schema: Optional[Dict[str, type]] = None
+) -> str:
+    """Adds / changes variables of dataform.json
+
+    The file is left untouched when the variables are already set, and is
+    otherwise replaced atomically, so that a reader never sees it half written.
+
+    Args:
+        dataform_json_path (Path): Path pointing towards dataform.json file
+        dataform_vars (dict): Variables to add / change in dataform.json
+        schema (Dict[str, type]): Expected type of some variables, see
+            validate_dataform_vars
+
+    Returns:
+        str: Hash of the resulting variables, usable as a cache key
+
+    Raises:
+        InvalidDataformVarsError: If a resulting variable has an unexpected type
+    """
+    dataform_json_path = Path(dataform_json_path)
+    with open(dataform_json_path) as json_file:
+        json_data = json.load(json_file)
+
+    current_vars = json_data.get("vars", {})
+    merged_vars = {**current_vars, **dataform_vars}
+    validate_dataform_vars(merged_vars, schema)
+
+    if "vars" in json_data and merged_vars == current_vars:
+        logging.info("Dataform vars of %s already up to date", dataform_json_path)
+        return hash_vars(merged_vars)
+
+    json_data["vars"] = merged_vars
+    file_descriptor, tmp_path = tempfile.mkstemp(
+        dir=str(dataform_json_path.parent), prefix=".dataform.json."
+    )
+    try:
+        with os.fdopen(file_descriptor, "w") as out_file:
+            json.dump(json_data, out_file, indent=4)
+        shutil.copymode(dataform_json_path, tmp_path)
+        os.replace(tmp_path, dataform_json_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return hash_vars(merged_vars)
@@ -0,0 +1,190 @@
+import shutil
+import json
+import logging
+from dataclasses import asdict
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+from src.change_detection import record_successful_run
+from src.dataform_runner import DEFAULT_RUN_TIMEOUT_SECONDS, run_dataform
+from src.dataform_shards import action_dependencies, affected_actions
+from src.gcs_transfer import DEFAULT_MAX_WORKERS
+from src.graph_cache import find_cached_graph, load_compiled_graph, read_build_info
+from src.handoff import StaleHandoffError, check_handoff_run, load_from_handoff_dir
+from src.metrics import current_stage, stage
+from src.secret_helper import SecretManagerHelper
+from src.snapshot import load_snapshot
+
+CREDENTIALS_SECRET_NAME = "dataform_credentials"
+
+
+def create_credentials_file(project_id: str, base_path: Path):
+    secret_manager_helper = SecretManagerHelper(project_id=project_id)
+    credentials = json.loads(
+        secret_manager_helper.get_secret(CREDENTIALS_SECRET_NAME)
+    )
+    file_path = base_path / ".df-credentials.json"
+
+    with open(str(file_path), 'w') as json_file:
+        json.dump(credentials, json_file, indent=4)
+
+
+def download_folder_from_gcs_and_return_base_path(
+    project_id: str,
+    gcs_bucket: str,
+    gcs_prefix: str,
+    local_destination_path: Path,
+    max_workers: int = DEFAULT_MAX_WORKERS
+):
+    """Downloads the Dataform project saved under the GCS prefix, either as
+    separate files or as a single archive, and adds the credentials file to it
+
+    Args:
+        project_id (str): GCP project containing the credentials secret
+        gcs_bucket (str): Bucket where the project is saved
+        gcs_prefix (str): Prefix where the project is saved
+        local_destination_path (Path): Local directory to download into
+        max_workers (int): Number of concurrent downloads
+
+    Returns:
+        Path: Local path of the Dataform project
+    """
+    base_path = Path(local_destination_path / Path(gcs_prefix))
+
+    if base_path.exists() and base_path.is_dir():
+        shutil.rmtree(base_path)
+
+    load_snapshot(gcs_bucket, gcs_prefix, local_destination_path, max_workers)
+    create_credentials_file(project_id, base_path)
+
+    return base_path
+
+
+def load_dataform_project(
+    project_id: str,
+    gcs_bucket: str,
+    gcs_prefix: str,
+    local_destination_path: Path,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    handoff_dir: Optional[Path] = None,
+    handoff_run_id: Optional[str] = None,
+    expected_commit: Optional[str] = None
+):
+    """Copies the Dataform project handed off by the loader if the hand-off
+    directory holds the one of this run, downloads it from GCS otherwise,
+    and adds the credentials file to it
+
+    Args:
+        project_id (str): GCP project containing the credentials secret
+        gcs_bucket (str): Bucket where the project is saved
+        gcs_prefix (str): Prefix where the project is saved
+        local_destination_path (Path): Local directory to copy or download into
+        max_workers (int): Number of concurrent downloads
+        handoff_dir (Path): Directory shared with the loader, see handoff.py
+        handoff_run_id (str): ID of the pipeline run that must have prepared
+            the project, whichever way it is loaded
+        expected_commit (str): Commit the project must have been built from,
+            when the loader may have been skipped by the step cache
+
+    Returns:
+        Path: Local path of the Dataform project
+
+    Raises:
+        StaleHandoffError: If neither the hand-off directory nor GCS holds
+            the project of the run, or the project is of another commit
+    """
+    base_path = Path(local_destination_path / Path(gcs_prefix))
+    source = "gcs"
+    if handoff_dir is not None and load_from_handoff_dir(
+        handoff_dir, base_path, handoff_run_id
+    ):
+        source = "handoff"
+        create_credentials_file(project_id, base_path)
+    else:
+        download_folder_from_gcs_and_return_base_path(
+            project_id, gcs_bucket, gcs_prefix, local_destination_path, max_workers
+        )
+        # The GCS copy is left over from a previous run if the loader only
+        # handed the project off
+        if handoff_run_id is not None:
+            check_handoff_run(base_path, handoff_run_id)
+
+    if expected_commit is not None:
+        found_commit = (read_build_info(base_path) or {}).get("commit")
+        if found_commit != expected_commit:
+            raise StaleHandoffError(
+                f"Project in {base_path} was built from commit {found_commit}, "
+                f"not from commit {expected_commit}"
+            )
+
+    metrics = current_stage()
+    if metrics is not None:
+        metrics.labels["source"] = source
+    return base_path
+
+
+def run_dataform_project(
+    base_path: Path,
+    graph_cache_gcs_path: Optional[str] = None,
+    actions: Optional[Sequence[str]] = None,
+    tags: Optional[Sequence[str]] = None,
+    run_state_gcs_path: Optional[str] = None,
+    run_timeout_seconds: Optional[float] = DEFAULT_RUN_TIMEOUT_SECONDS
+) -> List[dict]:
+    """Runs the actions of the Dataform project
+
+    Args:
+        base_path (Path): Local path of the Dataform project, with its
+            credentials and dependencies
+        graph_cache_gcs_path (str): gs:// prefix caching the compiled graphs.
+            No cache when None
+        actions (Sequence[str]): Only runs these actions. Takes precedence over tags
+        tags (Sequence[str]): Only runs the actions with one of these tags
+        run_state_gcs_path (str): When set, only runs the actions affected by
+            the files changed since the last successful run recorded there,
+            as listed by the loader, and records this run once successful
+        run_timeout_seconds (float): Seconds after which `dataform run` is killed
+
+    Returns:
+        List[dict]: Status and estimated duration of each action run, see
+            dataform_runner.ActionResult
+    """
+    build_info = read_build_info(base_path)
+    changed_files = (build_info or {}).get("changed_files")
+    select_actions = run_state_gcs_path and actions is None and changed_files is not None
+
+    # `dataform run` compiles the project again, so the graph is only
+    # compiled here to select the actions. Otherwise the cached one, if any,
+    # gives the dependencies measuring each action
+    with stage("load_graph"):
+        if select_actions:
+            graph = load_compiled_graph(base_path, graph_cache_gcs_path)
+        else:
+            graph = find_cached_graph(base_path, graph_cache_gcs_path)
+
+    if select_actions:
+        with stage("select_actions"):
+            actions = affected_actions(graph, changed_files, tags)
+        logging.info(
+            "%d files changed since commit %s, affected actions: %s",
+            len(changed_files), build_info["base_commit"],
+            "all" if actions is None else actions
+        )
+
+    action_results = []
+    if actions is not None and not actions:
+        logging.info("No action to run")
+    else:
+        with stage("dataform_run"):
+            run_result = run_dataform(
+                base_path,
+                actions=actions,
+                tags=tags,
+                dependencies=None if graph is None else action_dependencies(graph),
+                timeout=run_timeout_seconds
+            )
+        action_results = [asdict(action) for action in run_result.actions]
+
+    if run_state_gcs_path and build_info:
+        record_successful_run(run_state_gcs_path, build_info)
+    return action_results
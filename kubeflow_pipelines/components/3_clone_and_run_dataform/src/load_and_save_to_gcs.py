@@ -0,0 +1,140 @@
+import shutil
+from pathlib import Path
+from typing import Optional
+
+from src.change_detection import default_run_state_gcs_path, record_changes
+from src.dataform_vars import patch_dataform_vars
+from src.gcs_transfer import DEFAULT_MAX_WORKERS
+from src.git_cache import CloneOptions, clone_repository
+from src.graph_cache import write_build_info
+from src.handoff import save_to_handoff_dir, write_handoff_marker
+from src.metrics import stage
+from src.snapshot import FILES_FORMAT, save_snapshot
+
+# Root of the snapshots saved per commit and vars, out of the project prefixes
+SNAPSHOTS_DIR = "snapshots"
+
+
+def remove_dir_if_exists(directory: Path):
+    """Removes directory if exists.
+
+    Args:
+        directory (Path): Path to directory.
+    """
+    if directory.exists() and directory.is_dir():
+        shutil.rmtree(directory)
+
+
+def snapshot_gcs_prefix(gcs_prefix: str, commit: str, input_vars_hash: str) -> str:
+    """Returns the GCS prefix of the snapshot of a commit with given vars.
+
+    A snapshot saved there is never overwritten with other content, so a
+    step reading it can be cached on the commit and vars. Snapshots live
+    under their own root, out of the prefixes that loads sync and prune.
+
+    Args:
+        gcs_prefix (str): Prefix where the project is saved, including the
+            author if any
+        commit (str): Commit of the project
+        input_vars_hash (str): Hash of the vars given to the loader, see
+            graph_cache.hash_vars. Unlike the vars_hash of the build info, it
+            is known before cloning, as the vars of dataform.json are not
+
+    Returns:
+        str: Prefix of the snapshot
+    """
+    return f"{SNAPSHOTS_DIR}/{gcs_prefix}/{commit[:12]}-{input_vars_hash[:12]}"
+
+
+def prepare_dataform_project(
+    repo_url: str,
+    dataform_vars: dict,
+    destination_dir: Path,
+    clone_options: Optional[CloneOptions] = None,
+    run_state_gcs_path: Optional[str] = None,
+    handoff_run_id: Optional[str] = None
+):
+    """Clones the Dataform project and sets its vars, ready to be run
+
+    Args:
+        repo_url (str): URL of the repository
+        dataform_vars (dict): Vars set in dataform.json
+        destination_dir (Path): Where to clone the project, replaced if it exists
+        clone_options (CloneOptions): How the repository is cloned
+        run_state_gcs_path (str): When set, the files changed since the last
+            successful run recorded there are saved in the build info
+        handoff_run_id (str): ID of the pipeline run, stamped on the project
+            so that the runner does not pick up the project of another run
+    """
+    remove_dir_if_exists(destination_dir)
+
+    with stage("clone"):
+        clone_repository(repo_url, destination_dir, clone_options)
+
+    with stage("configure"):
+        dataform_json_path = destination_dir / "dataform.json"
+        vars_hash = patch_dataform_vars(dataform_json_path, dataform_vars)
+        # Lets the runner reuse the compiled graph of the same commit and vars
+        write_build_info(destination_dir, vars_hash)
+        if run_state_gcs_path is not None:
+            record_changes(destination_dir, run_state_gcs_path)
+        if handoff_run_id is not None:
+            write_handoff_marker(destination_dir, handoff_run_id)
+
+
+def clone_repo_and_save_to_gcs(
+    repo_url: str,
+    dataform_vars: dict,
+    gcs_bucket: str,
+    gcs_prefix: str,
+    max_workers: int = DEFAULT_MAX_WORKERS,
+    snapshot_format: str = FILES_FORMAT,
+    clone_options: Optional[CloneOptions] = None,
+    incremental: bool = False,
+    handoff_dir: Optional[Path] = None,
+    handoff_run_id: Optional[str] = None,
+    upload_to_gcs: bool = True
+):
+    """Clones the Dataform project, sets its vars and hands it to the runner
+
+    Args:
+        repo_url (str): URL of the repository
+        dataform_vars (dict): Vars set in dataform.json
+        gcs_bucket (str): Bucket where the project is saved
+        gcs_prefix (str): Prefix where the project is saved
+        max_workers (int): Number of concurrent uploads
+        snapshot_format (str): How the project is saved on GCS, see snapshot.py
+        clone_options (CloneOptions): How the repository is cloned
+        incremental (bool): Whether to record the files changed since the
+            last successful run
+        handoff_dir (Path): Directory shared with the runner, receiving a
+            copy of the project, see handoff.py
+        handoff_run_id (str): ID of the pipeline run, stamped on the project
+            so that the runner does not pick up the project of another run
+        upload_to_gcs (bool): Whether to save the project on GCS. Can only be
+            skipped when the project is handed off through handoff_dir
+    """
+    if not upload_to_gcs and handoff_dir is None:
+        raise ValueError("The project must be uploaded to GCS or handed off")
+
+    destination_dir = Path(Path.cwd() / "dataform")
+    prepare_dataform_project(
+        repo_url,
+        dataform_vars,
+        destination_dir,
+        clone_options=clone_options,
+        run_state_gcs_path=(
+            default_run_state_gcs_path(gcs_bucket, gcs_prefix) if incremental else None
+        ),
+        handoff_run_id=handoff_run_id
+    )
+
+    if handoff_dir is not None:
+        with stage("handoff"):
+            save_to_handoff_dir(destination_dir, handoff_dir)
+
+    if upload_to_gcs:
+        gcs_destination = f"gs://{gcs_bucket}/{gcs_prefix}"
+        with stage("upload", snapshot_format=snapshot_format):
+            save_snapshot(destination_dir, gcs_destination, snapshot_format, max_workers)
+    remove_dir_if_exists(destination_dir)
@@ -1,153 +1,639 @@
 """Kubeflow Pipeline for local area classifier training."""
 
 import argparse
+import json
 import logging
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
+from typing import Optional
 
-import google.auth
 import kfp
 from kfp.compiler import Compiler
-from secret_helper import SecretManagerHelper
+
+from gcp_project import get_project_id
+from pipeline_cache import compile_cached, compile_key, component_source_files, spec_hash
 
 
-_, PROJECT_ID = google.auth.default()
 GCR_IMAGE_FOLDER = 'dataform-basic-example'
-KFP_ROOT_GCS_PATH = f"gs://{PROJECT_ID}-staging/kfp"
+
+# Collected by KFP as the metrics of the step, see the --metrics-output-path
+# argument of the components
+KFP_METRICS_PATH = "/mlpipeline-metrics.json"
 
 GITHUB_CREDENTIALS_SECRET_NAME = "workshop_github_access_token"
-GITHUB_ACCESS_TOKEN = (
-    SecretManagerHelper(PROJECT_ID)
-    .get_secret(GITHUB_CREDENTIALS_SECRET_NAME)
-)
-REPO_URL = (
-    f"https://{GITHUB_ACCESS_TOKEN}:"
-    "x-oauth-basic@github.com/alexanderblnf/dataform-workshop-project"
-)
+
+# How the loader hands the project to the runner
+GCS_HANDOFF = "gcs"
+VOLUME_HANDOFF = "volume"
+HANDOFFS = (GCS_HANDOFF, VOLUME_HANDOFF)
+
+HANDOFF_MOUNT_PATH = "/handoff"
+HANDOFF_VOLUME_SIZE = "1Gi"
+
+# How long the result of a step keyed on the commit and vars is reused. The
+# snapshots they save on GCS must be kept at least as long
+STEP_CACHE_STALENESS = "P7D"
+# Steps whose result depends on more than their inputs are never reused
+NO_STEP_CACHE = "P0D"
+
+
+# Settings depending on the credentials are resolved on first use, so that
+# importing this module does not query the metadata server or Secret Manager
+@lru_cache(maxsize=None)
+def get_repo_url() -> str:
+    """Returns the URL of the Dataform repository, with the Github token"""
+    from secret_helper import SecretManagerHelper  # pylint: disable=import-outside-toplevel
+
+    github_access_token = (
+        SecretManagerHelper(get_project_id())
+        .get_secret(GITHUB_CREDENTIALS_SECRET_NAME)
+    )
+    return (
+        f"https://{github_access_token}:"
+        "x-oauth-basic@github.com/alexanderblnf/dataform-workshop-project"
+    )
+
+
+def get_gcs_bucket() -> str:
+    return f"{get_project_id()}-dataform-build"
+
+
+# The component images are shared by all the authors, see build_image.sh of
+# the components. Another tag can be built to try changes to a component
+DEFAULT_IMAGE_TAG = "latest"
+image_tag = DEFAULT_IMAGE_TAG
+
+
+def component_image(image_name: str) -> str:
+    """Returns the reference of the image of a component"""
+    return (
+        f"eu.gcr.io/{get_project_id()}/kfp/{GCR_IMAGE_FOLDER}/components/"
+        f"{image_name}:{image_tag}"
+    )
+
 
 PIPELINE_HOST = "https://6ed70044c47c016d-dot-europe-west1.pipelines.googleusercontent.com/"
-GCS_BUCKET = f"{PROJECT_ID}-dataform-build"
 
-global author
+# A single pipeline shared by all the authors, who pass their name per run
+PIPELINE_NAME = "Dataform Simple Example"
+EXPERIMENT_NAME = "dataform-simple-example"
+PACKAGE_DIR = Path("./pipeline-packages-ai-platform/")
+
+
+def resolve_dataform_version_op(
+    repo_url: str,
+    example_value: str,
+    author: str,
+    output_gcs_prefix: str
+):
+    return kfp.dsl.ContainerOp(
+        name="resolve_dataform_version",
+        image=component_image("load-dataform-gcs"),
+        arguments=[
+            "--repo-url",
+            repo_url,
+            "--example-value",
+            example_value,
+            "--author",
+            author,
+            "--output-gcs-prefix",
+            output_gcs_prefix,
+            "--resolve-only",
+            "--commit-output-path",
+            "/tmp/outputs/commit.txt",
+            "--input-vars-hash-output-path",
+            "/tmp/outputs/input_vars_hash.txt",
+            "--snapshot-prefix-output-path",
+            "/tmp/outputs/snapshot_prefix.txt",
+            "--metrics-output-path",
+            KFP_METRICS_PATH,
+        ],
+        file_outputs={
+            "commit": "/tmp/outputs/commit.txt",
+            "input_vars_hash": "/tmp/outputs/input_vars_hash.txt",
+            "snapshot_prefix": "/tmp/outputs/snapshot_prefix.txt",
+        }
+    )
 
 
 def load_repo_and_edit_config_op(
     repo_url: str,
     example_value: str,
+    author: str,
     output_gcs_bucket: str,
-    output_gcs_prefix: str
+    output_gcs_prefix: str,
+    repo_ref: Optional[str] = None,
+    snapshot_gcs_prefix: Optional[str] = None,
+    incremental: bool = False,
+    handoff_volume: Optional[kfp.dsl.PipelineVolume] = None
 ):
+    ref_arguments = ["--repo-ref", repo_ref] if repo_ref is not None else []
+    if snapshot_gcs_prefix is not None:
+        ref_arguments += ["--snapshot-gcs-prefix", snapshot_gcs_prefix]
+    handoff_arguments = []
+    if handoff_volume is not None:
+        handoff_arguments = [
+            "--handoff-dir",
+            HANDOFF_MOUNT_PATH,
+            "--handoff-run-id",
+            kfp.dsl.RUN_ID_PLACEHOLDER,
+            "--skip-gcs-upload"
+        ]
+
     return kfp.dsl.ContainerOp(
         name="save_dataform_repo_to_gcs",
-        image=(
-            f"eu.gcr.io/{PROJECT_ID}/kfp/{GCR_IMAGE_FOLDER}/{author}/"
-            f"components/load-dataform-gcs-{author}:latest"
-        ),
+        image=component_image("load-dataform-gcs"),
         arguments=[
             "--repo-url",
             repo_url,
             "--example-value",
             example_value,
-            # TODO: Add author param
+            "--author",
+            author,
             "--output-gcs-bucket",
             output_gcs_bucket,
             "--output-gcs-prefix",
             output_gcs_prefix,
-        ],
+            "--metrics-output-path",
+            KFP_METRICS_PATH,
+        ] + ref_arguments + (["--incremental"] if incremental else []) + handoff_arguments,
+        pvolumes={HANDOFF_MOUNT_PATH: handoff_volume} if handoff_volume else None
     )
 
 
 def run_dataform_op(
     project_id: str,
+    author: Optional[str],
     input_gcs_bucket: str,
-    input_gcs_prefix: str
+    input_gcs_prefix: str,
+    actions_json: Optional[str] = None,
+    incremental: bool = False,
+    handoff_volume: Optional[kfp.dsl.PipelineVolume] = None,
+    expected_commit: Optional[str] = None
 ):
+    arguments = [
+        "--project-id",
+        project_id,
+        "--input-gcs-bucket",
+        input_gcs_bucket,
+        "--input-gcs-prefix",
+        input_gcs_prefix,
+        "--metrics-output-path",
+        KFP_METRICS_PATH,
+        "--actions-output-path",
+        "/tmp/outputs/dataform_actions.json"
+    ]
+    if author is not None:
+        arguments += ["--author", author]
+    if actions_json is not None:
+        arguments += ["--actions-json", actions_json]
+    if incremental:
+        arguments.append("--incremental")
+    if expected_commit is not None:
+        arguments += ["--expected-commit", expected_commit]
+    if handoff_volume is not None:
+        arguments += [
+            "--handoff-dir",
+            HANDOFF_MOUNT_PATH,
+            "--handoff-run-id",
+            kfp.dsl.RUN_ID_PLACEHOLDER
+        ]
+
     return kfp.dsl.ContainerOp(
         name="run_dataform_example",
-        image=(
-            f"eu.gcr.io/{PROJECT_ID}/kfp/{GCR_IMAGE_FOLDER}/"
-            f"{author}/components/run-dataform-example-{author}:latest"
-        ),
+        image=component_image("run-dataform-example"),
+        arguments=arguments,
+        # Status and duration of each action, see src/dataform_runner.py
+        file_outputs={"dataform_actions": "/tmp/outputs/dataform_actions.json"},
+        pvolumes={HANDOFF_MOUNT_PATH: handoff_volume} if handoff_volume else None
+    )
+
+
+def clone_and_run_dataform_op(
+    project_id: str,
+    repo_url: str,
+    example_value: str,
+    author: str,
+    gcs_bucket: str,
+    gcs_prefix: str,
+    incremental: bool = False
+):
+    return kfp.dsl.ContainerOp(
+        name="clone_and_run_dataform",
+        image=component_image("clone-and-run-dataform"),
+        arguments=[
+            "--project-id",
+            project_id,
+            "--repo-url",
+            repo_url,
+            "--example-value",
+            example_value,
+            "--author",
+            author,
+            "--gcs-bucket",
+            gcs_bucket,
+            "--gcs-prefix",
+            gcs_prefix,
+            "--metrics-output-path",
+            KFP_METRICS_PATH,
+            "--actions-output-path",
+            "/tmp/outputs/dataform_actions.json"
+        ] + (["--incremental"] if incremental else []),
+        file_outputs={"dataform_actions": "/tmp/outputs/dataform_actions.json"}
+    )
+
+
+def plan_dataform_shards_op(
+    project_id: str,
+    author: Optional[str],
+    input_gcs_bucket: str,
+    input_gcs_prefix: str,
+    shards: int
+):
+    return kfp.dsl.ContainerOp(
+        name="plan_dataform_shards",
+        image=component_image("run-dataform-example"),
         arguments=[
             "--project-id",
             project_id,
             "--input-gcs-bucket",
             input_gcs_bucket,
             "--input-gcs-prefix",
-            input_gcs_prefix
-        ]
+            input_gcs_prefix,
+            "--plan-shards",
+            shards,
+            "--shards-output-path",
+            "/tmp/outputs/shards.json",
+            "--metrics-output-path",
+            KFP_METRICS_PATH
+        ] + (["--author", author] if author is not None else []),
+        file_outputs={"shards": "/tmp/outputs/shards.json"}
     )
 
 
-@kfp.dsl.pipeline(
-    name='Dataform Simple Example',
-    description='This pipeline loads a dataform project from Github and runs it.'
-)
-def dataform_simple_example_pipeline(
-    repo_url: str = REPO_URL,
-    example_value: str = "ai-platform-example-value",
-    output_gcs_bucket: str = GCS_BUCKET,
-    output_gcs_prefix: str = "dataform_folder",
-    # TODO: Add author param
+def build_pipeline(
+    dataform_shards: int = 1,
+    incremental: bool = False,
+    handoff: str = GCS_HANDOFF,
+    fused: bool = False,
+    step_caching: bool = True
 ):
-    # 1. Load component 1
-    load_repo_and_edit_config_step = load_repo_and_edit_config_op(
-        repo_url=repo_url,
-        example_value=example_value,
-        output_gcs_bucket=output_gcs_bucket,
-        output_gcs_prefix=f"{author}/{output_gcs_prefix}"
-    ).set_display_name('Load Repository and Save to GCS Bucket')
-    load_repo_and_edit_config_step.execution_options.caching_strategy.max_cache_staleness = "P0D"
-
-    # 2. Load component 2
-    run_dataform_step = run_dataform_op(
-        project_id=PROJECT_ID,
-        input_gcs_bucket=output_gcs_bucket,
-        input_gcs_prefix=f"{author}/{output_gcs_prefix}"
-    ).after(load_repo_and_edit_config_step).set_display_name('Run Dataform example')
-    run_dataform_step.execution_options.caching_strategy.max_cache_staleness = "P0D"
-
-
-def compile_and_upload_pipeline():
-    """Convenience function to compile and upload the pipeline"""
-    logging.info("Compiling pipeline...")
-    package_dir = Path("./pipeline-packages-ai-platform/")
-    current_date_and_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
-    pipeline_package_path = (
-        package_dir / f"dataform-simple-example-pipeline-{current_date_and_time}.zip"
-    )
-    pipeline_package_path.parent.mkdir(parents=True, exist_ok=True)
+    """Defines the pipeline. The defaults of its parameters need the
+    credentials, so they are only evaluated when the pipeline is compiled
 
-    Compiler().compile(
-        dataform_simple_example_pipeline,
-        str(pipeline_package_path)
+    Args:
+        dataform_shards (int): When above 1, the actions of the project are
+            split into up to this number of independent shards, run in parallel
+        incremental (bool): Whether to only run the actions affected by the
+            changes since the last successful run. Ignored when sharded
+        handoff (str): How the loader passes the project to the runner, one
+            of HANDOFFS. With a volume, the project is copied onto a disk
+            created for the run and mounted by both steps, instead of being
+            uploaded to GCS and downloaded back. Ignored when sharded, as a
+            ReadWriteOnce disk cannot follow shards running on several nodes
+        fused (bool): Whether to clone and run the project in a single step,
+            saving a container start and the hand-off. Takes precedence over
+            dataform_shards and handoff
+        step_caching (bool): Whether to resolve the commit first, so that the
+            steps preparing the project are skipped while the commit and vars
+            are unchanged. The project is then saved under a prefix of its
+            commit and vars. Ignored when the prepared project also depends
+            on the previous runs or the hand-off volume of the run, i.e. when
+            incremental and not sharded, or fused, or handed off on a volume
+    """
+    volume_handoff = handoff == VOLUME_HANDOFF and dataform_shards <= 1
+    incremental_load = incremental and dataform_shards <= 1
+    cached_load = step_caching and not (fused or incremental_load or volume_handoff)
+
+    @kfp.dsl.pipeline(
+        name=PIPELINE_NAME,
+        description='This pipeline loads a dataform project from Github and runs it.'
     )
+    def dataform_simple_example_pipeline(
+        author: str,
+        repo_url: str = get_repo_url(),
+        example_value: str = "ai-platform-example-value",
+        output_gcs_bucket: str = get_gcs_bucket(),
+        output_gcs_prefix: str = "dataform_folder",
+    ):
+        if fused:
+            clone_and_run_step = clone_and_run_dataform_op(
+                project_id=get_project_id(),
+                repo_url=repo_url,
+                example_value=example_value,
+                author=author,
+                gcs_bucket=output_gcs_bucket,
+                gcs_prefix=output_gcs_prefix,
+                incremental=incremental
+            ).set_display_name('Clone and run Dataform')
+            clone_and_run_step.execution_options.caching_strategy.max_cache_staleness = NO_STEP_CACHE
+            return
+
+        repo_ref = None
+        snapshot_gcs_prefix = None
+        # Read by the runner, prefixed by the author unless already included
+        project_gcs_prefix = output_gcs_prefix
+        project_author = author
+        expected_commit = None
+        load_cache_staleness = NO_STEP_CACHE
+        if cached_load:
+            resolve_step = resolve_dataform_version_op(
+                repo_url=repo_url,
+                example_value=example_value,
+                author=author,
+                output_gcs_prefix=output_gcs_prefix
+            ).set_display_name('Resolve Dataform commit')
+            # The ref may point to a new commit on each run
+            resolve_step.execution_options.caching_strategy.max_cache_staleness = NO_STEP_CACHE
+            repo_ref = resolve_step.outputs["commit"]
+            snapshot_gcs_prefix = resolve_step.outputs["snapshot_prefix"]
+            # The snapshot prefix already includes the author
+            project_gcs_prefix = snapshot_gcs_prefix
+            project_author = None
+            expected_commit = resolve_step.outputs["commit"]
+            load_cache_staleness = STEP_CACHE_STALENESS
 
-    logging.info("Uploading pipeline...")
-    client = kfp.Client(PIPELINE_HOST)
-    try:
-        client.upload_pipeline(
-            str(pipeline_package_path),
-            pipeline_name=f"Dataform Simple Example - {author}",
-            description="Pipeline that runs Dataform"
+        handoff_volume = None
+        if volume_handoff:
+            handoff_volume = kfp.dsl.VolumeOp(
+                name="create_handoff_volume",
+                resource_name="dataform-handoff",
+                size=HANDOFF_VOLUME_SIZE,
+                modes=kfp.dsl.VOLUME_MODE_RWO
+            ).set_display_name('Create hand-off volume').volume
+
+        # 1. Load component 1
+        load_repo_and_edit_config_step = load_repo_and_edit_config_op(
+            repo_url=repo_url,
+            example_value=example_value,
+            author=author,
+            output_gcs_bucket=output_gcs_bucket,
+            output_gcs_prefix=output_gcs_prefix,
+            repo_ref=repo_ref,
+            snapshot_gcs_prefix=snapshot_gcs_prefix,
+            incremental=incremental_load,
+            handoff_volume=handoff_volume
+        ).set_display_name('Load Repository and Save to GCS Bucket')
+        load_repo_and_edit_config_step.execution_options.caching_strategy.max_cache_staleness = (
+            load_cache_staleness
         )
-    except Exception:
-        client.upload_pipeline_version(
-            str(pipeline_package_path),
-            pipeline_name=f"Dataform Simple Example - {author}",
-            pipeline_version_name=f"{str(current_date_and_time)}-{author}"
+
+        # 2. Load component 2
+        if dataform_shards <= 1:
+            run_dataform_step = run_dataform_op(
+                project_id=get_project_id(),
+                author=project_author,
+                input_gcs_bucket=output_gcs_bucket,
+                input_gcs_prefix=project_gcs_prefix,
+                incremental=incremental,
+                handoff_volume=handoff_volume,
+                expected_commit=expected_commit
+            ).after(load_repo_and_edit_config_step).set_display_name('Run Dataform example')
+            # Runs the actions, which must happen on every run
+            run_dataform_step.execution_options.caching_strategy.max_cache_staleness = NO_STEP_CACHE
+            return
+
+        # 2. Compile the project and fan its shards out to parallel steps
+        plan_shards_step = plan_dataform_shards_op(
+            project_id=get_project_id(),
+            author=project_author,
+            input_gcs_bucket=output_gcs_bucket,
+            input_gcs_prefix=project_gcs_prefix,
+            shards=dataform_shards
+        ).after(load_repo_and_edit_config_step).set_display_name('Plan Dataform shards')
+        # Only depends on the project, saved under its commit and vars when cached
+        plan_shards_step.execution_options.caching_strategy.max_cache_staleness = (
+            load_cache_staleness
         )
 
+        with kfp.dsl.ParallelFor(plan_shards_step.outputs["shards"]) as shard_actions:
+            run_dataform_step = run_dataform_op(
+                project_id=get_project_id(),
+                author=project_author,
+                input_gcs_bucket=output_gcs_bucket,
+                input_gcs_prefix=project_gcs_prefix,
+                actions_json=shard_actions,
+                expected_commit=expected_commit
+            ).set_display_name('Run Dataform shard')
+            run_dataform_step.execution_options.caching_strategy.max_cache_staleness = NO_STEP_CACHE
+
+    return dataform_simple_example_pipeline
+
+
+def compile_pipeline(
+    dataform_shards: int = 1,
+    incremental: bool = False,
+    handoff: str = GCS_HANDOFF,
+    fused: bool = False,
+    step_caching: bool = True
+) -> Path:
+    """Compiles the pipeline, unless it was already compiled with the same
+    definition and settings
+
+    Returns:
+        Path: Path of the compiled package
+    """
+    settings = {
+        "dataform_shards": dataform_shards,
+        "incremental": incremental,
+        "handoff": handoff,
+        "fused": fused,
+        "step_caching": step_caching,
+        "image_tag": image_tag,
+        # Defaults of the pipeline parameters
+        "defaults": [get_repo_url(), get_gcs_bucket()],
+        "kfp": kfp.__version__,
+    }
+    return compile_cached(
+        lambda package_path: Compiler().compile(
+            build_pipeline(dataform_shards, incremental, handoff, fused, step_caching),
+            package_path
+        ),
+        PACKAGE_DIR,
+        "dataform-simple-example-pipeline",
+        compile_key([Path(__file__), *component_source_files()], settings),
+        ".yaml"
+    )
+
+
+def _version_tag(version_name: str) -> str:
+    # Recorded as the description of each version, as creating the pipeline
+    # uploads its first version under the name of the pipeline
+    return f"spec_hash={version_name}"
+
+
+def _find_version_by_name(client: kfp.Client, pipeline_id: str, name: str):
+    name_filter = json.dumps({
+        "predicates": [{"key": "name", "op": "EQUALS", "string_value": name}]
+    })
+    response = client.list_pipeline_versions(pipeline_id, page_size=1, filter=name_filter)
+    return response.versions[0] if response.versions else None
+
+
+def find_pipeline_version(
+    client: kfp.Client,
+    pipeline_id: str,
+    version_name: str
+) -> Optional[str]:
+    """Returns the ID of the version of the pipeline with this name, or of
+    the first version of the pipeline if it is tagged with this name"""
+    version = _find_version_by_name(client, pipeline_id, version_name)
+    if version is None:
+        first_version = _find_version_by_name(client, pipeline_id, PIPELINE_NAME)
+        if first_version is not None and first_version.description == _version_tag(version_name):
+            version = first_version
+    return version.id if version is not None else None
+
+
+def upload_pipeline(client: kfp.Client, package_path: Path) -> str:
+    """Uploads the compiled pipeline as a version named after its content,
+    unless a version with the same content exists
+
+    Returns:
+        str: ID of the pipeline version
+    """
+    version_name = spec_hash(package_path)[:16]
+    pipeline_id = client.get_pipeline_id(PIPELINE_NAME)
+    if pipeline_id is None:
+        logging.info("Uploading pipeline %s as version %s...", PIPELINE_NAME, version_name)
+        pipeline = client.upload_pipeline(
+            str(package_path),
+            pipeline_name=PIPELINE_NAME,
+            # Also the description of the first version
+            description=_version_tag(version_name)
+        )
+        return pipeline.default_version.id
+
+    version_id = find_pipeline_version(client, pipeline_id, version_name)
+    if version_id is not None:
+        logging.info("Pipeline version %s already uploaded", version_name)
+        return version_id
+
+    logging.info("Uploading pipeline version %s...", version_name)
+    version = client.upload_pipeline_version(
+        str(package_path),
+        pipeline_version_name=version_name,
+        pipeline_id=pipeline_id,
+        description=_version_tag(version_name)
+    )
+    return version.id
+
+
+def latest_pipeline_version(client: kfp.Client) -> str:
+    """Returns the ID of the last uploaded version of the pipeline"""
+    pipeline_id = client.get_pipeline_id(PIPELINE_NAME)
+    response = (
+        client.list_pipeline_versions(pipeline_id, page_size=1, sort_by="created_at desc")
+        if pipeline_id else None
+    )
+    if not response or not response.versions:
+        raise ValueError(f"Pipeline {PIPELINE_NAME} has no version, deploy it first")
+    return response.versions[0].id
+
+
+def submit_run(client: kfp.Client, version_id: str, author: str):
+    """Runs a version of the pipeline for an author"""
+    experiment = client.create_experiment(EXPERIMENT_NAME)
+    current_date_and_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
+    run = client.run_pipeline(
+        experiment.id,
+        job_name=f"dataform-simple-example-{author}-{current_date_and_time}",
+        params={"author": author},
+        version_id=version_id
+    )
+    logging.info("Submitted run %s of pipeline version %s", run.id, version_id)
+
+
+def compile_and_upload_pipeline(
+    dataform_shards: int = 1,
+    incremental: bool = False,
+    handoff: str = GCS_HANDOFF,
+    fused: bool = False,
+    step_caching: bool = True
+) -> str:
+    """Convenience function to compile and upload the pipeline, each only
+    when it changed
+
+    Returns:
+        str: ID of the pipeline version
+    """
+    package_path = compile_pipeline(
+        dataform_shards, incremental, handoff, fused, step_caching
+    )
+    return upload_pipeline(kfp.Client(PIPELINE_HOST), package_path)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--author",
-        help=("Author of the pipeline."),
+        help="Author of the runs submitted with --run or --run-only",
         type=str,
-        required=True
+    )
+    parser.add_argument(
+        "--run",
+        help="Also submits a run of the deployed pipeline",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--run-only",
+        help=(
+            "Submits a run of the last uploaded pipeline version, "
+            "without compiling or uploading the pipeline"
+        ),
+        action="store_true"
+    )
+    parser.add_argument(
+        "--dataform-shards",
+        help="Number of parallel steps running the Dataform actions",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only runs the Dataform actions affected since the last successful run",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--handoff",
+        help=(
+            "How the project is passed from the loader to the runner: through "
+            "GCS, or a volume mounted by both steps. Sharded runs always use GCS"
+        ),
+        type=str,
+        choices=HANDOFFS,
+        default=GCS_HANDOFF
+    )
+    parser.add_argument(
+        "--image-tag",
+        help="Tag of the component images, e.g. one built to try changes",
+        type=str,
+        default=DEFAULT_IMAGE_TAG
+    )
+    parser.add_argument(
+        "--fused",
+        help="Clones and runs the project in a single step, for low-latency runs",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--no-step-caching",
+        help="Prepares the project on every run, even if its commit and vars did not change",
+        action="store_true"
     )
     logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
-    author = args.author
-    compile_and_upload_pipeline()
+    if (args.run or args.run_only) and not args.author:
+        parser.error("--run and --run-only require --author")
+    image_tag = args.image_tag
+
+    if args.run_only:
+        pipeline_client = kfp.Client(PIPELINE_HOST)
+        submit_run(pipeline_client, latest_pipeline_version(pipeline_client), args.author)
+    else:
+        pipeline_version_id = compile_and_upload_pipeline(
+            args.dataform_shards, args.incremental, args.handoff, args.fused,
+            not args.no_step_caching
+        )
+        if args.run:
+            submit_run(kfp.Client(PIPELINE_HOST), pipeline_version_id, args.author)
@@ -2,128 +2,447 @@
 
 import argparse
 import logging
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime
 
-import google.auth
 import kfp
 from kfp.v2 import compiler
 from kfp.v2.google.client import AIPlatformClient
-from secret_helper import SecretManagerHelper
+
+from gcp_project import get_project_id
+from pipeline_cache import compile_cached, compile_key, component_source_files, spec_hash
 
 
-_, PROJECT_ID = google.auth.default()
 GCR_IMAGE_FOLDER = 'dataform-basic-example'
 
 GITHUB_CREDENTIALS_SECRET_NAME = "workshop_github_access_token"
-GITHUB_ACCESS_TOKEN = (
-    SecretManagerHelper(PROJECT_ID)
-    .get_secret(GITHUB_CREDENTIALS_SECRET_NAME)
-)
-REPO_URL = (
-    f"https://{GITHUB_ACCESS_TOKEN}:"
-    "x-oauth-basic@github.com/alexanderblnf/dataform-workshop-project"
-)
-
-KFP_ROOT_GCS_PATH = f"gs://{PROJECT_ID}-staging/kfp/vertex-ai"
+
+
+# Settings depending on the credentials are resolved on first use, so that
+# importing this module does not query the metadata server or Secret Manager
+@lru_cache(maxsize=None)
+def get_repo_url() -> str:
+    """Returns the URL of the Dataform repository, with the Github token"""
+    from secret_helper import SecretManagerHelper  # pylint: disable=import-outside-toplevel
+
+    github_access_token = (
+        SecretManagerHelper(get_project_id())
+        .get_secret(GITHUB_CREDENTIALS_SECRET_NAME)
+    )
+    return (
+        f"https://{github_access_token}:"
+        "x-oauth-basic@github.com/alexanderblnf/dataform-workshop-project"
+    )
+
+
+def get_gcs_bucket() -> str:
+    return f"{get_project_id()}-dataform-build"
+
+
+# The component images are shared by all the authors, see build_image.sh of
+# the components. Another tag can be built to try changes to a component
+DEFAULT_IMAGE_TAG = "latest"
+image_tag = DEFAULT_IMAGE_TAG
+
+
+def component_image(image_name: str) -> str:
+    """Returns the reference of the image of a component"""
+    return (
+        f"eu.gcr.io/{get_project_id()}/kfp/{GCR_IMAGE_FOLDER}/components/"
+        f"{image_name}:{image_tag}"
+    )
+
+
+def get_kfp_root_gcs_path() -> str:
+    return f"gs://{get_project_id()}-staging/kfp/vertex-ai"
+
+
 GCP_REGION = "europe-west4"
-GCS_BUCKET = f"{PROJECT_ID}-dataform-build"
 
-global author
+# How the loader hands the project to the runner
+GCS_HANDOFF = "gcs"
+ARTIFACT_HANDOFF = "artifact"
+HANDOFFS = (GCS_HANDOFF, ARTIFACT_HANDOFF)
+
+PACKAGE_DIR = Path("./pipeline-packages/")
+
+
+def build_pipeline(
+    dataform_shards: int = 1,
+    incremental: bool = False,
+    handoff: str = GCS_HANDOFF,
+    fused: bool = False,
+    step_caching: bool = True
+):
+    """Defines the pipeline, shared by all the authors who pass their name
+    per run. The defaults of its parameters need the credentials, so they
+    are only evaluated when the pipeline is compiled
+
+    Args:
+        dataform_shards (int): When above 1, the actions of the project are
+            split into up to this number of independent shards, run in parallel
+        incremental (bool): Whether to only run the actions affected by the
+            changes since the last successful run. Ignored when sharded
+        handoff (str): How the loader passes the project to the runner, one
+            of HANDOFFS. Ignored when sharded
+        fused (bool): Whether to clone and run the project in a single step.
+            Takes precedence over dataform_shards and handoff
+        step_caching (bool): Whether to resolve the commit first, so that
+            Vertex AI skips the steps preparing the project while the commit
+            and vars are unchanged. The project is then saved under a prefix
+            of its commit and vars. Ignored when incremental and not sharded,
+            or fused, as the prepared project then depends on previous runs
+    """
+    project_id = get_project_id()
+    kfp_root_gcs_path = get_kfp_root_gcs_path()
+    # Sharded runs always run all their actions
+    incremental_load = incremental and dataform_shards <= 1
+    incremental_arg = '"--incremental",' if incremental_load else ""
+    cached_load = step_caching and not (fused or incremental_load)
+
+    # The project is passed as a directory artifact instead of the GCS upload
+    # and download made by the components. Shards keep reading it from GCS
+    artifact_handoff = handoff == ARTIFACT_HANDOFF and dataform_shards <= 1
+    load_handoff_output = (
+        "outputs:\n    - {name: project, type: Artifact}" if artifact_handoff else ""
+    )
+    load_handoff_args = (
+        '"--handoff-dir", {outputPath: project}, "--skip-gcs-upload",'
+        if artifact_handoff else ""
+    )
+    run_handoff_input = "- {name: project, type: Artifact}" if artifact_handoff else ""
+    run_handoff_args = (
+        '"--handoff-dir", {inputPath: project},' if artifact_handoff else ""
+    )
 
-# TODO: Add author param
+    resolve_dataform_version_op = kfp.components.load_component_from_text(f'''
+    inputs:
+    - {{name: repo_url, type: String}}
+    - {{name: example_value, type: String}}
+    - {{name: author, type: String}}
+    - {{name: output_gcs_prefix, type: String}}
+    outputs:
+    - {{name: commit, type: String}}
+    - {{name: input_vars_hash, type: String}}
+    - {{name: snapshot_prefix, type: String}}
 
+    implementation:
+        container:
+            image: {component_image("load-dataform-gcs")}
+            args: [
+                "--resolve-only",
+                "--repo-url",
+                {{inputValue: repo_url}},
+                "--example-value",
+                {{inputValue: example_value}},
+                "--author",
+                {{inputValue: author}},
+                "--output-gcs-prefix",
+                {{inputValue: output_gcs_prefix}},
+                "--commit-output-path",
+                {{outputPath: commit}},
+                "--input-vars-hash-output-path",
+                {{outputPath: input_vars_hash}},
+                "--snapshot-prefix-output-path",
+                {{outputPath: snapshot_prefix}}
+            ]
+    ''')
 
-def compile_and_upload_pipeline():
     load_repo_and_edit_config_op = kfp.components.load_component_from_text(f'''
     inputs:
     - {{name: repo_url, type: String}}
     - {{name: example_value, type: String}}
+    - {{name: author, type: String}}
     - {{name: output_gcs_bucket, type: String}}
     - {{name: output_gcs_prefix, type: String}}
+    - {{name: repo_ref, type: String, optional: true}}
+    - {{name: snapshot_gcs_prefix, type: String, optional: true}}
+    {load_handoff_output}
 
     implementation:
         container:
-            image: eu.gcr.io/{PROJECT_ID}/kfp/{GCR_IMAGE_FOLDER}/{author}/components/load-dataform-gcs-{author}:latest
-            args: [
+            image: {component_image("load-dataform-gcs")}
+            args: [{incremental_arg}{load_handoff_args}
                 "--repo-url",
                 {{inputValue: repo_url}},
                 "--example-value",
                 {{inputValue: example_value}},
+                "--author",
+                {{inputValue: author}},
                 "--output-gcs-bucket",
                 {{inputValue: output_gcs_bucket}},
                 "--output-gcs-prefix",
-                {{inputValue: output_gcs_prefix}}
+                {{inputValue: output_gcs_prefix}},
+                {{if: {{cond: {{isPresent: repo_ref}}, then: [
+                    "--repo-ref",
+                    {{inputValue: repo_ref}}
+                ]}}}},
+                {{if: {{cond: {{isPresent: snapshot_gcs_prefix}}, then: [
+                    "--snapshot-gcs-prefix",
+                    {{inputValue: snapshot_gcs_prefix}}
+                ]}}}}
             ]
     ''')
 
     run_dataform_op = kfp.components.load_component_from_text(f'''
     inputs:
     - {{name: project_id, type: String}}
+    - {{name: author, type: String, optional: true}}
     - {{name: input_gcs_bucket, type: String}}
     - {{name: input_gcs_prefix, type: String}}
+    - {{name: actions_json, type: String, optional: true}}
+    - {{name: expected_commit, type: String, optional: true}}
+    {run_handoff_input}
     implementation:
         container:
-            image: eu.gcr.io/{PROJECT_ID}/kfp/{GCR_IMAGE_FOLDER}/{author}/components/run-dataform-example-{author}:latest
+            image: {component_image("run-dataform-example")}
+            args: [{incremental_arg}{run_handoff_args}
+                "--project-id",
+                {{inputValue: project_id}},
+                {{if: {{cond: {{isPresent: author}}, then: [
+                    "--author",
+                    {{inputValue: author}}
+                ]}}}},
+                "--input-gcs-bucket",
+                {{inputValue: input_gcs_bucket}},
+                "--input-gcs-prefix",
+                {{inputValue: input_gcs_prefix}},
+                {{if: {{cond: {{isPresent: actions_json}}, then: [
+                    "--actions-json",
+                    {{inputValue: actions_json}}
+                ]}}}},
+                {{if: {{cond: {{isPresent: expected_commit}}, then: [
+                    "--expected-commit",
+                    {{inputValue: expected_commit}}
+                ]}}}}
+            ]
+    ''')
+
+    # Clones and runs the project in a single step, for low-latency runs
+    fused_incremental_arg = '"--incremental",' if incremental else ""
+    clone_and_run_dataform_op = kfp.components.load_component_from_text(f'''
+    inputs:
+    - {{name: project_id, type: String}}
+    - {{name: repo_url, type: String}}
+    - {{name: example_value, type: String}}
+    - {{name: author, type: String}}
+    - {{name: gcs_bucket, type: String}}
+    - {{name: gcs_prefix, type: String}}
+    implementation:
+        container:
+            image: {component_image("clone-and-run-dataform")}
+            args: [{fused_incremental_arg}
+                "--project-id",
+                {{inputValue: project_id}},
+                "--repo-url",
+                {{inputValue: repo_url}},
+                "--example-value",
+                {{inputValue: example_value}},
+                "--author",
+                {{inputValue: author}},
+                "--gcs-bucket",
+                {{inputValue: gcs_bucket}},
+                "--gcs-prefix",
+                {{inputValue: gcs_prefix}}
+            ]
+    ''')
+
+    plan_dataform_shards_op = kfp.components.load_component_from_text(f'''
+    inputs:
+    - {{name: project_id, type: String}}
+    - {{name: author, type: String, optional: true}}
+    - {{name: input_gcs_bucket, type: String}}
+    - {{name: input_gcs_prefix, type: String}}
+    - {{name: shards, type: Integer}}
+    outputs:
+    - {{name: shards_json, type: JsonArray}}
+    implementation:
+        container:
+            image: {component_image("run-dataform-example")}
             args: [
                 "--project-id",
                 {{inputValue: project_id}},
+                {{if: {{cond: {{isPresent: author}}, then: [
+                    "--author",
+                    {{inputValue: author}}
+                ]}}}},
                 "--input-gcs-bucket",
                 {{inputValue: input_gcs_bucket}},
                 "--input-gcs-prefix",
-                {{inputValue: input_gcs_prefix}}
+                {{inputValue: input_gcs_prefix}},
+                "--plan-shards",
+                {{inputValue: shards}},
+                "--shards-output-path",
+                {{outputPath: shards_json}}
             ]
     ''')
 
     @kfp.dsl.pipeline(
         name='dataform-simple-example',
         description='This pipeline loads a dataform project from Github and runs it.',
-        pipeline_root=KFP_ROOT_GCS_PATH
+        pipeline_root=kfp_root_gcs_path
     )
     def dataform_simple_example_pipeline(
-        repo_url: str = REPO_URL,
+        author: str,
+        repo_url: str = get_repo_url(),
         example_value: str = "vertex-ai-value",
-        output_gcs_bucket: str = GCS_BUCKET,
+        output_gcs_bucket: str = get_gcs_bucket(),
         output_gcs_prefix: str = "dataform_folder",
-        # TODO: Add author param
     ):
+        if fused:
+            clone_and_run_step = clone_and_run_dataform_op(
+                project_id=project_id,
+                repo_url=repo_url,
+                example_value=example_value,
+                author=author,
+                gcs_bucket=output_gcs_bucket,
+                gcs_prefix=output_gcs_prefix
+            ).set_display_name('Clone and run Dataform')
+            clone_and_run_step.set_caching_options(False)
+            return
+
+        # Read by the runner, prefixed by the author unless already included
+        project_gcs_prefix = output_gcs_prefix
+        author_inputs = {"author": author}
+        # Only passed when the project is cached on the commit and vars
+        resolved_inputs = {}
+        commit_inputs = {}
+        if cached_load:
+            resolve_step = resolve_dataform_version_op(
+                repo_url=repo_url,
+                example_value=example_value,
+                author=author,
+                output_gcs_prefix=output_gcs_prefix
+            ).set_display_name('Resolve Dataform commit')
+            # The ref may point to a new commit on each run
+            resolve_step.set_caching_options(False)
+            # The snapshot prefix already includes the author
+            project_gcs_prefix = resolve_step.outputs["snapshot_prefix"]
+            author_inputs = {}
+            resolved_inputs = {
+                "repo_ref": resolve_step.outputs["commit"],
+                "snapshot_gcs_prefix": resolve_step.outputs["snapshot_prefix"],
+            }
+            commit_inputs = {"expected_commit": resolve_step.outputs["commit"]}
+
         # 1. Load training data from BigQuery
-        # TODO: Add author param
         load_repo_and_edit_config_step = load_repo_and_edit_config_op(
             repo_url=repo_url,
             example_value=example_value,
+            author=author,
             output_gcs_bucket=output_gcs_bucket,
-            output_gcs_prefix=f"{author}/{output_gcs_prefix}"
+            output_gcs_prefix=output_gcs_prefix,
+            **resolved_inputs
         ).set_display_name('Load Repository and Save to GCS Bucket')
-        load_repo_and_edit_config_step.execution_options.caching_strategy.max_cache_staleness = "P0D"
+        load_repo_and_edit_config_step.set_caching_options(cached_load)
 
         # 2. Validate training data
-        run_dataform_step = run_dataform_op(
-            project_id=PROJECT_ID,
+        if dataform_shards <= 1:
+            handoff_inputs = (
+                {"project": load_repo_and_edit_config_step.outputs["project"]}
+                if artifact_handoff else {}
+            )
+            run_dataform_step = run_dataform_op(
+                project_id=project_id,
+                input_gcs_bucket=output_gcs_bucket,
+                input_gcs_prefix=project_gcs_prefix,
+                **author_inputs,
+                **handoff_inputs,
+                **commit_inputs
+            ).after(load_repo_and_edit_config_step).set_display_name('Run Dataform example')
+            # Runs the actions, which must happen on every run
+            run_dataform_step.set_caching_options(False)
+            return
+
+        # 2. Compile the project and fan its shards out to parallel steps
+        plan_shards_step = plan_dataform_shards_op(
+            project_id=project_id,
             input_gcs_bucket=output_gcs_bucket,
-            input_gcs_prefix=f"{author}/{output_gcs_prefix}"
-        ).after(load_repo_and_edit_config_step).set_display_name('Run Dataform example')
-        run_dataform_step.execution_options.caching_strategy.max_cache_staleness = "P0D"
+            input_gcs_prefix=project_gcs_prefix,
+            shards=dataform_shards,
+            **author_inputs
+        ).after(load_repo_and_edit_config_step).set_display_name('Plan Dataform shards')
+        # Only depends on the project, saved under its commit and vars when cached
+        plan_shards_step.set_caching_options(cached_load)
+
+        with kfp.dsl.ParallelFor(plan_shards_step.outputs["shards_json"]) as shard_actions:
+            run_dataform_step = run_dataform_op(
+                project_id=project_id,
+                input_gcs_bucket=output_gcs_bucket,
+                input_gcs_prefix=project_gcs_prefix,
+                actions_json=shard_actions,
+                **author_inputs,
+                **commit_inputs
+            ).set_display_name('Run Dataform shard')
+            run_dataform_step.set_caching_options(False)
+
+    return dataform_simple_example_pipeline
 
-    """Convenience function to compile and upload the pipeline"""
-    logging.info("Compiling pipeline...")
-    package_dir = Path("./pipeline-packages/")
-    current_date_and_time = datetime.today().strftime('%Y-%m-%d-%H-%M-%S')
-    pipeline_package_path = (
-        package_dir / f"dataform-simple-example-pipeline-{current_date_and_time}.json"
-    )
-    pipeline_package_path.parent.mkdir(parents=True, exist_ok=True)
 
-    compiler.Compiler().compile(
-        pipeline_func=dataform_simple_example_pipeline,
-        package_path=str(pipeline_package_path))
+def compile_pipeline(
+    dataform_shards: int = 1,
+    incremental: bool = False,
+    handoff: str = GCS_HANDOFF,
+    fused: bool = False,
+    step_caching: bool = True
+) -> Path:
+    """Compiles the pipeline, unless it was already compiled with the same
+    definition and settings
+
+    Returns:
+        Path: Path of the compiled job spec
+    """
+    settings = {
+        "dataform_shards": dataform_shards,
+        "incremental": incremental,
+        "handoff": handoff,
+        "fused": fused,
+        "step_caching": step_caching,
+        "image_tag": image_tag,
+        # Defaults of the pipeline parameters
+        "defaults": [get_repo_url(), get_gcs_bucket(), get_kfp_root_gcs_path()],
+        "kfp": kfp.__version__,
+    }
+    return compile_cached(
+        lambda package_path: compiler.Compiler().compile(
+            pipeline_func=build_pipeline(
+                dataform_shards, incremental, handoff, fused, step_caching
+            ),
+            package_path=package_path
+        ),
+        PACKAGE_DIR,
+        "dataform-simple-example-pipeline",
+        compile_key([Path(__file__), *component_source_files()], settings),
+        ".json"
+    )
 
-    api_client = AIPlatformClient(project_id=PROJECT_ID, region=GCP_REGION)
 
+def submit_run(package_path: Path, author: str):
+    """Runs the compiled pipeline for an author, labelled with the hash of
+    its spec to tell which runs share a definition"""
+    api_client = AIPlatformClient(project_id=get_project_id(), region=GCP_REGION)
     api_client.create_run_from_job_spec(
-        str(pipeline_package_path),
-        pipeline_root=KFP_ROOT_GCS_PATH,
-        enable_caching=False
+        str(package_path),
+        pipeline_root=get_kfp_root_gcs_path(),
+        parameter_values={"author": author},
+        # Left to each step, see build_pipeline
+        enable_caching=None,
+        labels={"pipeline-spec": spec_hash(package_path)[:16]}
+    )
+
+
+def compile_and_upload_pipeline(
+    author: str,
+    dataform_shards: int = 1,
+    incremental: bool = False,
+    handoff: str = GCS_HANDOFF,
+    fused: bool = False,
+    step_caching: bool = True
+):
+    """Convenience function to compile the pipeline, when it changed, and run it"""
+    submit_run(
+        compile_pipeline(dataform_shards, incremental, handoff, fused, step_caching),
+        author
     )
 
 
@@ -131,11 +450,51 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--author",
-        help=("Author of the pipeline."),
+        help="Author of the run",
         type=str,
         required=True
     )
+    parser.add_argument(
+        "--dataform-shards",
+        help="Number of parallel steps running the Dataform actions",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only runs the Dataform actions affected since the last successful run",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--handoff",
+        help=(
+            "How the project is passed from the loader to the runner: through "
+            "GCS, or as a pipeline artifact. Sharded runs always use GCS"
+        ),
+        type=str,
+        choices=HANDOFFS,
+        default=GCS_HANDOFF
+    )
+    parser.add_argument(
+        "--image-tag",
+        help="Tag of the component images, e.g. one built to try changes",
+        type=str,
+        default=DEFAULT_IMAGE_TAG
+    )
+    parser.add_argument(
+        "--fused",
+        help="Clones and runs the project in a single step, for low-latency runs",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--no-step-caching",
+        help="Prepares the project on every run, even if its commit and vars did not change",
+        action="store_true"
+    )
     logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
-    author = args.author
-    compile_and_upload_pipeline()
+    image_tag = args.image_tag
+    compile_and_upload_pipeline(
+        args.author, args.dataform_shards, args.incremental, args.handoff, args.fused,
+        not args.no_step_caching
+    )
@@ -0,0 +1,22 @@
+"""
+Contains lazily-resolved settings of the Google Cloud project.
+
+google.auth.default() may query the metadata server, so it must not run
+when a DAG or pipeline module is imported: modules call get_project_id()
+from the code that needs the project instead.
+"""
+
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_project_id() -> str:
+    """Returns the project of the default credentials, resolved on first use
+
+    Returns:
+        str: The GCP project ID
+    """
+    import google.auth  # pylint: disable=import-outside-toplevel
+
+    _, project_id = google.auth.default()
+    return project_id
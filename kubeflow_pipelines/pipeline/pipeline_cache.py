@@ -0,0 +1,120 @@
+"""
+Contains helpers to only compile a pipeline when its definition changed, and
+to identify the compiled spec by its content, so that deploying an unchanged
+pipeline neither compiles nor uploads it again.
+
+The compiled package is named after a key covering the source of the
+pipeline module and of the components, the compile settings and the KFP
+version. Its content hash
+ignores the fields the compilers set on every compile, like the time.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Callable, Iterable, List
+
+import yaml
+
+# Set by the compilers on every compile, left out of the content hash
+VOLATILE_SPEC_KEYS = ("pipelines.kubeflow.org/pipeline_compilation_time",)
+
+COMPONENTS_DIR = Path(__file__).resolve().parent.parent / "components"
+
+
+def component_source_files(components_dir: Path = COMPONENTS_DIR) -> List[Path]:
+    """Returns the files the component images are built from, which define
+    the arguments and outputs the pipeline relies on
+
+    Args:
+        components_dir (Path): Directory of the components
+
+    Returns:
+        List[Path]: The files, without the Python bytecode
+    """
+    return sorted(
+        path for path in Path(components_dir).rglob("*")
+        if path.is_file() and "__pycache__" not in path.parts
+    )
+
+
+def compile_key(source_files: Iterable[Path], settings: dict) -> str:
+    """Returns the key of a compile, which changes with the pipeline definition
+
+    Args:
+        source_files (Iterable[Path]): Files defining the pipeline
+        settings (dict): Settings of the compile, serializable to JSON
+
+    Returns:
+        str: Hex digest of the sources and settings
+    """
+    source_files = sorted(Path(path).resolve() for path in source_files)
+    # Relative, so that the key does not depend on where the repo is checked out
+    root = Path(os.path.commonpath(source_files)) if source_files else Path()
+    digest = hashlib.sha256()
+    for source_file in source_files:
+        digest.update(source_file.relative_to(root).as_posix().encode())
+        digest.update(source_file.read_bytes())
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def compile_cached(
+    compile_to: Callable[[str], None],
+    package_dir: Path,
+    package_name: str,
+    key: str,
+    suffix: str
+) -> Path:
+    """Returns the package compiled for the key, compiling it if missing
+
+    Args:
+        compile_to (Callable[[str], None]): Compiles the pipeline to a path.
+            The compilers pick the format from its extension
+        package_dir (Path): Directory of the compiled packages
+        package_name (str): Name of the package, before its key
+        key (str): Key of the compile, see compile_key
+        suffix (str): Extension of the package, e.g. ".yaml" or ".json"
+
+    Returns:
+        Path: Path of the compiled package
+    """
+    package_path = Path(package_dir) / f"{package_name}-{key[:16]}{suffix}"
+    if package_path.exists():
+        logging.info("Pipeline unchanged, reusing %s", package_path)
+        return package_path
+
+    logging.info("Compiling pipeline to %s...", package_path)
+    package_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = package_path.with_name(f".{package_path.stem}.{os.getpid()}.tmp{suffix}")
+    compile_to(str(tmp_path))
+    os.replace(tmp_path, package_path)
+    return package_path
+
+
+def _without_volatile_keys(value):
+    if isinstance(value, dict):
+        return {
+            key: _without_volatile_keys(item)
+            for key, item in value.items()
+            if key not in VOLATILE_SPEC_KEYS
+        }
+    if isinstance(value, list):
+        return [_without_volatile_keys(item) for item in value]
+    return value
+
+
+def spec_hash(package_path: Path) -> str:
+    """Returns the hash of the content of a compiled pipeline
+
+    Args:
+        package_path (Path): Compiled pipeline, as JSON or YAML
+
+    Returns:
+        str: Hex digest of the spec, without its volatile fields
+    """
+    spec = yaml.safe_load(Path(package_path).read_text())
+    normalized = json.dumps(_without_volatile_keys(spec), sort_keys=True)
+    return hashlib.sha256(normalized.encode()).hexdigest()